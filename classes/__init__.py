@@ -1,2 +1,7 @@
+from .proposal_set import *
+from .round_store import *
 from .process import *
+from .pipelined_process import *
+from .async_process import *
 from .server import *
+from .sharding import *
@@ -0,0 +1,173 @@
+"""Actor
+
+Single consumer of a queue of calls. A process hands every change to its
+protocol state to its actor: connection readers enqueue the messages they
+decode, writers and the failure detector enqueue crashes, and proposals from
+other threads wait for their call to run. The actor runs the calls one at a
+time on its own thread in the order they were enqueued, so the protocol
+state is only touched by one thread, needs no lock, and processes the same
+sequence of events the same way every time. Calls can also be delayed, e.g.
+to batch work, and run on the same thread once they are due.
+"""
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Actor:
+    def __init__(self, name='actor', metrics=None):
+        self.name = name        # Name of the actor's thread.
+        self.metrics = metrics  # Optional Metrics to record how long calls wait in the queue in.
+        self.queue = queue.SimpleQueue()  # (callable, args, Future or None, enqueue time), then None to stop.
+        self.thread = None
+        self.closed = False
+        self.lock = threading.Lock()  # Orders closing against enqueueing, so no call is left behind.
+        self.timers = []  # Heap of (due time, sequence number, callable, args) of delayed calls, only used by the actor.
+        self.timer_ids = itertools.count()  # Orders delayed calls that are due at the same time.
+
+    def start(self):
+        """Start running enqueued calls on the actor's thread.
+
+        Return: N/A
+        """
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def is_current(self):
+        """Check if calls made now run straight away on the calling thread.
+        That is the case on the actor's own thread, and before it starts or once it is closed.
+
+        Return: True if a call would run on the calling thread.
+        """
+        return self.thread is None or self.closed or threading.current_thread() is self.thread
+
+    def tell(self, function, *args):
+        """Run a call on the actor without waiting for it.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        if not self.enqueue((function, args, None, time.perf_counter())):
+            function(*args)
+
+    def ask(self, function, *args):
+        """Run a call on the actor and wait for its result.
+        Calls from the actor's own thread run straight away, so they cannot deadlock.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: result of function.
+        """
+        if self.is_current():
+            return function(*args)
+        future = concurrent.futures.Future()
+        if not self.enqueue((function, args, future, time.perf_counter())):
+            return function(*args)
+        return future.result()
+
+    def tell_later(self, delay, function, *args):
+        """Run a call on the actor once a delay has passed, without waiting for it.
+        Delayed calls only run while the actor is running.
+
+        Keyword arguments:
+        delay -- seconds to wait before running the call.
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        self.tell(self.add_timer, time.monotonic() + delay, function, args)
+
+    def add_timer(self, due, function, args):
+        """Add a delayed call to the timer heap, on the actor.
+
+        Keyword arguments:
+        due -- time.monotonic() time the call is due at.
+        function -- callable to run.
+        args -- tuple of arguments for function.
+        Return: N/A
+        """
+        heapq.heappush(self.timers, (due, next(self.timer_ids), function, args))
+
+    def enqueue(self, call):
+        """Add a call to the queue unless the actor is not running.
+
+        Keyword arguments:
+        call -- tuple of callable, args, Future or None and enqueue time.
+        Return: True if the call was enqueued.
+        """
+        with self.lock:
+            if self.thread is None or self.closed:
+                return False
+            self.queue.put(call)
+            return True
+
+    def qsize(self):
+        """Number of calls waiting to run.
+
+        Return: int queue depth.
+        """
+        return self.queue.qsize()
+
+    def close(self):
+        """Stop the actor once the calls already enqueued have run.
+        Later calls run on the calling thread.
+
+        Return: N/A
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+
+    def run(self):
+        """Run enqueued calls one at a time until closed.
+
+        Return: N/A
+        """
+        while True:
+            while self.timers and self.timers[0][0] <= time.monotonic():
+                due, timer_id, function, args = heapq.heappop(self.timers)
+                self.call(function, args, None)
+            try:
+                # Wake up for the next delayed call if nothing is enqueued before it is due.
+                call = self.queue.get(timeout=max(0, self.timers[0][0] - time.monotonic()) if self.timers else None)
+            except queue.Empty:
+                continue
+            if call is None:
+                return
+            function, args, future, enqueued_at = call
+            if self.metrics is not None:
+                self.metrics.histogram('actor.queue_wait').observe(time.perf_counter() - enqueued_at)
+            self.call(function, args, future)
+
+    def call(self, function, args, future):
+        """Run a single call, handing its result or error to whoever is waiting for it.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- tuple of arguments for function.
+        future -- Future to set, or None if nobody is waiting.
+        Return: N/A
+        """
+        try:
+            result = function(*args)
+        except Exception as e:
+            if future is None:
+                # Nobody is waiting for the call, and one bad event must not stop the process.
+                logger.exception("Error in %s", getattr(function, '__name__', function))
+            else:
+                future.set_exception(e)
+        else:
+            if future is not None:
+                future.set_result(result)
@@ -0,0 +1,594 @@
+"""AsyncProcess
+
+This class represents a process that runs the same flooding regular consensus
+protocol as Process, but serves every peer connection from a single asyncio
+event loop instead of a thread per connection. Outbound messages are written
+to each peer's transport without blocking, so a node can keep hundreds of
+peers connected with one thread. The event loop is the only thread that
+changes the protocol state, so it takes the place of Process's actor.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+from .dialer import JoinResult, backoff_delay
+from .framing import FrameDecoder, FrameError
+from .process import Process
+from .state_transfer import encode_chunks
+from .transport import TCP, UNIX
+
+MAX_WRITE_BUFFER = 4 * 1024 * 1024  # Bytes buffered for a peer before it is considered stalled.
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncProcess(Process):
+    def __init__(self, host, port, **kwargs):
+        super().__init__(host, port, **kwargs)
+        # The asyncio engine does not use the blocking listening socket.
+        self.socket.close()
+        self.socket = None
+
+        # Event Loop #
+        self.loop = None         # Event loop running every peer connection.
+        self.server = None       # asyncio server accepting peer connections.
+        self.unix_server = None  # asyncio server accepting peer connections on the unix transport, if it is used.
+        self.round_event = asyncio.Event()  # Set and replaced whenever the current round changes.
+        self.listen_error = None  # Error raised while starting to listen.
+        self.metrics.gauge('write_buffer_bytes', self.write_buffer_size)
+
+    # ****************** #
+    # Socket Connections #
+
+    async def open_connection(self, peer_host, peer_port, greeting=None, transport=TCP, address=None):
+        """Open a connection to a peer or server on the event loop.
+
+        Keyword arguments:
+        peer_host -- host address of the peer connection.
+        peer_port -- port number of the peer connection.
+        greeting -- optional dict message to send once connected.
+        transport -- transport to connect over.
+        address -- address on the transport, or None for peer_host and peer_port.
+        Return: tuple of StreamReader and StreamWriter of new connection.
+        """
+        reader, writer = await transport.open_connection(address or (peer_host, peer_port))
+        self.connections.append(writer)
+        if greeting is not None:
+            writer.write(self.encode_data(greeting))
+        return reader, writer
+
+    def connect_to_rendezvous(self, server_host, server_port):
+        """Create connection to server to access group of peers.
+
+        Keyword arguments:
+        server_host -- host address of server connection.
+        server_port -- port number of server connection.
+        Return: N/A
+        """
+        self.join_result = concurrent.futures.Future()
+        future = asyncio.run_coroutine_threadsafe(
+            self.open_connection(server_host, server_port, greeting=self.greeting('new')), self.loop)
+        reader, self.server_connection = future.result()
+
+        # The server replies and pushes membership changes on the same connection.
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.read_stream(reader, self.server_connection, None))
+
+    def connect(self, peer_host, peer_port):
+        """Schedule a connection to a peer on the event loop.
+
+        Keyword arguments:
+        peer_host -- host address of the peer connection.
+        peer_port -- port number of the peer connection, which is also its peer ID.
+        Return: Task that resolves to the new connection.
+        """
+        return self.loop.create_task(self.connect_to_peer(peer_host, peer_port))
+
+    async def connect_to_peer(self, peer_host, peer_port, timeout=None):
+        """Connect to a peer and say hello, so the peer can use the connection in both directions.
+        The peer is added once it says hello back.
+
+        Keyword arguments:
+        peer_host -- host address of the peer connection.
+        peer_port -- port number of the peer connection, which is also its peer ID.
+        timeout -- optional seconds the connection attempt may take.
+        Return: StreamWriter of new connection, or None if it failed.
+        """
+        # Try the best transport that reaches the peer first.
+        for transport, address in self.dial_addresses(peer_host, peer_port):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    self.open_connection(peer_host, peer_port, self.greeting('hello'), transport, address),
+                    timeout)
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.debug("Failed to connect to %s over %s. Error: %r", address, transport.name, e)
+        else:
+            return None
+
+        logger.debug("Now connected to %s:%s", peer_host, peer_port)
+        self.loop.create_task(self.read_stream(reader, writer, peer_port))
+        return writer
+
+    def send_handshake(self, data, connection):
+        """Send a hello or bye on a peer connection's transport.
+
+        Keyword arguments:
+        data -- dict message to be sent.
+        connection -- StreamWriter of the peer connection.
+        Return: N/A
+        """
+        if not connection.is_closing():
+            connection.write(self.encode_data(data))
+
+    def close_connection(self, connection):
+        """Close a connection's transport.
+
+        Keyword arguments:
+        connection -- StreamWriter to close.
+        Return: N/A
+        """
+        connection.close()
+
+    def join_peers(self, ports):
+        """Open a connection to every peer currently in the network that the overlay makes a neighbour, concurrently.
+
+        Keyword arguments:
+        ports -- list of int port numbers of the active peers.
+        Return: N/A
+        """
+        ports = [port for port in sorted(self.overlay.neighbours(self.port, ports)) if port not in self.peers]
+        self.loop.create_task(self.dial_peers("127.0.0.1", ports))
+
+    def dial_neighbours(self, ports):
+        """Dial new neighbours concurrently on the event loop.
+
+        Keyword arguments:
+        ports -- list of int port numbers to dial.
+        Return: N/A
+        """
+        self.dialing.update(ports)
+        in_flight = asyncio.Semaphore(self.dialer.max_in_flight)
+        dials = asyncio.gather(*(self.dial_peer("127.0.0.1", port, in_flight) for port in ports))
+        dials.add_done_callback(lambda dials: self.dialing.difference_update(ports))
+
+    async def dial_peers(self, peer_host, ports):
+        """Dial every port with at most the dialer's limit of dials in flight, then report the join.
+
+        Keyword arguments:
+        peer_host -- host address of the peers.
+        ports -- list of int port numbers to dial.
+        Return: N/A
+        """
+        start = time.perf_counter()
+        in_flight = asyncio.Semaphore(self.dialer.max_in_flight)
+        dialed = await asyncio.gather(*(self.dial_peer(peer_host, port, in_flight) for port in ports))
+        reached = sorted(port for port, ok in zip(ports, dialed) if ok)
+        unreachable = sorted(port for port, ok in zip(ports, dialed) if not ok)
+        self.finish_join(JoinResult(reached, unreachable, time.perf_counter() - start))
+
+    async def dial_peer(self, peer_host, peer_port, in_flight):
+        """Dial a peer, retrying with exponential backoff.
+
+        Keyword arguments:
+        peer_host -- host address of the peer.
+        peer_port -- port number of the peer.
+        in_flight -- Semaphore bounding the dials in flight.
+        Return: True if a connection was opened.
+        """
+        for attempt in range(self.dialer.retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt, self.dialer.backoff))
+            if self.stopped.is_set():
+                return False
+            async with in_flight:
+                if await self.connect_to_peer(peer_host, peer_port, self.dialer.timeout) is not None:
+                    return True
+        logger.warning("Could not connect to %s:%s after %d attempts", peer_host, peer_port, self.dialer.retries + 1)
+        return False
+
+    async def listen(self):
+        """Listen for incoming connections on the event loop, on TCP and the other transports.
+
+        Return: N/A
+        """
+        self.server = await TCP.start_server(self.handle_stream, self.host, self.port, 1024)
+        logger.info("Listening for connections on %s:%s", self.host, self.port)
+        if 'unix' in self.transports:
+            # Owning the TCP port means the unix socket's path is free to take over.
+            self.unix_server = await UNIX.start_server(self.handle_stream, self.host, self.port, 1024)
+            self.unix_path = UNIX.path(self.port)
+            logger.info("Listening for connections at %s", self.unix_path)
+        self.listening.set()
+
+    def adopt(self, connection):
+        """Serve a connection a peer opened on the event loop, from any thread.
+
+        Keyword arguments:
+        connection -- socket of the accepted connection.
+        Return: N/A
+        """
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.adopt_socket(connection))
+
+    async def adopt_socket(self, connection):
+        """Wrap an accepted socket in a stream and serve it.
+
+        Keyword arguments:
+        connection -- socket of the accepted connection.
+        Return: N/A
+        """
+        try:
+            reader, writer = await asyncio.open_connection(sock=connection)
+        except OSError as e:
+            logger.debug("Failed to adopt connection %s. Error: %r", connection, e)
+            connection.close()
+            return
+        await self.handle_stream(reader, writer)
+
+    async def handle_stream(self, reader, writer):
+        """Receive and handle incoming data from a connected node.
+
+        Keyword arguments:
+        reader -- StreamReader of the accepted connection.
+        writer -- StreamWriter of the accepted connection.
+        Return: N/A
+        """
+        self.connections.append(writer)
+        logger.debug("Accepted connection from %s", writer.get_extra_info('peername'))
+        # The peer is only known once its hello arrives.
+        await self.read_stream(reader, writer, None)
+
+    async def read_stream(self, reader, writer, peer_id):
+        """Read frames from a connection until it closes.
+        The first message on a peer connection is the peer's hello.
+
+        Keyword arguments:
+        reader -- StreamReader of the connection.
+        writer -- StreamWriter of the connection.
+        peer_id -- port of a dialed peer, or None for accepted connections and the server.
+        Return: N/A
+        """
+        dialed = peer_id is not None
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = await reader.read(65536)
+                if not data:
+                    # The peer closed the connection.
+                    self.crash_connection(writer)
+                    break
+
+                self.metrics.counter('bytes_in').inc(len(data))
+                if peer_id is not None and self.failure_detector is not None:
+                    # Everything received from a peer shows it is alive, even part of a large message.
+                    self.failure_detector.heartbeat(peer_id)
+                data_messages = self.decode_data(decoder.feed(data))
+                logger.debug("Received data from %s: %s", peer_id, data_messages)
+
+                self.receive_messages(data_messages, writer, peer_id, dialed)
+                for data_message in data_messages:
+                    if 'hello' in data_message:
+                        peer_id = data_message['hello']
+
+            except (OSError, FrameError):
+                self.crash_connection(writer)
+                break
+
+    def write(self, encoded_data, connection):
+        """Queue encoded data on a connection's transport.
+        The transport coalesces writes, and a peer whose buffer keeps growing
+        has stalled and is dropped.
+
+        Keyword arguments:
+        encoded_data -- framed bytes to be sent.
+        connection -- StreamWriter to send the data on.
+        Return: N/A
+        """
+        if connection.is_closing() or self.stopped.is_set():
+            # The connection is already being closed, by the peer or by stop(), so it has not stalled.
+            self.crash_connection(connection)
+            return
+        if connection.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            # The peer has not read what was already buffered for it.
+            logger.warning("Dropping stalled connection %s", connection)
+            self.crash_connection(connection)
+            return
+        self.metrics.counter('bytes_out').inc(len(encoded_data))
+        connection.write(encoded_data)
+        self.last_sent[connection] = time.monotonic()
+        if connection.transport.get_write_buffer_size():
+            # Only wait on peers whose socket could not take the data immediately.
+            self.loop.create_task(self.drain(connection))
+
+    def write_buffer_size(self):
+        """Number of bytes buffered on every out connection, waiting to be sent.
+
+        Return: int bytes.
+        """
+        return sum(connection.transport.get_write_buffer_size() for connection in self.peers.connections())
+
+    async def drain(self, connection):
+        """Wait for a connection's write buffer to flush.
+        While profiling, the wait is recorded as writer.drain, which takes the
+        place of the threaded engine's blocked sends.
+
+        Keyword arguments:
+        connection -- StreamWriter being flushed.
+        Return: N/A
+        """
+        started = time.perf_counter() if self.profiling else None
+        try:
+            await connection.drain()
+        except OSError:
+            self.crash_connection(connection)
+            return
+        if started is not None:
+            self.metrics.histogram('writer.drain').observe(time.perf_counter() - started)
+
+    async def monitor_peers(self):
+        """Check on peers every heartbeat interval on the event loop until stopped.
+
+        Return: N/A
+        """
+        while not self.stopped.is_set():
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self.stopped.is_set():
+                self.check_peers()
+
+    def has_unread_data(self, connection):
+        """Check if data has arrived on a connection's socket that the event loop has not read yet.
+
+        Keyword arguments:
+        connection -- StreamWriter of the peer connection.
+        Return: True if the connection's socket is readable.
+        """
+        sock = connection.get_extra_info('socket')
+        return sock is not None and super().has_unread_data(sock)
+
+    def is_local_connection(self, connection):
+        """Check if a connection was made over the unix socket, so from the same host.
+
+        Keyword arguments:
+        connection -- StreamWriter of the connection.
+        Return: True if the connection is over a Unix domain socket.
+        """
+        sock = connection.get_extra_info('socket')
+        return sock is not None and super().is_local_connection(sock)
+
+    def run(self, listen=True):
+        """Run the event loop until the process is stopped.
+
+        Keyword arguments:
+        listen -- flag for if the process accepts its own connections.
+        Return: N/A
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if listen:
+                self.loop.run_until_complete(self.listen())
+            else:
+                self.listening.set()
+        except OSError as e:
+            # Hand the error to start(), which is waiting for the process to listen.
+            self.listen_error = e
+            self.listening.set()
+            self.loop.close()
+            return
+        if self.failure_detector is not None:
+            self.loop.create_task(self.monitor_peers())
+        self.loop.run_forever()
+
+        # Let the connection tasks see their closed connections before closing the loop.
+        tasks = asyncio.all_tasks(self.loop)
+        if tasks:
+            done, pending = self.loop.run_until_complete(asyncio.wait(tasks, timeout=1))
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+    def start(self, listen=True):
+        """Start thread running the event loop for all connections.
+
+        Keyword arguments:
+        listen -- flag for if the process accepts its own connections, False
+                  if its node accepts them and adopts them into the process.
+        Return: N/A
+        """
+        loop_thread = threading.Thread(target=self.run, args=(listen,), daemon=True)
+        loop_thread.start()
+        self.listening.wait()
+        if self.listen_error is not None:
+            raise self.listen_error
+
+    def stop(self):
+        """Stop the process, closing every connection and the event loop.
+
+        Return: N/A
+        """
+        if self.stopped.is_set():
+            return
+        if self.loop is not None and not self.loop_is_current():
+            self.loop.call_soon_threadsafe(self.stop)
+            return
+        self.stopped.set()
+        logger.info("Stopping process %s...", self.port)
+
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.log is not None:
+            self.log.close()
+        self.metrics.stop_dump()
+        for server in (self.server, self.unix_server):
+            if server is not None:
+                server.close()
+        if self.unix_path is not None:
+            UNIX.remove(self.unix_path)
+        for connection in list(self.connections):
+            connection.close()
+
+        self.notify_round_change()
+        if self.loop is not None:
+            self.loop.stop()
+
+    # ************** #
+    # State Transfer #
+
+    def send_snapshot(self, connection):
+        """Stream a snapshot of this process's state to a joining peer from a task on the event loop.
+
+        Keyword arguments:
+        connection -- StreamWriter of the peer that asked for it.
+        Return: N/A
+        """
+        self.loop.create_task(self.stream_snapshot(self.snapshot_state(), connection))
+
+    async def stream_snapshot(self, state, connection):
+        """Send a snapshot one chunk at a time, draining the connection after each chunk.
+        The snapshot is encoded off the event loop, so rounds keep running meanwhile.
+
+        Keyword arguments:
+        state -- RecoveredState to send.
+        connection -- StreamWriter of the peer connection.
+        Return: N/A
+        """
+        chunks = await self.loop.run_in_executor(None, encode_chunks, state)
+        logger.info("Sending state up to round %s in %d chunks.", state.next_round_id, len(chunks))
+        for index, chunk in enumerate(chunks):
+            if connection.is_closing() or self.peers.peer_id(connection) is None:
+                # The peer has crashed.
+                return
+            self.send_to_connection({'snapshot_chunk': (index, len(chunks), chunk)}, connection)
+            try:
+                await connection.drain()
+            except OSError:
+                self.crash_connection(connection)
+                return
+
+    # ******* #
+    # Waiting #
+
+    def notify_round_change(self):
+        """Wake every thread and coroutine waiting on the current round or a decision.
+
+        Return: N/A
+        """
+        super().notify_round_change()
+        if self.loop is None or self.loop_is_current():
+            event, self.round_event = self.round_event, asyncio.Event()
+            event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.notify_round_change)
+
+    async def wait_for_round_change_async(self, round_id):
+        """Wait on the event loop until the current round is no longer round_id.
+
+        Keyword arguments:
+        round_id -- int ID of the round being waited on.
+        Return: int ID of the new current round, or None if the process stopped.
+        """
+        while self.current_round_id == round_id and not self.stopped.is_set():
+            await self.round_event.wait()
+        return None if self.current_round_id == round_id else self.current_round_id
+
+    async def wait_for_decision_async(self, round_id):
+        """Wait on the event loop until a round has been delivered.
+
+        Keyword arguments:
+        round_id -- int ID of the round being waited on.
+        Return: decided value of the round, or None if the process stopped or the round ended by a crash.
+        """
+        while self.current_round_id <= round_id and not self.stopped.is_set():
+            await self.round_event.wait()
+        return self.rounds.decision(round_id)
+
+    async def wait_for_shutdown_async(self):
+        """Wait on the event loop until the process is stopped.
+
+        Return: N/A
+        """
+        while not self.stopped.is_set():
+            await self.round_event.wait()
+
+    # ****************** #
+    # Flooding Algorithm #
+
+    def propose(self, value):
+        """ Propose a user input value on the event loop.
+        Proposals may come from the main thread, so they are handed to the
+        loop to keep all protocol state changes on a single thread.
+
+        Keyword arguments:
+        value -- user entered value
+        Return: N/A
+        """
+        if self.loop is None or self.loop_is_current():
+            super().propose(value)
+        else:
+            self.loop.call_soon_threadsafe(super().propose, value)
+
+    def schedule(self, delay, function, *args):
+        """Run a function against the protocol state on the event loop once a delay has passed.
+
+        Keyword arguments:
+        delay -- seconds to wait.
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        self.loop.call_later(delay, function, *args)
+
+    def dispatch(self, function, *args):
+        """Run a function against the protocol state on the event loop from any thread, without waiting for it.
+        Once the process has stopped the loop no longer runs calls, so they run on the calling thread.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        if self.loop is None or self.stopped.is_set():
+            function(*args)
+            return
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            # The loop closed meanwhile.
+            function(*args)
+
+    def execute(self, function, *args):
+        """Run a function against the protocol state on the event loop and return its result.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: result of function.
+        """
+        if self.loop is None or self.loop_is_current():
+            return function(*args)
+
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def loop_is_current(self):
+        """Check if the caller is running on the process's event loop.
+
+        Return: True if called from the event loop thread.
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
@@ -0,0 +1,191 @@
+"""Batcher
+
+Collects values submitted through Process.submit into batches, so that a
+single consensus round can order many client values. A batch is proposed once
+it reaches its size threshold or its oldest value has waited for the time
+threshold, and only when the process has a round it has not proposed in yet.
+Each submitted value gets a future that resolves with the decided value once
+its batch is decided. Only one batch wins each round, so a batch that loses,
+or whose round ends without a decision, is proposed again unchanged in a
+later round, ahead of newer values. A losing batch stays in the proposal set,
+so it may also win a later round it was not proposed in, which resolves it
+all the same. A round cannot end until every process
+has proposed in it, so when a peer starts a round the current batch is sent
+at once, even if it is empty.
+"""
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+from .metrics import SIZE_BOUNDS
+from .proposal_set import freeze
+
+
+class Batcher:
+    def __init__(self, process, batch_size=64, batch_delay=0.005):
+        self.process = process          # Process that batches are proposed through.
+        self.batch_size = batch_size    # Number of values that triggers a batch immediately.
+        self.batch_delay = batch_delay  # Seconds the oldest value waits before a partial batch is sent.
+
+        self.pending = collections.deque()  # Submitted (value, future, submit time) waiting for a batch.
+        # Dict of proposed value to the list of (value, future, submit time) of each batch not decided yet.
+        self.undecided = dict()
+        self.retry = collections.deque()  # Proposed values of the batches that lost their round.
+        self.in_flight = dict()  # Dict of round ID to the value of the batch proposed in it.
+        self.condition = threading.Condition()
+        self.delivered = 0  # Number of rounds delivered, to notice a round freeing up.
+        self.flush_now = False  # Flag for if a peer is waiting on this process's next batch.
+        self.closed = False
+
+        process.decision_listeners.append(self.on_decision)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, value):
+        """Submit a value to be ordered by consensus.
+
+        Keyword arguments:
+        value -- value to be proposed.
+        Return: Future that resolves with the decided value of its round.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Batcher is closed.")
+            self.pending.append((value, future, time.monotonic()))
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify()
+        return future
+
+    def round_opened(self):
+        """Send the current batch without waiting, because a peer has started a round.
+
+        Return: N/A
+        """
+        with self.condition:
+            if not self.flush_now:
+                self.flush_now = True
+                self.condition.notify()
+
+    def round_freed(self):
+        """Retry waiting batches because a round became free without one being delivered,
+        e.g. once a joining process has caught up with its peers.
+
+        Return: N/A
+        """
+        with self.condition:
+            self.delivered += 1
+            self.condition.notify()
+
+    def on_decision(self, round_id, value):
+        """Resolve the futures of the batch a delivered round decided, if it is one of this process's.
+        The batch proposed in the round is proposed again unchanged if it lost,
+        as it may still be decided under the value it was first proposed as.
+
+        Keyword arguments:
+        round_id -- int ID of the delivered round.
+        value -- decided value, or None if the round ended because of a crash.
+        Return: N/A
+        """
+        with self.condition:
+            proposed = self.in_flight.pop(round_id, None)
+            decided = freeze(value) if value is not None else None
+            won = self.undecided.pop(decided, None)
+            if won is not None and decided in self.retry:
+                # A batch waiting to be proposed again can win any round, as it is still in the proposal set.
+                self.retry.remove(decided)
+            if proposed in self.undecided:
+                self.retry.append(proposed)
+            # A round has been delivered, so a new one may be free.
+            self.delivered += 1
+            self.condition.notify()
+
+        if won is not None:
+            for i, future, submit_time in won:
+                future.round_id = round_id
+                future.set_result(value)
+
+    def run(self):
+        """Propose batches once they are full or old enough and a round is free.
+
+        Return: N/A
+        """
+        while True:
+            with self.condition:
+                while not self.closed and not self.retry and not self.pending and not self.flush_now:
+                    self.condition.wait()
+                if self.closed:
+                    return
+
+                retried = self.retry.popleft() if self.retry else None
+                if retried is not None:
+                    batch = self.undecided[retried]
+                else:
+                    # Wait for the batch to fill up or for the oldest value to time out.
+                    deadline = self.pending[0][2] + self.batch_delay if self.pending else 0
+                    while not self.closed and not self.flush_now and len(self.pending) < self.batch_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+                    if self.closed:
+                        return
+                    batch = [self.pending.popleft() for i in range(min(self.batch_size, len(self.pending)))]
+                delivered = self.delivered
+                self.flush_now = False
+
+            if not self.propose_batch(batch):
+                # No free round, so wait for a round to be delivered before trying again.
+                with self.condition:
+                    if retried is not None:
+                        self.retry.appendleft(retried)
+                    else:
+                        self.pending.extendleft(reversed(batch))
+                    while not self.closed and self.delivered == delivered:
+                        self.condition.wait()
+
+    def propose_batch(self, batch):
+        """Propose a batch in the next round the process has not proposed in.
+
+        Keyword arguments:
+        batch -- list of (value, future, submit time) to propose.
+        Return: True if the batch was proposed.
+        """
+        return self.process.execute(self.propose_in_free_round, batch)
+
+    def propose_in_free_round(self, batch):
+        """Propose a batch if the process has a free round.
+        Runs inside Process.execute, so no message can take the round first.
+
+        Keyword arguments:
+        batch -- list of (value, future, submit time) to propose.
+        Return: True if the batch was proposed.
+        """
+        round_id = self.process.next_free_round()
+        if round_id is None:
+            return False
+        proposed = freeze([value for value, future, submitted in batch])
+        if batch:
+            with self.condition:
+                self.undecided[proposed] = batch
+                self.in_flight[round_id] = proposed
+        self.process.metrics.histogram('batch_size', SIZE_BOUNDS).observe(len(batch))
+        self.process.propose(proposed)
+        return True
+
+    def close(self):
+        """Stop batching and cancel the futures of values not yet proposed, or waiting to be proposed again.
+
+        Return: N/A
+        """
+        with self.condition:
+            self.closed = True
+            pending, self.pending = list(self.pending), collections.deque()
+            for proposed in self.retry:
+                pending.extend(self.undecided.pop(proposed))
+            self.retry = collections.deque()
+            self.condition.notify()
+        for value, future, submitted in pending:
+            future.cancel()
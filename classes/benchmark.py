@@ -0,0 +1,456 @@
+"""Benchmark
+
+Harness that runs a rendezvous Server and a cluster of processes on loopback
+ports inside one program and drives the flooding protocol without user input.
+Each scenario reports decisions per second, p50/p99 decision latency, bytes
+on the wire per round and time to join, so runs can be saved and compared.
+
+Scenarios:
+steady -- processes join one at a time, then propose in every round.
+burst -- every process joins at the same moment, then proposes in every round.
+crash -- like steady, but one process is stopped halfway through the rounds.
+
+run_sharded instead runs nodes that each host many consensus groups on a
+pool of worker processes, and reports the decisions of every group together.
+"""
+
+import socket
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+from .async_process import AsyncProcess
+from .overlay import make_overlay
+from .pipelined_process import PipelinedProcess
+from .process import Process
+from .server import Server
+from .sharding import ShardedNode
+
+ENGINES = {
+    'thread': Process,
+    'async': AsyncProcess,
+    'pipelined': PipelinedProcess,
+}
+SCENARIOS = ('steady', 'burst', 'crash')
+
+
+def free_ports(count, host='127.0.0.1'):
+    """Find ports that are currently free on a host.
+
+    Keyword arguments:
+    count -- number of ports needed.
+    host -- host address the ports are for.
+    Return: list of int port numbers.
+    """
+    sockets = []
+    try:
+        for i in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind((host, 0))
+            sockets.append(s)
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def files_needed(ports, overlay='mesh'):
+    """Estimate the file descriptors a cluster needs when it runs in one program.
+    Every process has an out and an in connection for each neighbour, plus
+    its listening socket and server connection, which the server also holds.
+
+    Keyword arguments:
+    ports -- list of the ports of the processes.
+    overlay -- overlay the processes connect over, one of OVERLAYS or an instance.
+    Return: int number of file descriptors.
+    """
+    overlay = make_overlay(overlay)
+    connections = sum(len(overlay.neighbours(port, ports)) for port in ports)
+    return 2 * connections + 3 * len(ports) + 64
+
+
+def raise_file_limit(needed):
+    """Raise the soft open file limit up to the hard limit if a cluster needs more.
+
+    Keyword arguments:
+    needed -- number of file descriptors needed.
+    Return: N/A
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        limit = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        soft = limit
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        raise OSError(f"{needed} open files are needed but the limit is {soft}")
+
+
+def percentile(samples, fraction):
+    """Get a percentile of samples using the nearest rank.
+
+    Keyword arguments:
+    samples -- list of numbers.
+    fraction -- percentile as a fraction, e.g. 0.99.
+    Return: sample at the percentile, or None if there are no samples.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Cluster:
+    def __init__(self, size, engine='thread', host='127.0.0.1', **process_kwargs):
+        ports = free_ports(size + 1, host)
+        raise_file_limit(files_needed(ports[1:], process_kwargs.get('overlay', 'mesh')))
+        self.host = host
+        self.server = Server(host, ports[0])  # Rendezvous server the processes join through.
+        self.processes = [ENGINES[engine](host, port, **process_kwargs) for port in ports[1:]]
+        self.crashed = set()  # Indexes of processes that have been stopped.
+        self.deliveries = dict()  # Dict of round ID to dict of process index to delivery time.
+        self.condition = threading.Condition()  # Notified whenever a process delivers a round.
+
+    def start(self):
+        """Start the server and every process listening, without joining yet.
+
+        Return: N/A
+        """
+        self.server.start()
+        for index, process in enumerate(self.processes):
+            process.decision_listeners.append(self.listener(index))
+            process.start()
+
+    def stop(self):
+        """Stop every process and the server.
+
+        Return: N/A
+        """
+        for process in self.processes:
+            process.stop()
+        self.server.stop()
+        self.server.wait_for_shutdown(5)
+
+    def listener(self, index):
+        """Create a decision listener that records when a process delivers each round.
+
+        Keyword arguments:
+        index -- index of the process the listener is for.
+        Return: callable given a round ID and decided value.
+        """
+        def on_decision(round_id, value):
+            with self.condition:
+                self.deliveries.setdefault(round_id, dict())[index] = (time.perf_counter(), value)
+                self.condition.notify_all()
+        return on_decision
+
+    def alive(self):
+        """Get the processes that have not been stopped.
+
+        Return: list of (index, process).
+        """
+        return [(i, process) for i, process in enumerate(self.processes) if i not in self.crashed]
+
+    def join(self, burst=False, timeout=30):
+        """Connect every process to the rendezvous server and wait for the overlay to connect.
+
+        Keyword arguments:
+        burst -- flag for if every process joins at once instead of one at a time.
+        timeout -- seconds to wait for the overlay.
+        Return: float seconds taken to join.
+        """
+        start = time.perf_counter()
+        if burst:
+            threads = [threading.Thread(target=process.connect_to_rendezvous, args=(self.host, self.server.port))
+                       for process in self.processes]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.wait_for_mesh(self.processes, timeout)
+        else:
+            for count, process in enumerate(self.processes, 1):
+                process.connect_to_rendezvous(self.host, self.server.port)
+                self.wait_for_mesh(self.processes[:count], timeout)
+        # Processes hold back proposals until they have caught up with their peers.
+        for process in self.processes:
+            if process.wait_for_join(timeout) is None:
+                raise TimeoutError(f"Process {process.port} did not finish joining within {timeout}s")
+        return time.perf_counter() - start
+
+    def wait_for_mesh(self, processes, timeout):
+        """Wait until every process is connected to each of its overlay neighbours in both directions,
+        which is every other process in a full mesh. With a relaying overlay
+        every process also has to know every member, as rounds wait for all of them.
+
+        Keyword arguments:
+        processes -- list of processes that should be connected.
+        timeout -- seconds to wait.
+        Return: N/A
+        """
+        deadline = time.monotonic() + timeout
+        members = {process.port for process in processes}
+        neighbours = [process.overlay.neighbours(process.port, members) for process in processes]
+
+        def connected(process, wanted):
+            if process.overlay.relays and not process.peer_ports >= members - {process.port}:
+                return False
+            return process.peers.ids() >= wanted
+
+        while not all(connected(process, wanted) for process, wanted in zip(processes, neighbours)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{len(processes)} processes did not connect within {timeout}s")
+            # Connections are made on other threads without a completion signal, so poll.
+            time.sleep(0.001)
+
+    def crash(self, index):
+        """Stop a process, which its peers see as a crash.
+
+        Keyword arguments:
+        index -- index of the process to stop.
+        Return: N/A
+        """
+        self.crashed.add(index)
+        self.processes[index].stop()
+
+    def bytes_sent(self):
+        """Total number of bytes every process has sent.
+
+        Return: int bytes.
+        """
+        return sum(process.metrics.counter('bytes_out').value for process in self.processes)
+
+    def propose(self, round_id):
+        """Have every running process propose a value in a round, unless it already has.
+        A round that follows a crash is already proposed in with the carried values.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: N/A
+        """
+        for index, process in self.alive():
+            process.execute(self.propose_in_round, process, round_id, f"{round_id}:{index}")
+
+    def propose_in_round(self, process, round_id, value):
+        """Propose a value if a round is the process's next free round.
+        Runs inside Process.execute, so no message can take the round first.
+
+        Keyword arguments:
+        process -- process to propose through.
+        round_id -- int ID of the round.
+        value -- value to propose.
+        Return: N/A
+        """
+        if process.next_free_round() == round_id:
+            process.propose(value)
+
+    def wait_for_round(self, round_id, timeout):
+        """Wait until every running process has delivered a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        timeout -- seconds to wait.
+        Return: list of (delivery time, value) from every running process.
+        """
+        with self.condition:
+            done = self.condition.wait_for(
+                lambda: all(i in self.deliveries.get(round_id, ()) for i, process in self.alive()), timeout)
+            if not done:
+                raise TimeoutError(f"Round {round_id} was not delivered within {timeout}s")
+            return [self.deliveries[round_id][i] for i, process in self.alive()]
+
+    def run_rounds(self, rounds, window=1, crash_round=None, timeout=10):
+        """Drive rounds through the cluster, keeping up to a window of rounds in flight.
+
+        Keyword arguments:
+        rounds -- number of rounds to run.
+        window -- number of rounds proposed before the oldest has to be delivered.
+        crash_round -- round ID at which one process is stopped, or None.
+        timeout -- seconds to wait for each round.
+        Return: dict of results.
+        """
+        latencies = []
+        decisions = 0
+        proposed_at = dict()
+        bytes_before = self.bytes_sent()
+        start = time.perf_counter()
+
+        for round_id in range(rounds + window - 1):
+            if round_id < rounds:
+                if round_id == crash_round:
+                    self.crash(len(self.processes) - 1)
+                proposed_at[round_id] = time.perf_counter()
+                self.propose(round_id)
+
+            delivered_round_id = round_id - window + 1
+            if delivered_round_id >= 0:
+                delivered = self.wait_for_round(delivered_round_id, timeout)
+                latencies.append(max(t for t, value in delivered) - proposed_at[delivered_round_id])
+                if delivered[0][1] is not None:
+                    decisions += 1
+
+        seconds = time.perf_counter() - start
+        return {
+            'rounds': rounds,
+            'decisions': decisions,
+            'seconds': seconds,
+            'decisions_per_second': decisions / seconds if seconds else None,
+            'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+            'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+            'bytes_per_round': (self.bytes_sent() - bytes_before) / rounds,
+        }
+
+
+def run_scenario(scenario, size, engine='thread', rounds=100, window=4, timeout=10, **process_kwargs):
+    """Run a single scenario on a new cluster.
+
+    Keyword arguments:
+    scenario -- one of SCENARIOS.
+    size -- number of processes.
+    engine -- one of ENGINES.
+    rounds -- number of rounds to run.
+    window -- rounds in flight for the pipelined engine.
+    timeout -- seconds to wait for each round.
+    process_kwargs -- extra arguments for each process, e.g. delta=True.
+    Return: dict of results.
+    """
+    if scenario not in SCENARIOS:
+        raise ValueError(f"Unknown scenario {scenario!r}")
+    if engine == 'pipelined':
+        process_kwargs['window'] = window
+    else:
+        window = 1
+
+    result = {'scenario': scenario, 'engine': engine, 'size': size, **process_kwargs}
+    try:
+        cluster = Cluster(size, engine, **process_kwargs)
+    except OSError as e:
+        result['error'] = str(e)
+        return result
+
+    try:
+        cluster.start()
+        result['join_seconds'] = cluster.join(burst=scenario == 'burst')
+        crash_round = rounds // 2 if scenario == 'crash' else None
+        result.update(cluster.run_rounds(rounds, window, crash_round, timeout))
+        result['metrics'] = cluster.processes[0].metrics.snapshot()
+    except (OSError, TimeoutError) as e:
+        result['error'] = str(e)
+    finally:
+        cluster.stop()
+    return result
+
+
+def run_benchmark(sizes, scenarios=SCENARIOS, engines=('thread',), **kwargs):
+    """Run every combination of scenario, engine and cluster size.
+
+    Keyword arguments:
+    sizes -- list of numbers of processes.
+    scenarios -- list of scenario names.
+    engines -- list of engine names.
+    kwargs -- arguments passed on to run_scenario.
+    Return: list of result dicts.
+    """
+    return [run_scenario(scenario, size, engine, **kwargs)
+            for engine in engines for scenario in scenarios for size in sizes]
+
+
+def run_sharded(size, groups, workers=None, engine='thread', rounds=100, window=4, timeout=10, **process_kwargs):
+    """Run nodes that each host every one of many consensus groups, with every group proposing
+    in its next round as soon as it has delivered the last, so the groups progress independently.
+
+    Keyword arguments:
+    size -- number of nodes.
+    groups -- number of consensus groups.
+    workers -- number of worker processes per node, or None for one per core.
+    engine -- one of ENGINES, which each group runs on.
+    rounds -- number of rounds each group runs.
+    window -- rounds in flight for the pipelined engine.
+    timeout -- seconds to wait for any group to deliver its next round.
+    process_kwargs -- extra arguments for each group's process, e.g. delta=True.
+    Return: dict of results, with decisions counted over every group.
+    """
+    if engine == 'pipelined':
+        process_kwargs['window'] = window
+
+    result = {'scenario': 'sharded', 'engine': engine, 'size': size, 'groups': groups, 'workers': workers,
+              **process_kwargs}
+    ports = free_ports(size + 1)
+    server = Server('127.0.0.1', ports[0])
+    nodes = [ShardedNode('127.0.0.1', port, range(groups), workers, ENGINES[engine], **process_kwargs)
+             for port in ports[1:]]
+    deliveries = dict()  # Dict of (group, round ID) to dict of node index to (delivery time, value).
+    condition = threading.Condition()  # Notified whenever a node delivers a round of a group.
+
+    def listener(index):
+        def on_decision(group, round_id, value):
+            with condition:
+                deliveries.setdefault((group, round_id), dict())[index] = (time.perf_counter(), value)
+                condition.notify_all()
+        return on_decision
+
+    try:
+        server.start()
+        start = time.perf_counter()
+        for index, node in enumerate(nodes):
+            node.decision_listeners.append(listener(index))
+            node.start()
+        result['workers'] = nodes[0].worker_count
+        # Workers start from a fresh interpreter, which would otherwise be counted as joining.
+        for node in nodes:
+            if not node.wait_for_workers(timeout):
+                raise TimeoutError(f"Node {node.port} did not start its workers within {timeout}s")
+        result['spawn_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for node in nodes:
+            node.connect_to_rendezvous('127.0.0.1', server.port)
+        for node in nodes:
+            if not node.wait_for_join(timeout):
+                raise TimeoutError(f"Node {node.port} did not finish joining within {timeout}s")
+        result['join_seconds'] = time.perf_counter() - start
+
+        bytes_before = sum(m['counters'].get('bytes_out', 0) for node in nodes for m in node.metrics().values())
+        start = time.perf_counter()
+        for node in nodes:
+            node.run_rounds(rounds)
+        with condition:
+            while not all(len(deliveries.get((group, rounds - 1), ())) == size for group in range(groups)):
+                if not condition.wait(timeout):
+                    raise TimeoutError(f"No round was delivered within {timeout}s")
+        seconds = time.perf_counter() - start
+
+        # With every group proposing as soon as it delivers, a round lasts from the last delivery of the one before.
+        latencies = []
+        decisions = 0
+        for group in range(groups):
+            delivered_at = start
+            for round_id in range(rounds):
+                delivered = deliveries[(group, round_id)].values()
+                latencies.append(max(t for t, value in delivered) - delivered_at)
+                delivered_at = max(t for t, value in delivered)
+                if next(iter(delivered))[1] is not None:
+                    decisions += 1
+        bytes_after = sum(m['counters'].get('bytes_out', 0) for node in nodes for m in node.metrics().values())
+        result.update({
+            'rounds': rounds,
+            'decisions': decisions,
+            'seconds': seconds,
+            'decisions_per_second': decisions / seconds if seconds else None,
+            'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+            'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+            'bytes_per_round': (bytes_after - bytes_before) / (rounds * groups),
+        })
+    except (OSError, TimeoutError, ConnectionError) as e:
+        result['error'] = str(e)
+    finally:
+        for node in nodes:
+            node.stop()
+        server.stop()
+        server.wait_for_shutdown(5)
+    return result
@@ -0,0 +1,366 @@
+"""Codec
+
+Encodings for the messages carried in frames. Every frame payload says how it
+is encoded, so each side of a connection can send with its own codec and a
+payload is always decoded correctly:
+
+JsonCodec -- JSON text, which every process and the server understand. A JSON
+             payload starts with '{', so it needs no tag and is compatible
+             with processes that predate codecs.
+BinaryCodec -- a tag byte and a compact binary encoding. Ints are zigzag
+               varints, and lists of only ints, only strings or only rows of
+               strings are packed as typed arrays, so large proposal sets take
+               less space and are decoded without parsing text. Tuples stay
+               tuples. Offered as 'binary', and as 'binary-zlib' with payloads
+               above a size threshold zlib compressed when that helps, which
+               trades CPU for bandwidth.
+
+A process offers its codecs in preference order in its hello, and each side
+sends with the first of its own codecs the other side offered, falling back
+to JSON.
+"""
+
+import itertools
+import json
+import struct
+import zlib
+
+from .framing import FrameError
+
+COMPRESS_THRESHOLD = 1024  # Bytes of binary payload above which binary-zlib tries compression.
+COMPRESS_LEVEL = 1         # zlib level, as speed matters more than ratio on a LAN.
+
+# Payload tags. A JSON payload starts with '{' instead of a tag.
+BINARY_TAG = 0x01       # Binary encoding.
+BINARY_ZLIB_TAG = 0x02  # zlib compressed binary encoding.
+
+# Value tags of the binary encoding.
+NONE = 0x00
+TRUE = 0x01
+FALSE = 0x02
+INT = 0x03        # Zigzag varint.
+FLOAT = 0x04      # 8 byte IEEE 754 double.
+STR = 0x05        # Varint length and UTF-8 bytes.
+LIST = 0x06       # Varint count and tagged items.
+TUPLE = 0x07      # Varint count and tagged items.
+DICT = 0x08       # Varint count and tagged key, value pairs.
+INT_ARRAY = 0x09  # Varint count, a container tag and packed 8 byte ints.
+STR_ARRAY = 0x0A  # Varint count, a container tag, varint length and the UTF-8 bytes of the joined strings.
+STR_TABLE = 0x0B  # Varint count, container tags of the table and its rows, varint length and the UTF-8
+                  # bytes of the joined rows, each of them joined strings.
+
+SEPARATOR = '\x00'      # Joins the strings of an array or row, which is only used if none of them contain it.
+ROW_SEPARATOR = '\x01'  # Joins the rows of a table.
+
+FLOAT_FORMAT = struct.Struct('!d')
+INT64_MIN = -1 << 63
+INT64_MAX = (1 << 63) - 1
+
+
+class CodecError(FrameError):
+    """Raised when a payload cannot be decoded."""
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, data):
+        """Encode a message as JSON text.
+
+        Keyword arguments:
+        data -- dict message.
+        Return: bytes payload.
+        """
+        return json.dumps(data).encode('utf-8')
+
+
+class BinaryCodec:
+    def __init__(self, name='binary', compress_threshold=None, compress_level=COMPRESS_LEVEL):
+        self.name = name  # Name the codec is offered by.
+        self.compress_threshold = compress_threshold  # Bytes above which compression is tried, or None for never.
+        self.compress_level = compress_level
+
+    def encode(self, data):
+        """Encode a message in the binary encoding, compressing it if it is large.
+
+        Keyword arguments:
+        data -- dict message.
+        Return: bytes payload.
+        """
+        out = bytearray([BINARY_TAG])
+        write_value(out, data)
+        if self.compress_threshold is not None and len(out) > self.compress_threshold:
+            compressed = zlib.compress(memoryview(out)[1:], self.compress_level)
+            if len(compressed) + 1 < len(out):
+                return bytes([BINARY_ZLIB_TAG]) + compressed
+        return bytes(out)
+
+
+CODECS = {
+    'json': JsonCodec(),
+    'binary': BinaryCodec(),
+    'binary-zlib': BinaryCodec('binary-zlib', COMPRESS_THRESHOLD),
+}
+JSON = CODECS['json']
+DEFAULT_CODECS = ('binary', 'json')  # Codecs offered by default, most preferred first.
+
+
+def decode_payload(payload):
+    """Decode a frame payload with the codec it says it was encoded with.
+
+    Keyword arguments:
+    payload -- bytes payload of a single frame.
+    Return: decoded dict message.
+    """
+    if not payload:
+        raise CodecError("Empty payload.")
+    tag = payload[0]
+    try:
+        if tag == BINARY_TAG:
+            message = read_message(memoryview(payload)[1:])
+        elif tag == BINARY_ZLIB_TAG:
+            message = read_message(memoryview(zlib.decompress(memoryview(payload)[1:])))
+        else:
+            message = json.loads(payload)
+    except (ValueError, IndexError, struct.error, zlib.error, RecursionError) as e:
+        raise CodecError(f"Could not decode payload: {e!r}") from e
+    # Handlers look messages up by key, so any other value is as unusable as a corrupt one.
+    if not isinstance(message, dict):
+        raise CodecError(f"Payload decodes to {type(message).__name__}, not a dict message.")
+    return message
+
+
+def read_message(data):
+    """Decode a whole payload in the binary encoding.
+
+    Keyword arguments:
+    data -- bytes-like payload without its codec tag.
+    Return: decoded value.
+    """
+    value, offset = read_value(data, 0)
+    if offset != len(data):
+        raise CodecError(f"{len(data) - offset} trailing bytes after payload.")
+    return value
+
+
+def negotiate(preferred, offered):
+    """Pick the codec to send with on a connection.
+
+    Keyword arguments:
+    preferred -- list of codec names this side supports, most preferred first.
+    offered -- list of codec names the other side offered, or None if it offered none.
+    Return: codec instance.
+    """
+    for name in preferred:
+        if offered and name in offered and name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def write_varint(out, value):
+    """Append an unsigned int as a varint, 7 bits per byte.
+
+    Keyword arguments:
+    out -- bytearray to append to.
+    value -- non-negative int.
+    Return: N/A
+    """
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    """Read an unsigned varint.
+
+    Keyword arguments:
+    data -- bytes-like buffer.
+    offset -- int offset of the varint.
+    Return: tuple of int value and the offset after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def write_value(out, value):
+    """Append a tagged value in the binary encoding.
+
+    Keyword arguments:
+    out -- bytearray to append to.
+    value -- None, bool, int, float, str, list, tuple or dict of those.
+    Return: N/A
+    """
+    kind = type(value)
+    if kind is str:
+        encoded = value.encode('utf-8')
+        out.append(STR)
+        write_varint(out, len(encoded))
+        out += encoded
+    elif kind is int:
+        out.append(INT)
+        # Zigzag encoding keeps small negative ints short.
+        write_varint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif kind is list or kind is tuple:
+        write_sequence(out, value, kind is tuple)
+    elif kind is dict:
+        out.append(DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            write_value(out, key)
+            write_value(out, item)
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif kind is float:
+        out.append(FLOAT)
+        out += FLOAT_FORMAT.pack(value)
+    else:
+        raise TypeError(f"Cannot encode {kind.__name__} value {value!r}")
+
+
+def write_sequence(out, values, is_tuple):
+    """Append a list or tuple, as a typed array if every item is an int or every item is a str.
+
+    Keyword arguments:
+    out -- bytearray to append to.
+    values -- list or tuple.
+    is_tuple -- flag for if the values are decoded as a tuple.
+    Return: N/A
+    """
+    kinds = set(map(type, values))
+    if (kinds == {tuple} or kinds == {list}) and write_table(out, values, is_tuple, kinds == {tuple}):
+        return
+    if kinds == {str}:
+        # Joining and splitting on a separator keeps both ends of a large array out of Python loops.
+        joined = SEPARATOR.join(values)
+        if joined.count(SEPARATOR) == len(values) - 1:
+            encoded = joined.encode('utf-8')
+            out.append(STR_ARRAY)
+            write_varint(out, len(values))
+            out.append(TUPLE if is_tuple else LIST)
+            write_varint(out, len(encoded))
+            out += encoded
+            return
+    if kinds == {int} and INT64_MIN <= min(values) and max(values) <= INT64_MAX:
+        out.append(INT_ARRAY)
+        write_varint(out, len(values))
+        out.append(TUPLE if is_tuple else LIST)
+        out += struct.pack(f'!{len(values)}q', *values)
+        return
+    out.append(TUPLE if is_tuple else LIST)
+    write_varint(out, len(values))
+    for value in values:
+        write_value(out, value)
+
+
+def write_table(out, rows, is_tuple, rows_are_tuples):
+    """Append a list or tuple of non-empty rows of strings as a string table, e.g. a proposal set of batches.
+
+    Keyword arguments:
+    out -- bytearray to append to.
+    rows -- list or tuple of rows, which are all tuples or all lists.
+    is_tuple -- flag for if the rows are decoded as a tuple.
+    rows_are_tuples -- flag for if each row is decoded as a tuple.
+    Return: True if the rows were appended, False if they are not a table of strings.
+    """
+    if min(map(len, rows)) == 0 or set(map(type, itertools.chain.from_iterable(rows))) != {str}:
+        return False
+    joined = ROW_SEPARATOR.join([SEPARATOR.join(row) for row in rows])
+    if (joined.count(ROW_SEPARATOR) != len(rows) - 1
+            or joined.count(SEPARATOR) != sum(map(len, rows)) - len(rows)):
+        return False
+    encoded = joined.encode('utf-8')
+    out.append(STR_TABLE)
+    write_varint(out, len(rows))
+    out.append(TUPLE if is_tuple else LIST)
+    out.append(TUPLE if rows_are_tuples else LIST)
+    write_varint(out, len(encoded))
+    out += encoded
+    return True
+
+
+def read_value(data, offset):
+    """Read a tagged value in the binary encoding.
+
+    Keyword arguments:
+    data -- bytes-like buffer.
+    offset -- int offset of the value's tag.
+    Return: tuple of the value and the offset after it.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag == STR:
+        length, offset = read_varint(data, offset)
+        end = offset + length
+        if end > len(data):
+            raise ValueError("String runs past the end of the payload.")
+        return str(data[offset:end], 'utf-8'), end
+    if tag == INT:
+        value, offset = read_varint(data, offset)
+        return (value >> 1) ^ -(value & 1), offset
+    if tag == LIST or tag == TUPLE:
+        count, offset = read_varint(data, offset)
+        values = []
+        for i in range(count):
+            value, offset = read_value(data, offset)
+            values.append(value)
+        return (tuple(values) if tag == TUPLE else values), offset
+    if tag == DICT:
+        count, offset = read_varint(data, offset)
+        value = dict()
+        for i in range(count):
+            key, offset = read_value(data, offset)
+            value[key], offset = read_value(data, offset)
+        return value, offset
+    if tag == STR_ARRAY:
+        count, offset = read_varint(data, offset)
+        container = data[offset]
+        length, offset = read_varint(data, offset + 1)
+        end = offset + length
+        if end > len(data):
+            raise ValueError("String array runs past the end of the payload.")
+        values = str(data[offset:end], 'utf-8').split(SEPARATOR) if count else []
+        if len(values) != count:
+            raise ValueError(f"String array has {len(values)} strings instead of {count}.")
+        return (tuple(values) if container == TUPLE else values), end
+    if tag == STR_TABLE:
+        count, offset = read_varint(data, offset)
+        container = data[offset]
+        row_container = data[offset + 1]
+        length, offset = read_varint(data, offset + 2)
+        end = offset + length
+        if end > len(data):
+            raise ValueError("String table runs past the end of the payload.")
+        rows = str(data[offset:end], 'utf-8').split(ROW_SEPARATOR)
+        if len(rows) != count:
+            raise ValueError(f"String table has {len(rows)} rows instead of {count}.")
+        if row_container == TUPLE:
+            values = [tuple(row.split(SEPARATOR)) for row in rows]
+        else:
+            values = [row.split(SEPARATOR) for row in rows]
+        return (tuple(values) if container == TUPLE else values), end
+    if tag == INT_ARRAY:
+        count, offset = read_varint(data, offset)
+        container = data[offset]
+        values = struct.unpack_from(f'!{count}q', data, offset + 1)
+        return (values if container == TUPLE else list(values)), offset + 1 + 8 * count
+    if tag == NONE:
+        return None, offset
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+    if tag == FLOAT:
+        return FLOAT_FORMAT.unpack_from(data, offset)[0], offset + FLOAT_FORMAT.size
+    raise ValueError(f"Unknown value tag {tag:#x}")
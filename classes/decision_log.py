@@ -0,0 +1,371 @@
+"""DecisionLog
+
+Append-only on-disk log of the proposals a process has seen and the outcome
+of every round it has delivered, so a restarted process resumes from the
+round it reached instead of round 0. Each record is a payload length, a
+CRC32 of the payload and the JSON payload, so a record torn by a crash is
+detected and cut off on recovery. Records are written by a single writer
+thread that fsyncs once per batch of whatever has queued up meanwhile
+(group commit), so appending never waits on the disk. Callers that must not
+act before a record is on disk register a callback, which the writer runs
+once the record's batch is fsynced.
+
+Every snapshot_interval rounds the writer saves the state the log describes
+as a snapshot, starts a new log segment and deletes the old ones, so the log
+does not grow forever. The snapshot only keeps the proposals no round has
+decided yet, the retained rounds and the next round to run. Recovery loads the snapshot and replays only the
+segment written since, reading it through mmap.
+"""
+
+import collections
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from .metrics import SIZE_BOUNDS
+from .proposal_set import freeze
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct('!II')  # Payload length and CRC32 of the payload.
+SNAPSHOT_INTERVAL = 1024  # Rounds logged between snapshots.
+SNAPSHOT_FILE = 'snapshot'
+SEGMENT_SUFFIX = '.log'
+
+# State described by a log: every proposed value no round has decided, the last retained rounds as
+# (round ID, decided value or None) in round order, and the next round to run.
+RecoveredState = collections.namedtuple('RecoveredState', ['proposals', 'rounds', 'next_round_id'])
+
+
+def encode_record(record):
+    """Encode a dict record with its length and checksum.
+
+    Keyword arguments:
+    record -- dict to be encoded.
+    Return: bytes of the complete record.
+    """
+    payload = json.dumps(record).encode('utf-8')
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data):
+    """Decode records from the start of a buffer up to the first incomplete or corrupt one.
+
+    Keyword arguments:
+    data -- bytes-like buffer, e.g. an mmap of a log segment.
+    Return: tuple of list of dict records and int length of the valid prefix.
+    """
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(data):
+            break
+        payload = data[offset + RECORD_HEADER.size:end]
+        if zlib.crc32(payload) != checksum:
+            break
+        records.append(json.loads(payload))
+        offset = end
+    return records, offset
+
+
+class DecisionLog:
+    def __init__(self, path, retention=128, snapshot_interval=SNAPSHOT_INTERVAL, fsync=True, metrics=None):
+        self.path = path  # Directory holding the snapshot and log segments.
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync  # Flag for if batches are fsynced, which only tests and benchmarks turn off.
+        self.metrics = metrics  # Optional Metrics to record fsync times and batch sizes in.
+
+        # State the log describes, kept up to date by the writer so snapshots match the segments exactly.
+        self.proposals = dict()  # Dict of hashable value to each value no round has decided, in the order logged.
+        self.rounds = collections.deque(maxlen=retention)  # (round ID, value) of the last retained rounds.
+        self.next_round_id = 0
+        self.rounds_since_snapshot = 0
+
+        self.segment_id = 0  # ID of the segment being appended to, which is also its file name.
+        self.file = None
+        self.queue = queue.Queue()  # Records waiting to be written, then None to stop.
+        self.thread = None
+        self.condition = threading.Condition()  # Notified whenever a batch becomes durable.
+        self.appended = 0  # Number of records appended.
+        self.durable = 0   # Number of records written and fsynced.
+        self.callbacks = collections.deque()  # (sequence number, callable, args) waiting for their record to be durable.
+
+    def segment_path(self, segment_id):
+        """Get the file a segment is stored in.
+
+        Keyword arguments:
+        segment_id -- int ID of the segment.
+        Return: str path.
+        """
+        return os.path.join(self.path, f"{segment_id:020d}{SEGMENT_SUFFIX}")
+
+    def segment_ids(self):
+        """Get the IDs of the segments on disk.
+
+        Return: sorted list of int segment IDs.
+        """
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def recover(self):
+        """Rebuild the state the log describes, then open it for appending.
+        A torn record at the end of the log, left by a crash during a write,
+        is cut off.
+
+        Return: RecoveredState.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        start = time.perf_counter()
+
+        snapshot_path = os.path.join(self.path, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, 'rb') as f:
+                records, length = decode_records(f.read())
+            if not records:
+                raise ValueError(f"Snapshot {snapshot_path} is corrupt")
+            snapshot = records[0]
+            self.apply({'proposals': snapshot['proposals']})
+            self.rounds.extend(tuple(entry) for entry in snapshot['rounds'])
+            self.next_round_id = snapshot['next_round_id']
+            self.segment_id = snapshot['segment']
+
+        # Segments from before the snapshot are left over from a compaction cut short by a crash.
+        self.remove_segments(self.segment_id)
+
+        replayed = 0
+        segment_ids = self.segment_ids()
+        for index, segment_id in enumerate(segment_ids):
+            segment_path = self.segment_path(segment_id)
+            size = os.path.getsize(segment_path)
+            if size == 0:
+                records, length = [], 0
+            else:
+                with open(segment_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    records, length = decode_records(data)
+            for record in records:
+                self.apply(record)
+            replayed += len(records)
+            self.segment_id = segment_id
+
+            if length < size:
+                # Nothing after a torn or corrupt record can be trusted.
+                logger.warning("Truncating log segment %s at byte %d of %d", segment_path, length, size)
+                with open(segment_path, 'r+b') as f:
+                    f.truncate(length)
+                for later_segment_id in segment_ids[index + 1:]:
+                    os.remove(self.segment_path(later_segment_id))
+                break
+
+        self.file = open(self.segment_path(self.segment_id), 'ab')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        logger.info("Recovered %d rounds and %d proposals from %s in %.3fs, replaying %d records",
+                    self.next_round_id, len(self.proposals), self.path, time.perf_counter() - start, replayed)
+        return RecoveredState(list(self.proposals.values()), list(self.rounds), self.next_round_id)
+
+    def apply(self, record):
+        """Update the state the log describes with a record.
+
+        Keyword arguments:
+        record -- dict record.
+        Return: N/A
+        """
+        if 'proposals' in record:
+            for value in record['proposals']:
+                self.proposals.setdefault(freeze(value), value)
+        elif 'round' in record:
+            round_id, value = record['round']
+            if value is not None:
+                # A decided value is kept with its round, so recovery does not need it as a proposal.
+                self.proposals.pop(freeze(value), None)
+            self.rounds.append((round_id, value))
+            self.next_round_id = round_id + 1
+            self.rounds_since_snapshot += 1
+
+    def append_proposals(self, values):
+        """Log values added to the proposal set.
+
+        Keyword arguments:
+        values -- list of new proposed values.
+        Return: int sequence number of the record.
+        """
+        return self.append({'proposals': values})
+
+    def append_round(self, round_id, value):
+        """Log the outcome of a delivered round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        value -- decided value, or None if the round ended because of a crash.
+        Return: int sequence number of the record.
+        """
+        return self.append({'round': (round_id, value)})
+
+    def append(self, record):
+        """Queue a record to be written without waiting for the disk.
+
+        Keyword arguments:
+        record -- dict record.
+        Return: int sequence number of the record, which sync() can wait on.
+        """
+        with self.condition:
+            self.appended += 1
+            self.queue.put(record)
+            return self.appended
+
+    def sync(self, sequence=None, timeout=None):
+        """Block until a record, by default the last one appended, is durable.
+
+        Keyword arguments:
+        sequence -- sequence number returned by append.
+        timeout -- optional seconds to wait for.
+        Return: True if the record is durable.
+        """
+        with self.condition:
+            if sequence is None:
+                sequence = self.appended
+            return self.condition.wait_for(lambda: self.durable >= sequence, timeout)
+
+    def when_durable(self, sequence, callback, *args):
+        """Run a callback once a record is durable, without waiting for it.
+        Callbacks run one at a time in the order of their records, on the writer
+        thread, or straight away if the record is already durable, so they should
+        only hand work off, e.g. to an actor.
+
+        Keyword arguments:
+        sequence -- sequence number returned by append.
+        callback -- callable to run.
+        args -- arguments for callback.
+        Return: N/A
+        """
+        with self.condition:
+            if self.durable >= sequence and not self.callbacks:
+                callback(*args)
+            else:
+                self.callbacks.append((sequence, callback, args))
+
+    def close(self):
+        """Write every queued record, then stop the writer.
+
+        Return: N/A
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+
+    def run(self):
+        """Write queued records in batches, with one fsync per batch.
+
+        Return: N/A
+        """
+        while True:
+            records = [self.queue.get()]
+            while True:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            records = [record for record in records if record is not None]
+
+            if records:
+                self.write(records)
+            if self.rounds_since_snapshot >= self.snapshot_interval:
+                self.compact()
+            if stop:
+                return
+
+    def write(self, records):
+        """Write and fsync a batch of records.
+
+        Keyword arguments:
+        records -- list of dict records.
+        Return: N/A
+        """
+        self.file.write(b''.join(encode_record(record) for record in records))
+        self.file.flush()
+        if self.fsync:
+            fsync_start = time.perf_counter()
+            os.fsync(self.file.fileno())
+            if self.metrics is not None:
+                self.metrics.histogram('log.fsync').observe(time.perf_counter() - fsync_start)
+        if self.metrics is not None:
+            self.metrics.histogram('log.batch_records', SIZE_BOUNDS).observe(len(records))
+
+        for record in records:
+            self.apply(record)
+        with self.condition:
+            self.durable += len(records)
+            self.condition.notify_all()
+            while self.callbacks and self.callbacks[0][0] <= self.durable:
+                sequence, callback, args = self.callbacks.popleft()
+                callback(*args)
+
+    def compact(self):
+        """Save the current state as a snapshot, then replace the log with an empty segment.
+
+        Return: N/A
+        """
+        start = time.perf_counter()
+        segment_id = self.segment_id + 1
+        snapshot = {
+            'segment': segment_id,
+            'next_round_id': self.next_round_id,
+            'rounds': list(self.rounds),
+            'proposals': list(self.proposals.values()),
+        }
+
+        # Replace the snapshot atomically, so a crash leaves either the old or the new one.
+        snapshot_path = os.path.join(self.path, SNAPSHOT_FILE)
+        with open(snapshot_path + '.tmp', 'wb') as f:
+            f.write(encode_record(snapshot))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+
+        self.file.close()
+        self.segment_id = segment_id
+        self.file = open(self.segment_path(segment_id), 'ab')
+        # The old segments are only deleted once the snapshot replacing them is on disk.
+        self.sync_directory()
+        self.remove_segments(segment_id)
+        self.rounds_since_snapshot = 0
+        logger.info("Saved log snapshot at round %s in %.3fs", self.next_round_id, time.perf_counter() - start)
+
+    def remove_segments(self, segment_id):
+        """Delete the segments before a segment.
+
+        Keyword arguments:
+        segment_id -- ID of the first segment to keep.
+        Return: N/A
+        """
+        for old_segment_id in self.segment_ids():
+            if old_segment_id < segment_id:
+                os.remove(self.segment_path(old_segment_id))
+
+    def sync_directory(self):
+        """Fsync the log directory, so renamed and created files survive a crash.
+
+        Return: N/A
+        """
+        if not self.fsync or not hasattr(os, 'O_DIRECTORY'):
+            # Directories cannot be opened for fsync on Windows.
+            return
+        fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,117 @@
+"""Dialer
+
+Opens connections to many peers at once for a joining process. At most a
+bounded number of dials are in flight, each attempt has its own timeout, and
+a failed attempt is retried with exponential backoff, so one unreachable peer
+neither blocks nor delays connecting to the others. The outcome of a join is
+reported as a JoinResult listing the peers that were reached and those that
+were not.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = 32   # Dials open at once.
+DIAL_TIMEOUT = 2.0   # Seconds a single connection attempt may take.
+DIAL_RETRIES = 4     # Attempts after the first before a peer is reported unreachable.
+BACKOFF = 0.05       # Seconds before the first retry, doubling after each failure.
+MAX_BACKOFF = 2.0    # Longest wait between two attempts.
+
+# Ports of the peers that were connected to and that could not be, and the seconds the join took.
+JoinResult = collections.namedtuple('JoinResult', ['reached', 'unreachable', 'seconds'])
+
+
+def backoff_delay(attempt, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    """Get the wait before retrying a failed attempt.
+    Jitter keeps peers that failed together from retrying together.
+
+    Keyword arguments:
+    attempt -- number of attempts that have failed.
+    backoff -- seconds before the first retry.
+    max_backoff -- longest wait.
+    Return: float seconds.
+    """
+    return min(max_backoff, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class Dialer:
+    def __init__(self, connect, stopped, max_in_flight=MAX_IN_FLIGHT, timeout=DIAL_TIMEOUT,
+                 retries=DIAL_RETRIES, backoff=BACKOFF):
+        self.connect = connect        # Callable given a host, port and timeout that opens a connection.
+        self.stopped = stopped        # Event set once the process has stopped, which ends every dial.
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def dial_all(self, host, ports):
+        """Dial every port concurrently without blocking the caller.
+
+        Keyword arguments:
+        host -- host address of the peers.
+        ports -- list of int port numbers to dial.
+        Return: Future that resolves to a JoinResult.
+        """
+        result = concurrent.futures.Future()
+        start = time.perf_counter()
+        if not ports:
+            result.set_result(JoinResult([], [], 0.0))
+            return result
+
+        reached, unreachable = [], []
+        remaining = [len(ports)]
+        lock = threading.Lock()
+
+        def dialed(future, port):
+            with lock:
+                (reached if future.exception() is None and future.result() else unreachable).append(port)
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                result.set_result(JoinResult(sorted(reached), sorted(unreachable), time.perf_counter() - start))
+
+        def submit_dials():
+            # The workers exit once every dial is done, so idle processes keep no dialing threads.
+            executor = concurrent.futures.ThreadPoolExecutor(min(self.max_in_flight, len(ports)), 'dialer')
+            for port in ports:
+                try:
+                    future = executor.submit(self.dial, host, port)
+                except RuntimeError as e:
+                    # The interpreter is shutting down.
+                    future = concurrent.futures.Future()
+                    future.set_exception(e)
+                future.add_done_callback(lambda future, port=port: dialed(future, port))
+            executor.shutdown(wait=False)
+
+        # Submitting starts the workers, which would hold up a caller that has other events to handle.
+        threading.Thread(target=submit_dials, name='dialer', daemon=True).start()
+        return result
+
+    def dial(self, host, port):
+        """Dial a port, retrying with exponential backoff.
+
+        Keyword arguments:
+        host -- host address of the peer.
+        port -- int port number of the peer.
+        Return: True if a connection was opened.
+        """
+        for attempt in range(self.retries + 1):
+            if self.stopped.is_set():
+                return False
+            if attempt:
+                # Wait before retrying, waking early if the process stops.
+                if self.stopped.wait(backoff_delay(attempt, self.backoff)):
+                    return False
+            try:
+                self.connect(host, port, self.timeout)
+                return True
+            except OSError as e:
+                logger.debug("Attempt %d to connect to %s:%s failed: %s", attempt + 1, host, port, e)
+        logger.warning("Could not connect to %s:%s after %d attempts", host, port, self.retries + 1)
+        return False
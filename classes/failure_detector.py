@@ -0,0 +1,168 @@
+"""FailureDetector
+
+Suspects peers that have crashed, hung or been partitioned away from how long
+they have been silent. Every message received from a peer counts as a
+heartbeat, and a process only sends an explicit heartbeat to a peer it has
+sent nothing else to for a heartbeat interval, so heartbeats ride on the
+protocol's own traffic. Detectors share one interface, so either can be used:
+
+TimeoutDetector -- suspects a peer once it has been silent for a fixed timeout.
+PhiAccrualDetector -- suspects a peer once its silence is unlikely given the
+                      intervals between its past heartbeats.
+"""
+
+import collections
+import math
+import threading
+import time
+
+HEARTBEAT_INTERVAL = 0.1  # Seconds without sending to a peer before a heartbeat is sent.
+SUSPECT_TIMEOUT = 1.0     # Seconds a peer may be silent before the timeout detector suspects it.
+PHI_THRESHOLD = 8.0       # Suspicion level, about a 1e-8 chance of a false suspicion.
+PHI_WINDOW = 100          # Heartbeat intervals remembered per peer.
+MIN_STD_DEVIATION = 0.1   # Seconds, so bursts of traffic do not make every short pause suspicious.
+ACCEPTABLE_PAUSE = 0.5    # Seconds of extra silence tolerated, e.g. for scheduling delays.
+
+
+class TimeoutDetector:
+    def __init__(self, timeout=SUSPECT_TIMEOUT):
+        self.timeout = timeout
+        self.last_heard = dict()  # Dict of peer ID to the time a message was last received from it.
+        self.lock = threading.Lock()
+
+    def heartbeat(self, peer_id, now=None):
+        """Record that a message was received from a peer.
+
+        Keyword arguments:
+        peer_id -- ID of the peer.
+        now -- optional time.monotonic() time of the message.
+        Return: N/A
+        """
+        self.last_heard[peer_id] = time.monotonic() if now is None else now
+
+    def remove(self, peer_id):
+        """Stop monitoring a peer.
+
+        Keyword arguments:
+        peer_id -- ID of the peer.
+        Return: N/A
+        """
+        with self.lock:
+            self.last_heard.pop(peer_id, None)
+
+    def suspects(self, now=None):
+        """Get the peers that have been silent for longer than the timeout.
+
+        Keyword arguments:
+        now -- optional time.monotonic() time to check at.
+        Return: list of peer IDs.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return [peer_id for peer_id, heard in list(self.last_heard.items()) if now - heard > self.timeout]
+
+
+class PhiAccrualDetector:
+    """Phi accrual failure detector (Hayashibara et al.), as used by Cassandra and Akka.
+    Phi is -log10 of the probability that a peer's next heartbeat arrives
+    later than now, assuming normally distributed heartbeat intervals.
+    """
+
+    def __init__(self, threshold=PHI_THRESHOLD, window=PHI_WINDOW, min_std_deviation=MIN_STD_DEVIATION,
+                 acceptable_pause=ACCEPTABLE_PAUSE, first_interval=HEARTBEAT_INTERVAL):
+        self.threshold = threshold
+        self.window = window
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval  # Interval assumed before a peer's first heartbeat interval is seen.
+        self.last_heard = dict()  # Dict of peer ID to the time a message was last received from it.
+        self.intervals = dict()   # Dict of peer ID to a deque of its last window heartbeat intervals.
+        self.lock = threading.Lock()
+
+    def heartbeat(self, peer_id, now=None):
+        """Record that a message was received from a peer.
+
+        Keyword arguments:
+        peer_id -- ID of the peer.
+        now -- optional time.monotonic() time of the message.
+        Return: N/A
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.last_heard.get(peer_id)
+            self.last_heard[peer_id] = now
+            if last is None:
+                # Seed the history so a peer that goes silent straight away is still suspected.
+                self.intervals[peer_id] = collections.deque([self.first_interval], self.window)
+            else:
+                self.intervals[peer_id].append(now - last)
+
+    def remove(self, peer_id):
+        """Stop monitoring a peer.
+
+        Keyword arguments:
+        peer_id -- ID of the peer.
+        Return: N/A
+        """
+        with self.lock:
+            self.last_heard.pop(peer_id, None)
+            self.intervals.pop(peer_id, None)
+
+    def phi(self, peer_id, now=None):
+        """Get the suspicion level of a peer.
+
+        Keyword arguments:
+        peer_id -- ID of the peer.
+        now -- optional time.monotonic() time to check at.
+        Return: float phi, or 0.0 if the peer is not monitored.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.last_heard.get(peer_id)
+            if last is None:
+                return 0.0
+            intervals = list(self.intervals[peer_id])
+
+        mean = sum(intervals) / len(intervals)
+        variance = sum((interval - mean) ** 2 for interval in intervals) / len(intervals)
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+
+        # Logistic approximation of the normal distribution's tail, P = 1 / (1 + e^-x),
+        # with phi = -log10(P) rearranged so that neither long nor short silences overflow.
+        y = (now - last - mean - self.acceptable_pause) / std_deviation
+        x = -y * (1.5976 + 0.070566 * y * y)
+        if x < 0:
+            return (math.log1p(math.exp(x)) - x) / math.log(10)
+        return math.log1p(math.exp(-x)) / math.log(10)
+
+    def suspects(self, now=None):
+        """Get the peers whose suspicion level has reached the threshold.
+
+        Keyword arguments:
+        now -- optional time.monotonic() time to check at.
+        Return: list of peer IDs.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            peer_ids = list(self.last_heard)
+        return [peer_id for peer_id in peer_ids if self.phi(peer_id, now) >= self.threshold]
+
+
+FAILURE_DETECTORS = {
+    'timeout': TimeoutDetector,
+    'phi': PhiAccrualDetector,
+}
+
+
+def make_failure_detector(detector):
+    """Create a failure detector from its name.
+
+    Keyword arguments:
+    detector -- one of FAILURE_DETECTORS, a detector instance, or None for no failure detection.
+    Return: detector, or None.
+    """
+    if isinstance(detector, str):
+        if detector not in FAILURE_DETECTORS:
+            raise ValueError(f"Unknown failure detector {detector!r}")
+        return FAILURE_DETECTORS[detector]()
+    return detector
@@ -0,0 +1,114 @@
+"""Framing
+
+Length-prefixed framing used on every connection between processes and the
+rendezvous server. Each frame is a 4 byte big-endian payload length followed
+by the payload itself, so a message can never be confused by the characters
+it contains or by how TCP happens to split or coalesce reads.
+"""
+
+import struct
+
+HEADER = struct.Struct('!I')  # Payload length header.
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # Largest payload accepted from a peer.
+
+
+class FrameError(Exception):
+    """Raised when a peer sends a frame that cannot be decoded."""
+
+
+def encode_frame(payload):
+    """Prefix a payload with its length.
+
+    Keyword arguments:
+    payload -- bytes to be framed.
+    Return: bytes of the complete frame.
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """Per-connection receive buffer that decodes complete frames incrementally.
+
+    Bytes are received straight into a reusable bytearray, and only the
+    unread tail is moved back to the front once a read has been consumed,
+    so large messages and bursts of small ones are handled in linear time.
+    """
+
+    def __init__(self, buffer_size=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Offset of the first unread byte.
+        self.end = 0    # Offset after the last received byte.
+        self.max_frame_size = max_frame_size
+
+    def reserve(self, size):
+        """Make room for at least size more bytes after the unread data.
+
+        Keyword arguments:
+        size -- number of free bytes needed at the end of the buffer.
+        Return: N/A
+        """
+        if len(self.buffer) - self.end >= size:
+            return
+
+        # Move the unread tail to the front before growing the buffer.
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        if len(self.buffer) - self.end < size:
+            self.view.release()
+            self.buffer.extend(bytes(max(size, len(self.buffer))))
+            self.view = memoryview(self.buffer)
+
+    def recv(self, connection, size=65536):
+        """Receive data from a socket directly into the buffer.
+
+        Keyword arguments:
+        connection -- socket to receive from.
+        size -- maximum number of bytes to read at once.
+        Return: list of complete frame payloads, or None if the peer closed.
+        """
+        self.reserve(size)
+        received = connection.recv_into(self.view[self.end:], size)
+        if not received:
+            return None
+        self.end += received
+        return self.frames()
+
+    def feed(self, data):
+        """Append already received bytes to the buffer.
+
+        Keyword arguments:
+        data -- bytes received from the peer.
+        Return: list of complete frame payloads.
+        """
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.frames()
+
+    def frames(self):
+        """Pop every complete frame currently in the buffer.
+
+        Return: list of frame payloads as bytes.
+        """
+        frames = []
+        while self.end - self.start >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}.")
+
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                # Make sure the rest of a large frame fits on the next read.
+                self.reserve(frame_end - self.end)
+                break
+
+            frames.append(bytes(self.view[self.start + HEADER.size:frame_end]))
+            self.start = frame_end
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
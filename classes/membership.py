@@ -0,0 +1,65 @@
+"""Membership
+
+Indexed in-memory registry of the peers that have joined the network. Peers
+are keyed by their listening port and kept in join order, so joins, leaves
+and lookups are O(1) and the port list never has to be rebuilt from sockets.
+"""
+
+
+class Membership:
+    def __init__(self):
+        self.peers = dict()  # Dict of peer port to its connection, in join order.
+
+    def add(self, port, connection):
+        """Register a peer that has joined.
+
+        Keyword arguments:
+        port -- int listening port of the peer.
+        connection -- connection the peer joined on.
+        Return: True if the peer is new, False if the port is already a member, which keeps its connection.
+        """
+        if port in self.peers:
+            return False
+        self.peers[port] = connection
+        return True
+
+    def remove(self, port):
+        """Remove a peer that has left.
+
+        Keyword arguments:
+        port -- int listening port of the peer.
+        Return: connection of the removed peer, or None if it was not a member.
+        """
+        return self.peers.pop(port, None)
+
+    def connection(self, port):
+        """Get the connection of a member.
+
+        Keyword arguments:
+        port -- int listening port of the peer.
+        Return: connection of the peer, or None if it is not a member.
+        """
+        return self.peers.get(port)
+
+    def ports(self):
+        """Get the ports of all members in join order.
+
+        Return: list of int port numbers.
+        """
+        return list(self.peers)
+
+    def connections(self):
+        """Get the connections of all members in join order.
+
+        Return: list of connections.
+        """
+        return list(self.peers.values())
+
+    def __contains__(self, port):
+        return port in self.peers
+
+    def __iter__(self):
+        return iter(self.peers)
+
+    def __len__(self):
+        return len(self.peers)
@@ -0,0 +1,214 @@
+"""Metrics
+
+Registry of counters, histograms and gauges that a process or server updates
+as it runs. Updating a metric is a short locked increment, so metrics stay on
+even under load. A snapshot of every metric can be read through snapshot(), or
+written out periodically by a dump thread.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, doubling from 1 microsecond to about 10 minutes.
+DEFAULT_BOUNDS = tuple(1e-6 * 2 ** i for i in range(30))
+# Histogram bucket upper bounds for sizes and counts, doubling from 1 to about a million.
+SIZE_BOUNDS = tuple(2 ** i for i in range(21))
+
+
+class Counter:
+    """Count of events or a running total, e.g. bytes sent."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Add an amount to the counter.
+
+        Keyword arguments:
+        amount -- number to add.
+        Return: N/A
+        """
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """Distribution of observed values in exponential buckets, e.g. durations in seconds."""
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds  # Sorted upper bounds of the buckets.
+        self.buckets = [0] * (len(bounds) + 1)  # Counts per bucket, the last for values above every bound.
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Record an observed value.
+
+        Keyword arguments:
+        value -- number observed.
+        Return: N/A
+        """
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, fraction):
+        """Estimate a percentile as the upper bound of the bucket it falls in.
+
+        Keyword arguments:
+        fraction -- percentile as a fraction, e.g. 0.99.
+        Return: estimated value, or None if nothing has been observed.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            seen = 0
+            for index, bucket in enumerate(self.buckets):
+                seen += bucket
+                if seen >= rank and bucket:
+                    # The true value is never above the largest value observed.
+                    return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+            return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = dict()    # Dict of name to Counter.
+        self.histograms = dict()  # Dict of name to Histogram.
+        self.gauges = dict()      # Dict of name to callable sampled when a snapshot is taken.
+        self.lock = threading.Lock()
+        self.dump_stopped = None  # Event that stops the dump thread, if one is running.
+
+    def counter(self, name):
+        """Get a counter, creating it if needed.
+
+        Keyword arguments:
+        name -- name of the counter, e.g. 'messages_in.proposal'.
+        Return: Counter.
+        """
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name, bounds=DEFAULT_BOUNDS):
+        """Get a histogram, creating it if needed.
+
+        Keyword arguments:
+        name -- name of the histogram, e.g. 'round_duration'.
+        bounds -- bucket upper bounds used if the histogram is created.
+        Return: Histogram.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram(bounds))
+        return histogram
+
+    def gauge(self, name, function):
+        """Register a gauge that is sampled whenever a snapshot is taken.
+
+        Keyword arguments:
+        name -- name of the gauge, e.g. 'writer_queue_depth'.
+        function -- callable returning the current value.
+        Return: N/A
+        """
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        """Get the current value of every metric.
+
+        Return: dict with 'counters', 'histograms' and 'gauges' dicts of name to value.
+        """
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+            gauges = list(self.gauges.items())
+
+        sampled = dict()
+        for name, function in gauges:
+            try:
+                sampled[name] = function()
+            except Exception:
+                # Gauges read state owned by other threads, so skip one that changed under it.
+                logger.debug("Failed to sample gauge %s", name, exc_info=True)
+        return {
+            'counters': {name: counter.snapshot() for name, counter in sorted(counters)},
+            'histograms': {name: histogram.snapshot() for name, histogram in sorted(histograms)},
+            'gauges': dict(sorted(sampled.items())),
+        }
+
+    def start_dump(self, interval, path=None):
+        """Start a thread that writes a snapshot every interval.
+        Snapshots are appended to a file as JSON lines, or logged if no file is given.
+
+        Keyword arguments:
+        interval -- seconds between snapshots.
+        path -- optional file to append snapshots to.
+        Return: N/A
+        """
+        self.stop_dump()
+        self.dump_stopped = threading.Event()
+        threading.Thread(target=self.dump, args=(interval, path, self.dump_stopped), daemon=True).start()
+
+    def stop_dump(self):
+        """Stop the dump thread, if one is running.
+
+        Return: N/A
+        """
+        if self.dump_stopped is not None:
+            self.dump_stopped.set()
+            self.dump_stopped = None
+
+    def dump(self, interval, path, stopped):
+        """Write a snapshot every interval until stopped.
+
+        Keyword arguments:
+        interval -- seconds between snapshots.
+        path -- optional file to append snapshots to.
+        stopped -- Event that stops the dump.
+        Return: N/A
+        """
+        while not stopped.wait(interval):
+            snapshot = self.snapshot()
+            snapshot['time'] = time.time()
+            if path is None:
+                logger.info("Metrics: %s", json.dumps(snapshot))
+                continue
+            try:
+                with open(path, 'a') as f:
+                    f.write(json.dumps(snapshot) + '\n')
+            except OSError:
+                logger.warning("Failed to write metrics to %s", path, exc_info=True)
@@ -0,0 +1,116 @@
+"""Overlay
+
+Chooses the peers a process keeps connections to, and so how proposals reach
+the peers it is not connected to. Overlays share one interface, so either can
+be used:
+
+FullMesh -- every process is connected to every other and only sends its
+            proposals to them directly. Connections per process grow linearly
+            with the cluster, and messages per round quadratically.
+GossipOverlay -- every process is connected to O(log N) neighbours, the
+                 fingers of a ring of hashed ports, as in Chord. A proposal
+                 also carries the processes whose proposals it includes, and
+                 a process relays it to its neighbours whenever that set
+                 grows, so every member's proposal reaches every process in
+                 O(log N) hops. Every process computes the same neighbours
+                 from the membership the server pushes, and a join only moves
+                 a few of them.
+"""
+
+import bisect
+import hashlib
+
+RING_BITS = 32       # Bits of the positions on the gossip overlay's ring.
+RELAY_DELAY = 0.005  # Seconds a process collects new origins for before relaying them.
+
+
+class FullMesh:
+    relays = False  # Flag for if proposals are relayed to peers that are not neighbours.
+
+    def neighbours(self, local_id, members):
+        """Get the peers a process keeps connections to.
+
+        Keyword arguments:
+        local_id -- port of the process.
+        members -- iterable of the ports of the members.
+        Return: set of peer ports.
+        """
+        return set(members) - {local_id}
+
+
+class GossipOverlay:
+    relays = True
+
+    def __init__(self, bits=RING_BITS):
+        self.bits = bits
+        self.positions = dict()  # Dict of port to its position on the ring.
+
+    def position(self, member_id):
+        """Get a member's position on the ring.
+        Ports are hashed, so members spread evenly however their ports were picked.
+
+        Keyword arguments:
+        member_id -- port of the member.
+        Return: int position.
+        """
+        position = self.positions.get(member_id)
+        if position is None:
+            digest = hashlib.blake2b(str(member_id).encode(), digest_size=8).digest()
+            position = self.positions[member_id] = int.from_bytes(digest, 'big') >> (64 - self.bits)
+        return position
+
+    def neighbours(self, local_id, members):
+        """Get the peers a process keeps connections to: its fingers, the first
+        member at or after each power of two past its position, and the members
+        it is a finger of. Both ends of a connection want it, so neither side
+        retires it while the other still needs it.
+
+        Keyword arguments:
+        local_id -- port of the process.
+        members -- iterable of the ports of the members.
+        Return: set of peer ports.
+        """
+        ring = sorted((self.position(member_id), member_id) for member_id in set(members) | {local_id})
+        if len(ring) < 2:
+            return set()
+        positions = [position for position, member_id in ring]
+        ids = [member_id for position, member_id in ring]
+        size = 1 << self.bits
+        index = ids.index(local_id)
+        local = positions[index]
+        predecessor = positions[index - 1]
+
+        neighbours = set()
+        for i in range(self.bits):
+            step = 1 << i
+            # Finger i is the first member at or after local + 2^i.
+            neighbours.add(ids[bisect.bisect_left(positions, (local + step) % size) % len(ids)])
+            # This process is finger i of the members in (predecessor - 2^i, local - 2^i].
+            low, high = (predecessor - step) % size, (local - step) % size
+            if low < high:
+                neighbours.update(ids[bisect.bisect_right(positions, low):bisect.bisect_right(positions, high)])
+            else:
+                neighbours.update(ids[bisect.bisect_right(positions, low):])
+                neighbours.update(ids[:bisect.bisect_right(positions, high)])
+        neighbours.discard(local_id)
+        return neighbours
+
+
+OVERLAYS = {
+    'mesh': FullMesh,
+    'gossip': GossipOverlay,
+}
+
+
+def make_overlay(overlay):
+    """Create an overlay from its name.
+
+    Keyword arguments:
+    overlay -- one of OVERLAYS, or an overlay instance.
+    Return: overlay.
+    """
+    if isinstance(overlay, str):
+        if overlay not in OVERLAYS:
+            raise ValueError(f"Unknown overlay {overlay!r}")
+        return OVERLAYS[overlay]()
+    return overlay
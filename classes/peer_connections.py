@@ -0,0 +1,94 @@
+"""PeerConnections
+
+Registry of the single full-duplex connection a process keeps with each peer,
+keyed by the peer's stable ID, its listening port, which is exchanged in a
+hello frame when the connection opens. If both peers open a connection to
+each other at the same time, both sides keep the connection dialed by the
+peer with the lower ID and retire the other, so they always agree on which
+one carries their traffic.
+"""
+
+
+class PeerConnections:
+    def __init__(self, local_id):
+        self.local_id = local_id  # Stable ID of this process.
+        self.by_id = dict()       # Dict of peer ID to its active connection.
+        self.by_connection = dict()  # Dict of active connection to (peer ID, ID of the peer that dialed it).
+
+    def add(self, peer_id, connection, dialer_id):
+        """Register a connection to a peer, resolving a duplicate connection to the same peer.
+
+        Keyword arguments:
+        peer_id -- stable ID of the peer.
+        connection -- connection to the peer.
+        dialer_id -- ID of the process that opened the connection.
+        Return: connection that should be retired, which may be the new one, or None.
+        """
+        current = self.by_id.get(peer_id)
+        if current is not None:
+            current_dialer_id = self.by_connection[current][1]
+            keep_id = min(self.local_id, peer_id)
+            if current_dialer_id == keep_id and dialer_id != keep_id:
+                # The connection already registered wins the tie-break.
+                return connection
+            # The new connection wins, or replaces a connection from the same dialer that it reopened.
+            del self.by_connection[current]
+
+        self.by_id[peer_id] = connection
+        self.by_connection[connection] = (peer_id, dialer_id)
+        return current
+
+    def remove(self, connection):
+        """Remove a connection.
+
+        Keyword arguments:
+        connection -- connection that has closed.
+        Return: ID of the peer if the connection was its active connection, else None.
+        """
+        entry = self.by_connection.pop(connection, None)
+        if entry is None:
+            return None
+        del self.by_id[entry[0]]
+        return entry[0]
+
+    def connection(self, peer_id):
+        """Get the active connection to a peer.
+
+        Keyword arguments:
+        peer_id -- stable ID of the peer.
+        Return: connection, or None if the peer is not connected.
+        """
+        return self.by_id.get(peer_id)
+
+    def peer_id(self, connection):
+        """Get the peer an active connection belongs to.
+
+        Keyword arguments:
+        connection -- connection to look up.
+        Return: peer ID, or None if the connection is not active.
+        """
+        entry = self.by_connection.get(connection)
+        return entry[0] if entry is not None else None
+
+    def ids(self):
+        """Get the IDs of every connected peer.
+
+        Return: live set-like view of peer IDs.
+        """
+        return self.by_id.keys()
+
+    def connections(self):
+        """Get the active connection to every peer.
+
+        Return: list of connections.
+        """
+        return list(self.by_id.values())
+
+    def __contains__(self, peer_id):
+        return peer_id in self.by_id
+
+    def __iter__(self):
+        return iter(list(self.by_id))
+
+    def __len__(self):
+        return len(self.by_id)
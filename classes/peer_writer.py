@@ -0,0 +1,133 @@
+"""PeerWriter
+
+Bounded outbound queue and writer thread for a single peer connection.
+Broadcasts hand the same encoded bytes to every peer's queue and return
+immediately. Each writer coalesces whatever is queued into one batched send,
+and a peer that stops reading fills its queue or times out its send and is
+dropped instead of stalling everyone else.
+"""
+
+import queue
+import socket
+import threading
+import time
+
+MAX_QUEUED_MESSAGES = 1024   # Messages queued for a peer before it is considered stalled.
+MAX_BATCH_BYTES = 256 * 1024  # Bytes coalesced into a single send.
+SEND_TIMEOUT = 5.0            # Seconds a single send may block before the peer is dropped.
+
+
+class PeerWriter:
+    def __init__(self, connection, on_error, max_queued=MAX_QUEUED_MESSAGES,
+                 max_batch_bytes=MAX_BATCH_BYTES, send_timeout=SEND_TIMEOUT, send_time=None):
+        self.connection = connection  # Out connection socket written to.
+        self.on_error = on_error      # Called with the connection when the peer is dropped.
+        self.send_time = send_time    # Optional Histogram to record how long each send blocks for in, set while running.
+        self.queue = queue.Queue(max_queued)  # Encoded messages waiting to be sent.
+        self.max_batch_bytes = max_batch_bytes
+        self.closed = False
+
+        # Out connections are only written to, so a timeout bounds a stalled send.
+        connection.settimeout(send_timeout)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, encoded_data):
+        """Queue encoded data without blocking.
+
+        Keyword arguments:
+        encoded_data -- framed bytes to be sent.
+        Return: True if the data was queued, False if the queue is full and the peer should be dropped,
+                or None if the writer is closed, e.g. on shutdown or after a failed send.
+        """
+        if self.closed:
+            return None
+        try:
+            self.queue.put_nowait(encoded_data)
+        except queue.Full:
+            return False
+        return True
+
+    def qsize(self):
+        """Number of messages waiting to be sent.
+
+        Return: int queue depth.
+        """
+        return self.queue.qsize()
+
+    def flush(self, timeout=None):
+        """Block until every message queued so far has been sent, or the writer has stopped.
+        Lets a long stream of messages be queued a little at a time.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for.
+        Return: True if every queued message was sent.
+        """
+        with self.queue.all_tasks_done:
+            self.queue.all_tasks_done.wait_for(lambda: not self.queue.unfinished_tasks or self.closed, timeout)
+            return not self.queue.unfinished_tasks
+
+    def close(self):
+        """Stop the writer once the messages already queued have been sent.
+
+        Return: N/A
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            # The writer is stalled on a dead peer, which is about to be closed under it.
+            pass
+        self.wake_flushers()
+
+    def wake_flushers(self):
+        """Wake threads waiting in flush, e.g. because the writer has stopped.
+
+        Return: N/A
+        """
+        with self.queue.all_tasks_done:
+            self.queue.all_tasks_done.notify_all()
+
+    def run(self):
+        """Send queued messages, coalescing small ones into batched writes.
+
+        Return: N/A
+        """
+        while True:
+            encoded_data = self.queue.get()
+            if encoded_data is None:
+                return
+
+            batch = [encoded_data]
+            batch_size = len(encoded_data)
+            stop = False
+            while batch_size < self.max_batch_bytes:
+                try:
+                    encoded_data = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if encoded_data is None:
+                    stop = True
+                    break
+                batch.append(encoded_data)
+                batch_size += len(encoded_data)
+
+            send_time = self.send_time
+            started = time.perf_counter() if send_time is not None else None
+            try:
+                self.connection.sendall(batch[0] if len(batch) == 1 else b''.join(batch))
+            except socket.error:
+                if not self.closed:
+                    self.closed = True
+                    self.wake_flushers()
+                    self.on_error(self.connection)
+                return
+            if send_time is not None:
+                send_time.observe(time.perf_counter() - started)
+            for i in range(len(batch)):
+                self.queue.task_done()
+
+            if stop:
+                return
@@ -0,0 +1,293 @@
+"""PipelinedProcess
+
+This class represents a process that runs several rounds of the flooding
+regular consensus protocol at once. A window of consecutive rounds is open at
+any time, and each round is a separate instance with its own proposal set,
+received from tracking and crash flag. Rounds may end in any order, but they
+are delivered to the decision listeners in round order, and the window slides
+forward as the lowest open round is delivered.
+"""
+
+import collections
+import logging
+import time
+
+from .process import Process
+from .proposal_set import ProposalSet, freeze
+
+logger = logging.getLogger(__name__)
+
+
+class PipelinedProcess(Process):
+    def __init__(self, host, port, window=4, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.window = window  # Number of rounds that can be open at once.
+        self.pending_proposals = collections.deque()  # Values waiting for a free round in the window.
+
+    # ****************** #
+    # Flooding Algorithm #
+
+    def instance(self, round_id):
+        """Get the record of a round instance, creating its proposal set if needed.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: RoundRecord, or None if the round has already been evicted.
+        """
+        record = self.rounds.record(round_id)
+        if record is not None and record.proposal_set is None:
+            record.proposal_set = ProposalSet()
+        return record
+
+    def open_rounds(self):
+        """Get the IDs of the rounds currently inside the window.
+
+        Return: range of int round IDs.
+        """
+        return range(self.current_round_id, self.current_round_id + self.window)
+
+    def propose(self, value):
+        """ Propose a user input value in the first round of the window it has not proposed in yet.
+        If every round in the window has been proposed in, the value waits until the window slides.
+
+        Keyword arguments:
+        value -- user entered value
+        Return: int ID of the round proposed in, or None if the value is waiting.
+        """
+        if not self.actor.is_current():
+            return self.actor.ask(self.propose, value)
+        round_id = self.next_free_round()
+        if round_id is None:
+            self.pending_proposals.append(value)
+            return None
+
+        self.propose_in_round(round_id, [value])
+        return round_id
+
+    def next_free_round(self):
+        """Get the round a new proposal would be made in.
+
+        Return: int ID of the first round in the window not proposed in, or None if the window is full or joining.
+        """
+        if self.joining():
+            return None
+        for round_id in self.open_rounds():
+            if not self.rounds.has_proposed(round_id):
+                return round_id
+        return None
+
+    def propose_in_round(self, round_id, values):
+        """Add values to a round's proposal set and broadcast it to all peers.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        values -- list of values to propose.
+        Return: N/A
+        """
+        record = self.instance(round_id)
+        if record is None:
+            return
+        record.proposal_set.add(values)
+        record.proposed = True
+        record.proposed_at = time.perf_counter()
+
+        # Broadcast the round's proposal set to all peers.
+        self.broadcast_proposal(round_id)
+
+        # Check if this was the last value needed for the round.
+        self.check_end_of_round(round_id)
+
+    def broadcast_proposal(self, round_id, full=False):
+        """Broadcast a round instance's proposal set to all peers.
+        Each round has its own proposal set, so the whole set is always sent.
+
+        Keyword arguments:
+        round_id -- int ID of the round being proposed for.
+        full -- ignored, the whole set is always sent.
+        Return: N/A
+        """
+        if self.overlay.relays:
+            self.gossip_proposal(round_id)
+            return
+        record = self.instance(round_id)
+        if record is not None:
+            self.send_to_all({'proposal': (round_id, record.proposal_set.to_list())})
+
+    def unsent_proposals(self, round_id, connection, full=False):
+        """Get the proposals to relay to a neighbour, the round instance's whole proposal set.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        connection -- connection of the neighbour.
+        full -- ignored, the whole set is always sent.
+        Return: list of proposed values.
+        """
+        record = self.instance(round_id)
+        return record.proposal_set.to_list() if record is not None else []
+
+    def receive_proposal(self, peer_id, round_id, proposal_set, origins=None):
+        """ Receive a proposal from a connected node for one of the round instances.
+
+        Keyword arguments:
+        peer_id -- port of the peer that sent the proposal.
+        round_id -- int ID of the round in which the value was proposed.
+        proposed_set -- list of set including updated proposed value.
+        origins -- list of ports of the processes whose proposals a relayed proposal includes.
+        Return: N/A
+        """
+        record = self.instance(round_id)
+        if record is None or record.ended:
+            return
+        if origins is None:
+            record.received_from.add(peer_id)
+        else:
+            self.receive_origins(peer_id, round_id, origins)
+        record.proposal_set.add(proposal_set)
+
+        # A peer has started a round this process has not proposed in, so send any batched values now.
+        if self.batcher is not None and not record.proposed:
+            self.batcher.round_opened()
+
+        self.check_end_of_round(round_id)
+
+    def check_end_of_round(self, round_id=None):
+        """Determine if a round instance has reached its end.
+        Without a round ID every open round is checked, e.g. after a crash.
+
+        Keyword arguments:
+        round_id -- int ID of the round to check.
+        Return: N/A
+        """
+        if round_id is None:
+            for open_round_id in self.open_rounds():
+                self.check_end_of_round(open_round_id)
+            return
+
+        record = self.rounds.get(round_id)
+        if record is None or record.ended or not record.proposed:
+            return
+
+        # Check if process has received all possible proposals from self and peer processes.
+        if not self.expected_peers() <= record.received_from:
+            return
+        self.observe_phase(round_id, 'collect')
+
+        if not record.crash:
+            # Only decide on a value if there have been no crashes while the round was open.
+            self.decide(round_id)
+        self.end_round(round_id)
+
+    def decide(self, round_id, force_decision=None):
+        """Decide on a value for a round instance and broadcast it.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        force_decision -- value decided by a peer for this round.
+        Return: N/A
+        """
+        record = self.instance(round_id)
+        if record is None or record.decided:
+            return
+
+        if force_decision is not None:
+            force_decision = freeze(force_decision)
+            record.proposal_set.add([force_decision])
+            val = force_decision
+        else:
+            # Set decided val to largest val in the round's proposal set.
+            val = record.proposal_set.max()
+        self.rounds.set_decided(round_id, val)
+        self.observe_decision(round_id)
+        self.observe_phase(round_id, 'decide')
+        logger.info("Process has decided on value %r for round %s.", val, round_id)
+
+        # Broadcast decision to all peers.
+        self.send_to_all({'decision': (round_id, val)})
+        self.observe_phase(round_id, 'broadcast')
+
+    def receive_decision(self, round_id, decided_value):
+        """Receive a decided value from a connected node and end that round.
+
+        Keyword arguments:
+        round_id -- int ID of the decided round.
+        decided_value -- value decided by the peer.
+        Return: N/A
+        """
+        if not self.rounds.is_decided(round_id):
+            self.decide(round_id, force_decision=decided_value)
+            self.end_round(round_id)
+
+    def mark_crash(self):
+        """Record that a peer crashed while every currently open round was running.
+
+        Return: N/A
+        """
+        for round_id in self.open_rounds():
+            record = self.instance(round_id)
+            if record is not None and not record.ended:
+                record.crash = True
+
+    def end_round(self, round_id=None):
+        """End a round instance, then deliver every ended round at the bottom of the window.
+
+        Keyword arguments:
+        round_id -- int ID of the round, the lowest open round by default.
+        Return: N/A
+        """
+        if round_id is None:
+            round_id = self.current_round_id
+        record = self.instance(round_id)
+        if record is None or record.ended:
+            return
+        record.ended = True
+        self.observe_round_end(round_id)
+        logger.debug("Ending round %s...", round_id)
+
+        if record.crash and not record.decided:
+            # Needs chance to decide these values again in a round this process has not proposed in.
+            carry_round_id = round_id + 1
+            while self.rounds.has_proposed(carry_round_id):
+                carry_round_id += 1
+            self.propose_in_round(carry_round_id, record.proposal_set.to_list())
+
+        self.deliver_ended_rounds()
+        self.propose_pending()
+
+    def deliver_ended_rounds(self):
+        """Slide the window past every round at its bottom that has ended, in order.
+
+        Return: N/A
+        """
+        delivered_round_id = self.current_round_id
+        while self.rounds.is_ended(self.current_round_id):
+            self.deliver(self.current_round_id)
+            self.current_round_id += 1
+        self.rounds.evict(self.current_round_id)
+        if self.current_round_id != delivered_round_id:
+            self.notify_round_change()
+
+    def resume_decided_rounds(self):
+        """Deliver the rounds from the current one on that ended while catching up.
+
+        Return: N/A
+        """
+        self.deliver_ended_rounds()
+
+    def propose_pending(self):
+        """Propose values that were waiting in the rounds that are free.
+
+        Return: N/A
+        """
+        while self.pending_proposals:
+            free_round_id = self.next_free_round()
+            if free_round_id is None:
+                break
+            self.propose_in_round(free_round_id, [self.pending_proposals.popleft()])
+
+    def release_proposals(self):
+        """Retry proposals that were held back because no round was free.
+
+        Return: N/A
+        """
+        self.propose_pending()
+        super().release_proposals()
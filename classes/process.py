@@ -2,67 +2,197 @@
 
 This class represents a process that can connect to a peer network and run an 
 implementation of the flooding regular consensus protocol algorithm.
+Connection threads only read, decode and send. Every message, crash and
+proposal they produce is handed to the process's actor, which changes the
+protocol state on a single thread, so the protocol needs no lock.
+
+A process can be profiled, either from the start or by toggling its sampling
+profiler while it runs, with a signal or, if the process allows it, a profile
+message on its unix socket. While profiled, it
+also records histograms of the time spent handling each message type
+(handler.<type>), decoding frames (decode), blocked sending to peers
+(writer.send) and in each phase of a round: from its first proposal being seen
+to every expected proposal being received (round.collect), then deciding
+(round.decide), queueing the decision for every peer (round.broadcast) and
+delivering the round (round.deliver). A phase a round skips, e.g. collecting
+when a peer's decision ends it, is folded into the next one. Time calls wait
+for the actor is always recorded, as actor.queue_wait. Every hook checks a
+single flag, so a process that is not profiled pays next to nothing for them.
 """
 
+import concurrent.futures
+import json
+import logging
+import os
+import selectors
 import socket
+import tempfile
 import threading
-import json
+import time
+
+from .codec import DEFAULT_CODECS, JSON, decode_payload, negotiate
+from .decision_log import DecisionLog, RecoveredState
+from .dialer import Dialer, MAX_IN_FLIGHT, DIAL_TIMEOUT
+from .failure_detector import HEARTBEAT_INTERVAL, make_failure_detector
+from .framing import HEADER, encode_frame, FrameDecoder, FrameError
+from .metrics import Metrics, SIZE_BOUNDS
+from .overlay import RELAY_DELAY, make_overlay
+from .peer_connections import PeerConnections
+from .peer_writer import PeerWriter
+from .profiler import SamplingProfiler
+from .proposal_set import ProposalSet, freeze
+from .actor import Actor
+from .batcher import Batcher
+from .round_store import RoundStore
+from .state_transfer import SnapshotAssembler, encode_chunks
+from .transport import DEFAULT_TRANSPORTS, TRANSPORTS, UNIX, host_id, is_local, set_no_delay
+
+logger = logging.getLogger(__name__)
 
 class Process:
-    def __init__(self, host, port):
+    def __init__(self, host, port, delta=False, retention=128, batch_size=64, batch_delay=0.005,
+                 max_dials=MAX_IN_FLIGHT, dial_timeout=DIAL_TIMEOUT, failure_detector='timeout',
+                 heartbeat_interval=HEARTBEAT_INTERVAL, log_dir=None, codecs=DEFAULT_CODECS, overlay='mesh',
+                 relay_delay=RELAY_DELAY, group=None, transports=DEFAULT_TRANSPORTS, profile=False,
+                 profile_dir=None, profile_messages=False):
         # Socket Connections #
         self.host = host
         self.port = port
+        self.group = group  # ID of the consensus group the process runs, or None if its node only runs one.
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connections = []
-        self.out_connections = []
+        self.transports = list(transports)  # Names of the transports peers are dialed over, most preferred first.
+        self.unix_socket = None  # Socket listening on the unix transport, if it is one of the transports.
+        self.unix_path = None    # Path the process listens at on the unix transport, once it does.
+        self.endpoints = dict()  # Dict of peer port to the endpoint the server advertised for it.
+        self.connections = []  # Every open connection, including the server and peers still saying hello.
+        self.peers = PeerConnections(port)  # Single connection to each peer, keyed by the peer's port.
+        self.retired_by_peers = set()  # Duplicate connections the peer has said bye on but this process still uses.
+        self.writers = dict()  # Dict of peer connection to the PeerWriter queueing its sends.
         self.server_connection = None
-        self.lock = threading.Lock()
+        self.peer_ports = set()  # Set of peer ports that the server reports as joined.
+        self.listening = threading.Event()  # Set once the process is accepting connections.
+        self.stopped = threading.Event()    # Set once the process has been stopped.
+        self.round_condition = threading.Condition()  # Notified whenever the current round changes.
+        # Dials peers concurrently when joining, with at most max_dials in flight.
+        self.dialer = Dialer(self.connect, self.stopped, max_dials, dial_timeout)
+        self.join_result = None  # Future of the JoinResult of joining the network, once connecting to the server.
+        self.codecs = list(codecs)  # Names of the codecs offered to peers, most preferred first.
+        self.send_codecs = dict()   # Dict of peer connection to the codec messages are sent on it with.
+
+        # Overlay #
+        self.overlay = make_overlay(overlay)  # Chooses the peers to connect to, one of OVERLAYS.
+        self.dialing = set()       # Ports of neighbours being dialed after a membership change.
+        self.relay_rounds = set()  # Rounds whose received from set grew since they were last relayed.
+        self.relay_delay = relay_delay  # Seconds new origins are collected for before they are relayed.
+
+        # Failure Detection #
+        # Suspects peers that have been silent for too long, or None to only detect closed connections.
+        self.failure_detector = make_failure_detector(failure_detector)
+        self.heartbeat_interval = heartbeat_interval  # Seconds without sending to a peer before a heartbeat is sent.
+        self.last_sent = dict()  # Dict of peer connection to the time a message was last queued on it.
+
+        # State Transfer #
+        self.catch_up = None      # SnapshotAssembler of the snapshot being received while joining, or None.
+        self.pending_join = None  # JoinResult of a join that is waiting for its snapshot.
 
         # Flooding Algorithm #
-        self.proposal_set = []    # List of all proposed values.
-        self.decided_rounds = []  # List of round IDs that have been decided.
-        self.ended_rounds = []    # List of rounds that have been ended to avoid race conditions.
+        self.proposal_set = ProposalSet()  # Set of all proposed values.
+        self.delta = delta        # Flag for if proposals only carry values a peer has not been sent yet.
+        self.sent_versions = dict()  # Dict of peer connection to the proposal set version already sent on it.
+        self.future_proposals = dict()  # Dict of round ID to values received for a round not reached yet.
+        # Per-round received from, proposed, decided and ended state, keeping the last retention ended rounds.
+        self.rounds = RoundStore(retention)
 
-        self.received_from = dict()       # Dict of process ports that have been received from per round.
-        self.proposed_for_round = dict()  # Flag for if the process proposed per round.
+        self.current_round_id = 0     # ID of the current round.
+        self.round_crash = False      # Flag for if there has been a crash in the current round.
+        self.decision_listeners = []  # Callables given each round's ID and decided value, in round order.
 
-        self.current_round_id = 0                # ID of the current round.      
-        self.current_accepted_addresses = set()  # Set of currently conencted receiving addresses.
-        self.initial_out_ports = set()           # List of initial connections' ports from the current round's start.
-        self.round_crash = False                 # Flag for if there has been a crash in the current round. 
+        # Client Batching #
+        self.batcher = None            # Batcher for submitted values, started on the first submit.
+        self.batch_size = batch_size   # Number of submitted values proposed together at most.
+        self.batch_delay = batch_delay # Seconds a submitted value waits for its batch to fill.
+
+        # Metrics #
+        self.metrics = Metrics()  # Counters and histograms of messages, bytes and round timings.
+        # Runs every change to the protocol state, one at a time on a single thread.
+        self.actor = Actor(f"process-{port}", self.metrics)
+        self.metrics.gauge('actor_queue_depth', self.actor.qsize)
+        self.metrics.gauge('current_round', lambda: self.current_round_id)
+        self.metrics.gauge('peers', lambda: len(self.peers))
+        self.metrics.gauge('rounds_retained', lambda: len(self.rounds))
+        self.metrics.gauge('writer_queue_depth', lambda: sum(w.qsize() for w in list(self.writers.values())))
+        self.metrics.gauge('batcher_pending', lambda: len(self.batcher.pending) if self.batcher else 0)
+
+        # Profiling #
+        self.profile = profile    # Flag for if handler, decode, send and round phase times are always recorded.
+        self.profiling = profile  # Flag for if they are recorded now, which they also are while the profiler runs.
+        self.profiler = None      # SamplingProfiler toggled on while the process runs, or None.
+        self.profile_dir = profile_dir or tempfile.gettempdir()  # Directory profiles are dumped to.
+        # Flag for if profile messages toggle the profiler, which they only do on the unix socket.
+        self.profile_messages = profile_messages
+
+        # Durability #
+        self.log = None  # DecisionLog of proposals and delivered rounds, or None to keep state only in memory.
+        if log_dir is not None:
+            self.log = DecisionLog(log_dir, retention, metrics=self.metrics)
+            self.restore(self.log.recover())
        
         
     # ****************** #
     # Socket Connections #
     
-    def encode_data(self, data):
-        """Encodes dictionary data.
+    def encode_data(self, data, codec=JSON):
+        """Encodes dictionary data into a length-prefixed frame.
         
         Keyword arguments:
         data -- dictionary to be encoded.
-        Return: encoded version of dictionary data.
+        codec -- codec to encode with, JSON by default for handshakes and the server.
+        Return: framed, encoded version of dictionary data.
         """
-        return json.dumps(data).encode('utf-8')
+        return encode_frame(codec.encode(data))
     
-    def decode_data(self, data):
+    def decode_data(self, frames):
         """Decodes dictionary data.
-        May get multiple messages in a data stream, so need to split individual
-        dict objects to load individually.
+        The connection's frame decoder has already split the stream into 
+        complete messages, so each frame holds exactly one dict object,
+        tagged with the codec it was encoded with.
 
         Keyword arguments:
-        data -- encoded string of dict(s) to be decoded.
+        frames -- list of frame payloads to be decoded.
         Return: list of decoded version of dict data.
         """
-        # Decode data.
-        decoded_data = data.decode('utf-8')
+        if not self.profiling:
+            return [decode_payload(frame) for frame in frames]
+        started = time.perf_counter()
+        data_messages = [decode_payload(frame) for frame in frames]
+        self.metrics.histogram('decode').observe(time.perf_counter() - started)
+        return data_messages
+
+    def codec(self, connection):
+        """Get the codec messages are sent on a connection with.
+
+        Keyword arguments:
+        connection -- connection to send on.
+        Return: codec negotiated with the peer, or JSON.
+        """
+        return self.send_codecs.get(connection, JSON)
 
-        # Split string per dict object.
-        data_message = decoded_data.split('}')
-        data_message = [i+'}' for i in data_message]
-        data_message.remove('}')
+    def greeting(self, message_type):
+        """Create the message a process introduces itself to the server or a peer with.
 
-        return [json.loads(i) for i in data_message]
+        The server is also told where the process listens besides TCP, to
+        advertise to its peers.
+
+        Keyword arguments:
+        message_type -- 'new' for the server or 'hello' for a peer.
+        Return: dict message with this process's port, codecs and group.
+        """
+        data = {message_type: self.port, 'codecs': self.codecs}
+        if self.group is not None:
+            data['group'] = self.group
+        if message_type == 'new' and self.unix_path is not None:
+            data['endpoint'] = {'host_id': host_id(), 'unix': self.unix_path}
+        return data
 
     def connect_to_rendezvous(self, server_host, server_port):
         """Create connection to server to access group of peers.
@@ -76,87 +206,326 @@ class Process:
         connection = socket.create_connection((server_host, server_port))
         self.connections.append(connection)
         self.server_connection = connection
+        self.join_result = concurrent.futures.Future()
         
         # Send message to server to get group of peers.
-        encoded_data = self.encode_data({'new': self.port})
+        encoded_data = self.encode_data(self.greeting('new'))
         connection.sendall(encoded_data)
 
+        # The server replies and pushes membership changes on the same connection.
+        threading.Thread(target=self.handle_client, args=(connection, None)).start()
+
     
-    def connect(self, peer_host, peer_port):
-        """Connect to a peer socket.
+    def connect(self, peer_host, peer_port, timeout=None):
+        """Connect to a peer socket and say hello, so the peer can use it in both directions.
+        The peer is added once it says hello back.
         
         Keyword arguments:
         peer_host -- host address of the peer connection.
-        peer_port -- port number of the peer connection.
+        peer_port -- port number of the peer connection, which is also its peer ID.
+        timeout -- optional seconds the connection attempt may take.
         Return: socket of new connection.
         """
-        # Create socket to connect to the peer.
-        connection = socket.create_connection((peer_host, peer_port))
+        # Create socket to connect to the peer, over the best transport that reaches it.
+        error = None
+        for transport, address in self.dial_addresses(peer_host, peer_port):
+            try:
+                connection = transport.connect(address, timeout)
+                break
+            except OSError as e:
+                logger.debug("Failed to connect to %s over %s. Error: %r", address, transport.name, e)
+                error = e
+        else:
+            raise error
+        connection.settimeout(None)
         self.connections.append(connection)
-        self.out_connections.append(connection)
+        self.send_handshake(self.greeting('hello'), connection)
 
-        print(f"Now sending data to {peer_host}:{peer_port}")
+        logger.debug("Now connected to %s:%s", peer_host, peer_port)
+        threading.Thread(target=self.handle_client, args=(connection, peer_port)).start()
         return connection
+
+    def dial_addresses(self, peer_host, peer_port):
+        """Get the transports a peer can be dialed over, and its address on each, best first.
+        TCP is always tried last, as it reaches every peer.
+
+        Keyword arguments:
+        peer_host -- host address of the peer, if the server advertised none.
+        peer_port -- port number of the peer.
+        Return: list of tuples of transport and address.
+        """
+        endpoint = self.endpoints.get(peer_port)
+        addresses = []
+        for name in self.transports + ['tcp']:
+            transport = TRANSPORTS[name]
+            address = transport.address(endpoint, peer_host, peer_port)
+            if address is not None and (transport, address) not in addresses:
+                addresses.append((transport, address))
+        return addresses
+
+    def send_handshake(self, data, connection):
+        """Send a hello or bye directly on a peer connection that has no writer.
+
+        Keyword arguments:
+        data -- dict message to be sent.
+        connection -- peer connection.
+        Return: N/A
+        """
+        try:
+            connection.sendall(self.encode_data(data))
+        except socket.error:
+            # The reader sees the connection fail and handles the crash.
+            pass
+
+    def receive_hello(self, peer_id, connection, dialed, codecs=None):
+        """Handle a peer's hello, answering it on accepted connections.
+        Messages to the peer are sent with the first of this process's codecs
+        that the peer offered.
+
+        Keyword arguments:
+        peer_id -- port of the peer.
+        connection -- connection the hello was received on.
+        dialed -- flag for if this process opened the connection.
+        codecs -- list of codec names the peer offered, or None if it offered none.
+        Return: N/A
+        """
+        self.send_codecs[connection] = negotiate(self.codecs, codecs)
+        if dialed:
+            self.add_peer(peer_id, connection, dialer_id=self.port)
+        else:
+            self.send_handshake(self.greeting('hello'), connection)
+            self.add_peer(peer_id, connection, dialer_id=peer_id)
+
+    def add_peer(self, peer_id, connection, dialer_id):
+        """Register the connection to a peer once both sides know who the other is.
+        If the peers opened a connection to each other at the same time, the
+        one that loses the tie-break is retired.
+
+        Keyword arguments:
+        peer_id -- port of the peer.
+        connection -- connection to the peer.
+        dialer_id -- port of the process that opened the connection.
+        Return: N/A
+        """
+        retired = self.peers.add(peer_id, connection, dialer_id)
+        if retired is not connection:
+            if self.failure_detector is not None:
+                # Start the peer's silence clock from its hello.
+                self.failure_detector.heartbeat(peer_id)
+            if self.pending_join is not None and self.catch_up is None:
+                # The join finished dialing before any peer said hello.
+                self.request_snapshot()
+            if self.overlay.relays:
+                self.sync_peer(connection)
+        if retired is not None:
+            logger.debug("Retiring duplicate connection to peer %s", peer_id)
+            self.retire_connection(retired)
+
+    def open_writer(self, connection):
+        """Start the writer that queues sends on a peer connection.
+        The writer already coalesces queued messages, so Nagle's algorithm
+        would only delay replies behind the peer's delayed acknowledgements.
+        Called on the connection's reader thread when the peer says hello, so
+        the actor is not held up starting the writer's thread. Nothing is
+        sent through the writer until the actor has added the peer.
+
+        Keyword arguments:
+        connection -- peer connection.
+        Return: N/A
+        """
+        set_no_delay(connection)
+        self.writers[connection] = PeerWriter(connection, on_error=self.report_crash, send_time=self.send_time())
+
+    def send_time(self):
+        """Get the histogram writers record how long their sends block for in.
+
+        Return: Histogram while profiling, else None.
+        """
+        return self.metrics.histogram('writer.send') if self.profiling else None
+
+    def retire_connection(self, connection):
+        """Stop sending on a duplicate connection, or one the overlay no longer
+        wants, and say bye on it. The peer retires the same connection, but may
+        not have seen the winning connection or membership change yet, so it
+        keeps reading until both have said bye.
+
+        Keyword arguments:
+        connection -- peer connection that is no longer registered.
+        Return: N/A
+        """
+        self.sent_versions.pop(connection, None)
+        self.last_sent.pop(connection, None)
+        self.send_codecs.pop(connection, None)
+        writer = self.writers.pop(connection, None)
+        if writer is not None:
+            writer.send(self.encode_data({'bye': self.port}))
+            writer.close()
+        else:
+            self.send_handshake({'bye': self.port}, connection)
+        if connection in self.retired_by_peers:
+            # Both sides have retired it, so nothing more will be sent on it.
+            self.crash_connection(connection)
+
+    def receive_bye(self, connection):
+        """Handle a peer retiring a duplicate connection.
+
+        Keyword arguments:
+        connection -- connection the peer said bye on.
+        Return: N/A
+        """
+        if self.peers.peer_id(connection) is None:
+            # This process has already retired it too.
+            self.crash_connection(connection)
+        else:
+            # The winning connection's hello is still on its way.
+            self.retired_by_peers.add(connection)
     
-    def crash_connection(self, connection, address=None):
+    def report_crash(self, connection):
+        """Hand a connection that failed on a reader or writer thread to the actor.
+
+        Keyword arguments:
+        connection -- connection that has crashed.
+        Return: N/A
+        """
+        self.actor.tell(self.crash_connection, connection)
+
+    def crash_connection(self, connection):
         """Handle a connection crash
         
         Keyword arguments:
-        connection -- peer connection that has crashed.
-        address -- tuple of host address/port for the crashed peer.
+        connection -- connection that has crashed.
         Return: N/A
         """ 
-        # Remove from current connections and close the connection.
-        self.connections.remove(connection)
-        connection.close()
+        # A connection can be reported by both its reader and its writer.
+        try:
+            self.connections.remove(connection)
+        except ValueError:
+            return
+        if self.stopped.is_set():
+            # Connections are closed by stop(), not by crashes.
+            return
+
+        # Stop the connection's writer and close the connection.
+        self.retired_by_peers.discard(connection)
+        self.send_codecs.pop(connection, None)
+        writer = self.writers.pop(connection, None)
+        if writer is not None:
+            writer.close()
+        self.close_connection(connection)
         
+        if connection is self.server_connection:
+            logger.info("Connection to server closed.")
+            self.server_connection = None
+            return
 
-        # Check address for crashed receive connections.
-        if address:
-            print(f"Connection from {address} closed.")
-            self.current_accepted_addresses.remove(address)
+        # Retired duplicates and connections that never said hello are not peers.
+        peer_id = self.peers.remove(connection)
+        if peer_id is None:
+            return
+        logger.info("Connection to peer %s closed.", peer_id)
+        self.sent_versions.pop(connection, None)
+        self.last_sent.pop(connection, None)
+        if self.failure_detector is not None:
+            self.failure_detector.remove(peer_id)
+        if self.overlay.relays:
+            # The server may never see a hung neighbour leave, so stop waiting for its proposals now.
+            self.peer_ports.discard(peer_id)
+            self.update_overlay()
+        if self.catch_up is not None and self.catch_up.peer_id == peer_id:
+            logger.warning("Peer %s crashed while sending its snapshot.", peer_id)
+            self.catch_up = None
+            if not self.request_snapshot():
+                self.finish_catch_up()
 
-            # Set crash flag.
-            self.round_crash = True
+        # Set crash flag.
+        self.mark_crash()
 
-            # Check if process has now received all values from updated current connections.
-            self.check_end_of_round()
-        else:
-            self.out_connections.remove(connection)
+        # Check if process has now received all values from updated current connections.
+        self.check_end_of_round()
 
-    def listen(self):
-        """Listen to a socket connection for incoming data.
-        There is a thread running per connection which calls to handle data once received.
+    def close_connection(self, connection):
+        """Close a connection, waking any thread blocked reading it.
+
+        Keyword arguments:
+        connection -- socket to close.
+        Return: N/A
+        """
+        # A socket closed while another thread is in recv on it is not closed until that recv returns.
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+
+    def bind(self):
+        """Start listening on the receiving port, and on the other transports.
         
         Return: N/A
         """
-        # Start listening on receiving port.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
         self.socket.listen(10)
-        print(f"Listening for connections on {self.host}:{self.port}")
+        logger.info("Listening for connections on %s:%s", self.host, self.port)
+        if 'unix' in self.transports:
+            # Owning the TCP port means the unix socket's path is free to take over.
+            self.unix_socket = UNIX.listen(self.host, self.port, 10)
+            self.unix_path = UNIX.path(self.port)
+            logger.info("Listening for connections at %s", self.unix_path)
+        self.listening.set()
 
-        while True:
-            # Infinite loop to handle receiving data via a thread per connected peer.
-            connection, address = self.socket.accept()
-            self.connections.append(connection)
-            print(f"Now receiving data from connection: {address}")
-            self.current_accepted_addresses.add(address)
-            threading.Thread(target=self.handle_client, args=(connection, address)).start()
+    def listen(self, listener=None):
+        """Listen to a socket connection for incoming data.
+        There is a thread running per connection which calls to handle data once received.
+        
+        Keyword arguments:
+        listener -- listening socket to accept on, the TCP one by default.
+        Return: N/A
+        """
+        if listener is None:
+            if not self.listening.is_set():
+                self.bind()
+            listener = self.socket
+
+        while not self.stopped.is_set():
+            # Loop to handle receiving data via a thread per connected peer until stopped.
+            try:
+                connection, address = listener.accept()
+            except OSError:
+                break
+            logger.debug("Accepted connection from %s", address)
+            self.adopt(connection)
+
+    def adopt(self, connection):
+        """Serve a connection a peer opened, on a thread of its own.
+        A node that runs several groups accepts their connections and hands
+        each one to its group's process this way.
+
+        Keyword arguments:
+        connection -- socket of the accepted connection.
+        Return: N/A
+        """
+        self.connections.append(connection)
+        # The peer is only known once its hello arrives.
+        threading.Thread(target=self.handle_client, args=(connection, None)).start()
 
     def send_to_all(self, data):
         """Send data to all connections
+        The data is encoded once per codec and the same bytes are queued for
+        every peer using that codec.
         
         Keyword arguments:
-        data -- Encoded data to be sent
+        data -- dict data to be sent
         Return: N/A
         """
-        print(f"Sending {data} to all.")
-        for connection in self.out_connections:
-            try:
-                connection.sendall(self.encode_data(data))
-            except socket.error as e:
-                self.crash_connection(connection)
-                continue
+        logger.debug("Sending %s to all.", data)
+        encoded = dict()  # Dict of codec to the data encoded with it.
+        connections = self.peers.connections()
+        self.count_sent(data, len(connections))
+        for connection in connections:
+            codec = self.codec(connection)
+            if codec not in encoded:
+                encoded[codec] = self.encode_data(data, codec)
+            self.write(encoded[codec], connection)
 
     def send_to_connection(self, data, connection):
         """Send data to a send port.
@@ -166,87 +535,802 @@ class Process:
         connection -- socket to send the data on.
         Return: N/A
         """
-        try:
-            print(f"sending to {connection}")
-            connection.sendall(self.encode_data(data))
-        except socket.error as e:
-            print(f"failed to send {connection}")
-            self.crash_connection(connection)
+        logger.debug("Sending %s to %s.", data, connection)
+        self.count_sent(data)
+        self.write(self.encode_data(data, self.codec(connection)), connection)
 
-    def handle_client(self, connection, address):
-        """Receive and handle incoming data from connected nodes.
+    def count_sent(self, data, count=1):
+        """Count messages sent by their type.
+
+        Keyword arguments:
+        data -- dict message being sent.
+        count -- number of connections it is sent on.
+        Return: N/A
+        """
+        for message_type in data:
+            self.metrics.counter('messages_out.' + message_type).inc(count)
+
+    def write(self, encoded_data, connection):
+        """Queue encoded data on a connection's writer.
+        A peer whose queue is full has stalled and is dropped. A closed
+        writer's connection is already being closed, by stop() or by the
+        writer's own crash report, so the data is dropped without a warning.
         
-        Expected message types:
-            New:      A process requests be added to this process's connections.
-            Ports:    This process has received a list of currently active
-                      peer ports that it needs to exchange connections with.
-            Proposal: Receive a proposal set from a peer process.
-            Decision: Receive a decided value from a peer process.
+        Keyword arguments:
+        encoded_data -- framed bytes to be sent.
+        connection -- socket to send the data on.
+        Return: N/A
+        """
+        self.metrics.counter('bytes_out').inc(len(encoded_data))
+        writer = self.writers.get(connection)
+        if writer is None:
+            if connection is not self.server_connection:
+                # The peer connection has just been closed.
+                return
+            # The server connection has no writer and is written to directly.
+            try:
+                connection.sendall(encoded_data)
+            except socket.error:
+                logger.warning("Failed to send to %s", connection)
+                self.crash_connection(connection)
+            return
+        queued = writer.send(encoded_data)
+        if queued:
+            self.last_sent[connection] = time.monotonic()
+        elif queued is False:
+            logger.warning("Dropping stalled connection %s", connection)
+            self.report_crash(connection)
+
+    def handle_client(self, connection, peer_id):
+        """Receive and handle incoming data from connected nodes.
+        The first message on a peer connection is the peer's hello.
 
         Keyword arguments:
         connection -- socket that is receiving data.
-        address -- tuple host address/port that is receiving data.
+        peer_id -- port of a dialed peer, or None for accepted connections and the server.
         Return: N/A
         """
+        dialed = peer_id is not None
+        decoder = FrameDecoder()
         while True:
             try:
-                # Receive data on connection
-                data = connection.recv(1024)
-                if not data:
+                # Receive all complete frames currently available on connection.
+                frames = decoder.recv(connection)
+                if frames is None:
+                    # The peer closed the connection.
+                    self.report_crash(connection)
                     break
+                if peer_id is not None and self.failure_detector is not None:
+                    # Everything received from a peer shows it is alive, even part of a large message.
+                    self.failure_detector.heartbeat(peer_id)
+                if not frames:
+                    continue
                 
-                data_messages = self.decode_data(data) 
-                print(f"Received data from {address}: {data_messages}")
-
-                for data_message in data_messages:     
-                    message_type = data_message.keys()
-
-                    if 'new' in message_type:
-                        # Connect to new node.
-                        new_port = data_message['new']
-
-                        if new_port != self.port:
-                            # Connect to new peer process.
-                            self.connect("127.0.0.1", new_port)
-
-                    elif 'ports' in message_type:
-                        # Connect to all other peers in the network.
-                        ports = data_message['ports']
-                        for port in ports:
-                            if port != self.port:
-                                # Connect to the new peer and equest to be added to the peer's connections.
-                                new_connection = self.connect("127.0.0.1", port)
-                                self.send_to_connection({'new': self.port}, new_connection)
-                        # Last server communication, remove server from current.
-                        self.current_accepted_addresses.remove(address)
-                        print('Sent connections to all received ports.')
-
-                    elif 'proposal' in message_type:
-                        round_id =  data_message['proposal'][0]
-                        proposal_set = data_message['proposal'][1]
-                        self.receive_proposal(address, round_id, proposal_set)
-
-                    elif 'decision' in message_type:
-                        round_id = data_message['decision'][0]
-                        decided_value = data_message['decision'][1]
-                        if round_id not in self.decided_rounds:
-                            self.decide(force_decision=decided_value, round_id=round_id)
-
-                            # Only end round if receiving a decision for the current round.
-                            if round_id == self.current_round_id:
-                                self.end_round()
+                self.metrics.counter('bytes_in').inc(sum(len(frame) for frame in frames) + HEADER.size * len(frames))
+                data_messages = self.decode_data(frames)
+                logger.debug("Received data from %s: %s", peer_id, data_messages)
 
-            except socket.error:
-                self.crash_connection(connection=connection, address=address)
+                # The actor handles the messages, this thread only needs to know who sent them.
+                for data_message in data_messages:
+                    if 'hello' in data_message and connection not in self.writers:
+                        self.open_writer(connection)
+                self.actor.tell(self.receive_messages, data_messages, connection, peer_id, dialed)
+                for data_message in data_messages:
+                    if 'hello' in data_message:
+                        peer_id = data_message['hello']
+
+            except socket.timeout:
+                # The writer's send timeout also applies to reads, and an idle peer is not a crash.
+                continue
+            except (socket.error, FrameError):
+                self.report_crash(connection)
                 break
 
-    def start(self):
+    def receive_messages(self, data_messages, connection, peer_id, dialed):
+        """Handle the messages decoded from a single read of a connection.
+        The first message on a peer connection is the peer's hello.
+
+        Keyword arguments:
+        data_messages -- list of decoded dict messages, in the order they were received.
+        connection -- connection that received the messages.
+        peer_id -- port of the peer that sent them, or None before its hello and for the server.
+        dialed -- flag for if this process opened the connection.
+        Return: N/A
+        """
+        for data_message in data_messages:
+            started = time.perf_counter() if self.profiling else None
+            if 'hello' in data_message:
+                peer_id = data_message['hello']
+                self.receive_hello(peer_id, connection, dialed, data_message.get('codecs'))
+            elif 'bye' in data_message:
+                self.receive_bye(connection)
+            else:
+                self.handle_message(data_message, connection, peer_id)
+            if started is not None:
+                message_type = next(iter(data_message), 'empty')
+                self.metrics.histogram('handler.' + message_type).observe(time.perf_counter() - started)
+
+    def handle_message(self, data_message, connection, peer_id):
+        """Handle a single decoded message from a connected node.
+        
+        Expected message types:
+            Ports:    This process has received a list of currently active
+                      peer ports that it needs to exchange connections with,
+                      and the endpoints they can be reached at.
+            Joined:   The server reports peers that have joined the network.
+            Left:     The server reports peers that have left the network.
+            Proposal: Receive a proposal set from a peer process.
+            Delta:    Receive only the proposals a peer process has not sent before.
+            Gossip:   Receive a relayed proposal, with the processes whose
+                      proposals it includes that the peer has not sent before.
+            Decision: Receive a decided value from a peer process.
+            Heartbeat: A peer that has sent nothing else for a while is alive,
+                       which handle_client records for every message.
+            Snapshot Request: A joining peer asks for this process's state.
+            Snapshot Chunk: Receive the next chunk of a peer's state while joining.
+            Profile:  An operator on the same host toggles the sampling
+                      profiler, and is told where the profile was dumped if
+                      it was stopped. Only accepted on the unix socket of a
+                      process built with profile_messages=True.
+
+        Keyword arguments:
+        data_message -- decoded dict message.
+        connection -- connection that received the message.
+        peer_id -- port of the peer that sent the message, or None for the server.
+        Return: N/A
+        """
+        message_type = data_message.keys()
+        for key in message_type:
+            self.metrics.counter('messages_in.' + key).inc()
+
+        if 'ports' in message_type:
+            # Connect to all other peers in the network.
+            self.endpoints.update(data_message.get('endpoints', ()))
+            self.peer_ports.update(data_message['ports'])
+            self.join_peers(data_message['ports'])
+            logger.debug("Dialing all received ports.")
+
+        elif 'joined' in message_type:
+            # The new peers open the connections to existing peers, so only record them.
+            self.endpoints.update(data_message.get('endpoints', ()))
+            self.peer_ports.update(data_message['joined'])
+            self.peer_ports.discard(self.port)
+            if self.overlay.relays:
+                self.update_overlay(joined=data_message['joined'])
+
+        elif 'left' in message_type:
+            left = self.peer_ports.intersection(data_message['left'])
+            self.peer_ports.difference_update(left)
+            for port in data_message['left']:
+                self.endpoints.pop(port, None)
+            if self.overlay.relays and left:
+                # Members that are not neighbours are only seen to crash through the server.
+                self.mark_crash()
+                self.update_overlay()
+                self.check_end_of_round()
+
+        elif 'proposal' in message_type:
+            round_id =  data_message['proposal'][0]
+            proposal_set = data_message['proposal'][1]
+            self.receive_proposal(peer_id, round_id, proposal_set)
+
+        elif 'proposal_delta' in message_type:
+            round_id = data_message['proposal_delta'][0]
+            new_proposals = data_message['proposal_delta'][1]
+            self.receive_proposal(peer_id, round_id, new_proposals)
+
+        elif 'gossip' in message_type:
+            round_id, new_proposals, origins = data_message['gossip']
+            self.receive_proposal(peer_id, round_id, new_proposals, origins)
+
+        elif 'decision' in message_type:
+            round_id = data_message['decision'][0]
+            decided_value = data_message['decision'][1]
+            self.receive_decision(round_id, decided_value)
+
+        elif 'snapshot_request' in message_type:
+            self.send_snapshot(connection)
+
+        elif 'snapshot_chunk' in message_type:
+            index, total, chunk = data_message['snapshot_chunk']
+            self.receive_snapshot_chunk(peer_id, index, total, chunk)
+
+        elif 'profile' in message_type:
+            if not self.profile_messages or not self.is_local_connection(connection):
+                # Anyone who can reach the TCP port could otherwise slow the process down and fill its disk.
+                logger.warning("Ignoring profile message from a connection that may not profile process %s.",
+                               self.port)
+                return
+            reply = {'profile_dumped': self.toggle_profiler()}
+            if self.peers.peer_id(connection) is not None:
+                self.send_to_connection(reply, connection)
+            else:
+                self.send_handshake(reply, connection)
+
+    def join_peers(self, ports):
+        """Open a connection to every peer currently in the network that the overlay makes a neighbour.
+        The peers are dialed concurrently on the dialer's threads, so the
+        server's messages keep being handled while the join is in progress.
+        
+        Keyword arguments:
+        ports -- list of int port numbers of the active peers.
+        Return: N/A
+        """
+        ports = [port for port in sorted(self.overlay.neighbours(self.port, ports)) if port not in self.peers]
+        dials = self.dialer.dial_all("127.0.0.1", ports)
+        dials.add_done_callback(lambda dials: self.actor.tell(self.finish_join, dials.result()))
+
+    def finish_join(self, result):
+        """Report which peers were reached once every dial of a join has finished.
+        A process that reached peers catches up with them before the join is complete.
+
+        Keyword arguments:
+        result -- JoinResult of the join.
+        Return: N/A
+        """
+        logger.info("Joined in %.3fs, reached %d peers, unreachable: %s",
+                    result.seconds, len(result.reached), result.unreachable)
+        self.metrics.histogram('join_duration').observe(result.seconds)
+        if result.reached:
+            self.pending_join = result
+            # Without a registered peer yet, add_peer asks the first one to say hello.
+            self.request_snapshot()
+            return
+        self.resolve_join(result)
+
+    def resolve_join(self, result):
+        """Complete the join and let proposals held back while joining use the current round.
+
+        Keyword arguments:
+        result -- JoinResult of the join.
+        Return: N/A
+        """
+        if self.join_result is not None and not self.join_result.done():
+            self.join_result.set_result(result)
+        if self.overlay.relays:
+            # The membership may have changed while joining.
+            self.update_overlay()
+        self.release_proposals()
+
+    def joining(self):
+        """Check if the process is still dialing its peers or catching up with them.
+
+        Return: True until the join is complete.
+        """
+        return self.join_result is not None and not self.join_result.done()
+
+    def start(self, listen=True):
         """Start thread to listen for incoming connections.
+        Binds first, so the process is accepting connections once this returns.
+        
+        Keyword arguments:
+        listen -- flag for if the process accepts its own connections, False
+                  if its node accepts them and adopts them into the process.
+        Return: N/A
+        """
+        self.actor.start()
+        if listen:
+            self.bind()
+            listen_thread = threading.Thread(target=self.listen)
+            listen_thread.start()
+            if self.unix_socket is not None:
+                threading.Thread(target=self.listen, args=(self.unix_socket,)).start()
+        else:
+            self.listening.set()
+        if self.failure_detector is not None:
+            threading.Thread(target=self.monitor_peers, daemon=True).start()
+
+    def stop(self):
+        """Stop the process, closing every connection and waking all waiters.
         
         Return: N/A
         """
-        listen_thread = threading.Thread(target=self.listen)
-        listen_thread.start()
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        logger.info("Stopping process %s...", self.port)
+
+        self.actor.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.batcher is not None:
+            self.batcher.close()
+        if self.log is not None:
+            self.log.close()
+        self.metrics.stop_dump()
+
+        # Shutting sockets down wakes the threads blocked in accept and recv on them.
+        listeners = [listener for listener in (self.socket, self.unix_socket) if listener is not None]
+        for connection in listeners + list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+        if self.unix_path is not None:
+            UNIX.remove(self.unix_path)
+        for writer in list(self.writers.values()):
+            writer.close()
+
+        self.notify_round_change()
+
+    # ******* #
+    # Overlay #
+
+    def update_overlay(self, joined=()):
+        """Connect to the neighbours the overlay wants after a membership
+        change and retire the connections to members it no longer wants.
+        A joining process dials its own neighbours, and of two members that
+        become neighbours the one with the lower port dials, so the same
+        connection is rarely opened from both ends.
+
+        Keyword arguments:
+        joined -- list of ports of the members that have just joined.
+        Return: N/A
+        """
+        if self.joining() or self.stopped.is_set():
+            # A joining process dials its neighbours once its join is complete.
+            return
+        neighbours = self.overlay.neighbours(self.port, self.peer_ports)
+        dial = [port for port in sorted(neighbours)
+                if port > self.port and port not in joined and port not in self.peers and port not in self.dialing]
+        if dial:
+            self.dial_neighbours(dial)
+
+        # Peers that are not members yet have dialed this process ahead of the membership change.
+        for peer_id in list(self.peers):
+            if peer_id in self.peer_ports and peer_id not in neighbours:
+                logger.debug("Retiring connection to peer %s, which is no longer a neighbour", peer_id)
+                connection = self.peers.connection(peer_id)
+                self.peers.remove(connection)
+                if self.failure_detector is not None:
+                    self.failure_detector.remove(peer_id)
+                self.retire_connection(connection)
+
+    def dial_neighbours(self, ports):
+        """Dial new neighbours concurrently on the dialer's threads.
+
+        Keyword arguments:
+        ports -- list of int port numbers to dial.
+        Return: N/A
+        """
+        self.dialing.update(ports)
+        dials = self.dialer.dial_all("127.0.0.1", ports)
+        dials.add_done_callback(lambda dials: self.actor.tell(self.dialing.difference_update, ports))
+
+    def sync_peer(self, connection):
+        """Send a new neighbour what this process knows of the rounds the neighbour may still be running.
+        Relays only go out when a round's received from set grows, so a
+        neighbour connected in the middle of a round would miss what was
+        relayed before. Members are at most a window of rounds apart, as a
+        round only ends once every member has proposed in it.
+
+        Keyword arguments:
+        connection -- connection of the new neighbour.
+        Return: N/A
+        """
+        for round_id in self.rounds.round_ids(self.current_round_id - len(self.open_rounds())):
+            if self.rounds.is_decided(round_id):
+                self.send_to_connection({'decision': (round_id, self.rounds.decision(round_id))}, connection)
+            else:
+                self.gossip_proposal(round_id, full=True, connections=[connection])
+
+    def expected_peers(self):
+        """Get the peers a round needs a proposal from before it can end.
+
+        Return: set-like of peer ports, every member if proposals are relayed, else the connected peers.
+        """
+        if self.overlay.relays:
+            return self.peer_ports
+        return self.peers.ids()
+
+    # ***************** #
+    # Failure Detection #
+
+    def monitor_peers(self):
+        """Check on peers every heartbeat interval until stopped.
+
+        Return: N/A
+        """
+        while not self.stopped.wait(self.heartbeat_interval):
+            self.actor.tell(self.check_peers)
+
+    def check_peers(self):
+        """Send a heartbeat to every peer that has been sent nothing else for a
+        heartbeat interval, then drop the peers the failure detector suspects.
+
+        Return: N/A
+        """
+        now = time.monotonic()
+        heartbeats = dict()  # Dict of codec to the heartbeat encoded with it.
+        for connection in self.peers.connections():
+            if now - self.last_sent.get(connection, 0) >= self.heartbeat_interval:
+                codec = self.codec(connection)
+                if codec not in heartbeats:
+                    heartbeats[codec] = self.encode_data({'heartbeat': self.port}, codec)
+                self.metrics.counter('messages_out.heartbeat').inc()
+                self.write(heartbeats[codec], connection)
+
+        for peer_id in self.failure_detector.suspects(now):
+            self.suspect_peer(peer_id)
+
+    def suspect_peer(self, peer_id):
+        """Treat a peer that has been silent for too long as crashed.
+        Its connection is closed, so the round it stalled ends without a
+        decision, as it would for a peer that closed its connection.
+
+        Keyword arguments:
+        peer_id -- port of the suspected peer.
+        Return: N/A
+        """
+        connection = self.peers.connection(peer_id)
+        if connection is None:
+            self.failure_detector.remove(peer_id)
+            return
+        if self.has_unread_data(connection):
+            # The peer has sent more, this process is just slow to read it.
+            self.failure_detector.heartbeat(peer_id)
+            return
+        self.failure_detector.remove(peer_id)
+        logger.warning("Suspecting peer %s has failed.", peer_id)
+        self.metrics.counter('peers_suspected').inc()
+        self.crash_connection(connection)
+
+    def has_unread_data(self, connection):
+        """Check if data has arrived on a connection that its reader has not read yet.
+
+        Keyword arguments:
+        connection -- peer connection.
+        Return: True if the connection is readable.
+        """
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(connection, selectors.EVENT_READ)
+                return bool(selector.select(0))
+        except (OSError, ValueError):
+            # The connection has been closed.
+            return False
+
+    # ************** #
+    # State Transfer #
+
+    def request_snapshot(self):
+        """Ask a peer for a snapshot of its state, to catch up with it.
+
+        Return: True if a peer was asked, False if no peer is registered.
+        """
+        peer_ids = self.peers.ids()
+        if not peer_ids:
+            return False
+        peer_id = min(peer_ids)
+        logger.info("Requesting state from peer %s.", peer_id)
+        self.catch_up = SnapshotAssembler(peer_id)
+        self.send_to_connection({'snapshot_request': self.port}, self.peers.connection(peer_id))
+        return True
+
+    def snapshot_state(self):
+        """Get the state a joining peer needs to continue from the current round.
+
+        Return: RecoveredState of the open proposals, the retained ended rounds and the current round.
+        """
+        return RecoveredState(self.proposal_set.open_values(), self.rounds.ended_rounds(self.current_round_id),
+                              self.current_round_id)
+
+    def send_snapshot(self, connection):
+        """Stream a snapshot of this process's state to a joining peer.
+        The snapshot is taken on the actor, then encoded and sent on its own
+        thread, so rounds keep running while it is sent.
+
+        Keyword arguments:
+        connection -- connection of the peer that asked for it.
+        Return: N/A
+        """
+        state = self.snapshot_state()
+        threading.Thread(target=self.stream_snapshot, args=(state, connection), daemon=True).start()
+
+    def stream_snapshot(self, state, connection):
+        """Send a snapshot one chunk at a time.
+        Each chunk waits for the one before it to be sent, so a large snapshot
+        neither fills the peer's queue nor holds up messages queued behind it.
+        Only the peer's writer is used, so this can run off the actor.
+
+        Keyword arguments:
+        state -- RecoveredState to send.
+        connection -- peer connection to send it on.
+        Return: N/A
+        """
+        chunks = encode_chunks(state)
+        logger.info("Sending state up to round %s in %d chunks.", state.next_round_id, len(chunks))
+        for index, chunk in enumerate(chunks):
+            writer = self.writers.get(connection)
+            if writer is None:
+                # The peer has crashed.
+                return
+            self.send_to_connection({'snapshot_chunk': (index, len(chunks), chunk)}, connection)
+            writer.flush()
+
+    def receive_snapshot_chunk(self, peer_id, index, total, chunk):
+        """Receive a chunk of the snapshot being caught up from.
+
+        Keyword arguments:
+        peer_id -- port of the peer that sent the chunk.
+        index -- int position of the chunk.
+        total -- int number of chunks in the snapshot.
+        chunk -- str chunk.
+        Return: N/A
+        """
+        if self.catch_up is None or self.catch_up.peer_id != peer_id:
+            # Left over from a snapshot that has been abandoned.
+            return
+        try:
+            state = self.catch_up.add(index, total, chunk)
+        except ValueError as e:
+            logger.warning("Abandoning state transfer: %s", e)
+            self.finish_catch_up()
+            return
+        if state is None:
+            return
+
+        self.metrics.histogram('state_transfer_duration').observe(time.perf_counter() - self.catch_up.started_at)
+        self.metrics.histogram('state_transfer_chunks', SIZE_BOUNDS).observe(total)
+        self.catch_up_to(state)
+        self.finish_catch_up()
+
+    def catch_up_to(self, state):
+        """Continue from a peer's state if it is ahead of this process.
+        The rounds this process missed are taken from the snapshot instead of
+        being run, and rounds decided while the snapshot was on its way are
+        delivered straight away.
+
+        Keyword arguments:
+        state -- RecoveredState of the peer.
+        Return: N/A
+        """
+        if state.next_round_id <= self.current_round_id:
+            return
+        logger.info("Catching up from round %s to round %s.", self.current_round_id, state.next_round_id)
+        # Values the peer no longer has open were decided in rounds this process missed.
+        peer_open = set(map(freeze, state.proposals))
+        for value in self.proposal_set.open_values():
+            if value not in peer_open:
+                self.proposal_set.settle(value)
+        self.consolidate_proposal_sets(state.proposals)
+        self.restore(state)
+        self.release_future_proposals()
+        self.round_crash = False
+        if self.log is not None:
+            for round_id, value in state.rounds:
+                self.log.append_round(round_id, value)
+        self.resume_decided_rounds()
+        self.notify_round_change()
+
+    def resume_decided_rounds(self):
+        """End the rounds from the current one on that were decided while catching up.
+
+        Return: N/A
+        """
+        while self.rounds.is_decided(self.current_round_id) and not self.rounds.is_ended(self.current_round_id):
+            self.end_round()
+
+    def finish_catch_up(self):
+        """Stop catching up and complete the join.
+
+        Return: N/A
+        """
+        self.catch_up = None
+        result, self.pending_join = self.pending_join, None
+        if result is not None:
+            self.resolve_join(result)
+
+    # ******* #
+    # Waiting #
+
+    def notify_round_change(self):
+        """Wake every thread waiting on the current round or a decision.
+        
+        Return: N/A
+        """
+        with self.round_condition:
+            self.round_condition.notify_all()
+
+    def wait_for_round_change(self, round_id, timeout=None):
+        """Block until the current round is no longer round_id.
+        
+        Keyword arguments:
+        round_id -- int ID of the round being waited on.
+        timeout -- optional seconds to wait for.
+        Return: int ID of the new current round, or None on timeout or stop.
+        """
+        with self.round_condition:
+            changed = self.round_condition.wait_for(
+                lambda: self.current_round_id != round_id or self.stopped.is_set(), timeout)
+        if not changed or self.current_round_id == round_id:
+            return None
+        return self.current_round_id
+
+    def wait_for_decision(self, round_id, timeout=None):
+        """Block until a round has been delivered.
+        
+        Keyword arguments:
+        round_id -- int ID of the round being waited on.
+        timeout -- optional seconds to wait for.
+        Return: decided value of the round, or None on timeout, stop or a round ended by a crash.
+        """
+        with self.round_condition:
+            self.round_condition.wait_for(
+                lambda: self.current_round_id > round_id or self.stopped.is_set(), timeout)
+        return self.rounds.decision(round_id)
+
+    def wait_for_join(self, timeout=None):
+        """Block until the peers the server reported when joining have all been dialed.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for.
+        Return: JoinResult, or None if not joined within the timeout.
+        """
+        if self.join_result is None:
+            return None
+        try:
+            return self.join_result.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return None
+
+    def wait_for_shutdown(self, timeout=None):
+        """Block until the process is stopped.
+        
+        Keyword arguments:
+        timeout -- optional seconds to wait for.
+        Return: True if the process has stopped.
+        """
+        return self.stopped.wait(timeout)
+
+    # ********* #
+    # Profiling #
+
+    def set_profiling(self, profiling):
+        """Start or stop recording handler, decode, send and round phase times.
+
+        Keyword arguments:
+        profiling -- flag for if the times are recorded.
+        Return: N/A
+        """
+        self.profiling = profiling
+        writers = list(self.writers.values())
+        send_time = self.send_time() if writers else None
+        for writer in writers:
+            writer.send_time = send_time
+
+    def toggle_profiler(self):
+        """Start the sampling profiler, or stop it and dump what it collected.
+        The detailed times are recorded while it runs, even if the process is not always profiled.
+
+        Return: str path of the dumped stacks if the profiler was stopped and dumped, else None.
+        """
+        if self.profiler is None:
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+            self.set_profiling(True)
+            logger.info("Started profiling process %s.", self.port)
+            return None
+
+        profiler, self.profiler = self.profiler, None
+        profiler.stop()
+        self.set_profiling(self.profile)
+        try:
+            return self.dump_profile(profiler)
+        except OSError:
+            logger.warning("Failed to dump profile of process %s", self.port, exc_info=True)
+            return None
+
+    def dump_profile(self, profiler):
+        """Write a stopped profiler's stacks to the profile directory, with a
+        snapshot of the metrics, and so the recorded times, next to them.
+
+        Keyword arguments:
+        profiler -- stopped SamplingProfiler.
+        Return: str path of the stacks, whose snapshot has the same path with a .json suffix instead.
+        """
+        name = f"profile-{self.port}-{int(time.time() * 1000)}"
+        path = os.path.join(self.profile_dir, name + '.folded')
+        profiler.dump(path)
+        with open(os.path.join(self.profile_dir, name + '.json'), 'w') as f:
+            json.dump(self.metrics.snapshot(), f)
+        logger.info("Dumped %s samples of process %s to %s", profiler.sample_count, self.port, path)
+        return path
+
+    def is_local_connection(self, connection):
+        """Check if a connection was made over the unix socket, so from the same host.
+
+        Keyword arguments:
+        connection -- socket of the connection.
+        Return: True if the connection is over a Unix domain socket.
+        """
+        return is_local(connection)
+
+    def handle_profile_signal(self, signum, frame):
+        """Toggle the sampling profiler from a signal handler, e.g. for SIGUSR1.
+        Signal handlers run on the main thread, which may be in the middle of
+        changing the protocol state or waiting for the actor, so the toggle is
+        handed to the actor from another thread.
+
+        Keyword arguments:
+        signum -- number of the signal.
+        frame -- interrupted stack frame.
+        Return: N/A
+        """
+        threading.Thread(target=self.execute, args=(self.toggle_profiler,), daemon=True).start()
+
+    # ************** #
+    # Client Batching #
+
+    def submit(self, value):
+        """Submit a value to be ordered by consensus.
+        Submitted values are batched, and each batch is proposed as a single
+        value in the next round this process has not proposed in.
+        
+        Keyword arguments:
+        value -- value to be proposed.
+        Return: Future that resolves with the decided value of its round.
+        """
+        if self.batcher is None:
+            self.execute(self.open_batcher)
+        return self.batcher.submit(value)
+
+    def open_batcher(self):
+        """Start the batcher, unless an earlier submit already has.
+
+        Return: N/A
+        """
+        if self.batcher is None:
+            self.batcher = Batcher(self, self.batch_size, self.batch_delay)
+
+    def release_proposals(self):
+        """Retry proposals that were held back because no round was free.
+
+        Return: N/A
+        """
+        if self.batcher is not None:
+            self.batcher.round_freed()
+
+    def schedule(self, delay, function, *args):
+        """Run a function against the protocol state on the actor once a delay has passed.
+
+        Keyword arguments:
+        delay -- seconds to wait.
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        self.actor.tell_later(delay, function, *args)
+
+    def dispatch(self, function, *args):
+        """Run a function against the protocol state on the actor from any thread, without waiting for it.
+
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: N/A
+        """
+        self.actor.tell(function, *args)
+
+    def execute(self, function, *args):
+        """Run a function against the protocol state on the actor and return its result.
+        
+        Keyword arguments:
+        function -- callable to run.
+        args -- arguments for function.
+        Return: result of function.
+        """
+        return self.actor.ask(function, *args)
+
+    def next_free_round(self):
+        """Get the round a new proposal would be made in.
+        
+        Return: int round ID, or None if this process already proposed in the current round or is joining.
+        """
+        if self.joining() or self.rounds.has_proposed(self.current_round_id):
+            return None
+        return self.current_round_id
 
     # ****************** #
     # Flooding Algorithm #
@@ -254,20 +1338,26 @@ class Process:
     def propose(self, value):
         """ Propose a user input value. 
         Add value to proposal set and broadcast to all connected nodes.
+        Proposals from other threads, e.g. the main thread, wait for the actor to make them.
         
         Keyword arguments:
         value -- user entered value
-        Return: N/A
+        Return: int ID of the round proposed in.
         """
+        if not self.actor.is_current():
+            return self.actor.ask(self.propose, value)
+        round_id = self.current_round_id
+
         # Add value to proposal set. 
         self.consolidate_proposal_sets([value])
-        self.proposed_for_round[self.current_round_id] = True
+        self.rounds.set_proposed(round_id)
 
         # Broadcast proposal set to all peers.
-        self.send_to_all({'proposal': (self.current_round_id, self.proposal_set)}) 
+        self.broadcast_proposal(round_id)
         
         # Check if this was the last value needed for the round.
         self.check_end_of_round()
+        return round_id
 
     def decide(self, round_id, force_decision=None):
         """Decide on a value.
@@ -276,26 +1366,146 @@ class Process:
         
         Return: N/A
         """
-        print(f"Starting decision for round {round_id}...")
+        logger.debug("Starting decision for round %s...", round_id)
         # Don't need to decide if round was already decided on.
-        if round_id in self.decided_rounds:
-            print(f"Has already decided for round {round_id}.")
+        if self.rounds.is_decided(round_id):
+            logger.debug("Has already decided for round %s.", round_id)
             return
-        self.decided_rounds.append(round_id)
 
-        if force_decision:
+        if force_decision is not None:
             # Force decision if a decision has been received from another process for this round.
+            force_decision = freeze(force_decision)
             self.consolidate_proposal_sets([force_decision])
             val = force_decision
         else:
-            # Set decided val to largest val in list.
-            val = max(self.proposal_set)
-      
-        
-        print(f'** Process has decided on value {val} for round {round_id}.**\n')
+            # Set decided val to largest val no earlier round has decided, as the proposal set spans every round.
+            val = self.proposal_set.max_open()
+            if val is None:
+                # Every value was decided before, e.g. one was proposed again, so the round decides nothing.
+                logger.debug("Nothing new to decide in round %s.", round_id)
+                return
+        self.proposal_set.settle(val)
+        self.rounds.set_decided(round_id, val)
+        self.observe_decision(round_id)
+        self.observe_phase(round_id, 'decide')
+        logger.info("Process has decided on value %r for round %s.", val, round_id)
 
         # Broadcast decision to all peers.
-        self.send_to_all({'decision': (self.current_round_id, val)})
+        self.send_to_all({'decision': (round_id, val)})
+        self.observe_phase(round_id, 'broadcast')
+
+    def observe_decision(self, round_id):
+        """Record the time from this process proposing in a round to the round being decided.
+
+        Keyword arguments:
+        round_id -- int ID of the decided round.
+        Return: N/A
+        """
+        record = self.rounds.get(round_id)
+        if record is not None and record.proposed_at is not None:
+            self.metrics.histogram('decision_latency').observe(time.perf_counter() - record.proposed_at)
+
+    def observe_round_end(self, round_id):
+        """Record the time from a round's first proposal being seen to the round ending.
+
+        Keyword arguments:
+        round_id -- int ID of the ended round.
+        Return: N/A
+        """
+        record = self.rounds.get(round_id)
+        if record is not None:
+            self.metrics.histogram('round_duration').observe(time.perf_counter() - record.opened_at)
+
+    def observe_phase(self, round_id, phase):
+        """Record the time from a round's previous phase, or its first proposal being seen, to a phase, while profiling.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        phase -- name of the phase the round has reached.
+        Return: N/A
+        """
+        if not self.profiling:
+            return
+        record = self.rounds.get(round_id)
+        if record is None:
+            return
+        now = time.perf_counter()
+        self.metrics.histogram('round.' + phase).observe(now - (record.phase_at or record.opened_at))
+        record.phase_at = now
+
+    def receive_decision(self, round_id, decided_value):
+        """Receive a decided value from a connected node.
+        
+        Keyword arguments:
+        round_id -- int ID of the decided round.
+        decided_value -- value decided by the peer.
+        Return: N/A
+        """
+        if not self.rounds.is_decided(round_id):
+            self.decide(force_decision=decided_value, round_id=round_id)
+
+            # Only end round if receiving a decision for the current round.
+            if round_id == self.current_round_id:
+                self.end_round()
+
+    def mark_crash(self):
+        """Record that a peer crashed during the current round.
+        
+        Return: N/A
+        """
+        self.round_crash = True
+
+    def deliver(self, round_id):
+        """Hand an ended round's outcome to the decision listeners.
+        Rounds are delivered in round order. Rounds that ended because of a
+        crash are delivered with a value of None. With a decision log, the
+        listeners are only called once the round's record is durable.
+        
+        Keyword arguments:
+        round_id -- int ID of the ended round.
+        Return: N/A
+        """
+        value = self.rounds.decision(round_id)
+        if self.log is None:
+            self.notify_listeners(round_id, value)
+            return
+        # Listeners may act on an outcome, e.g. resolve a client's future, so they only hear of it once it is on
+        # disk. The log's writer hands it back once fsynced, so this thread does not wait on the disk.
+        sequence = self.log.append_round(round_id, value)
+        self.log.when_durable(sequence, self.dispatch, self.notify_listeners, round_id, value)
+
+    def notify_listeners(self, round_id, value):
+        """Hand a delivered round's outcome to the decision listeners.
+
+        Keyword arguments:
+        round_id -- int ID of the delivered round.
+        value -- decided value, or None if the round ended because of a crash.
+        Return: N/A
+        """
+        for listener in self.decision_listeners:
+            listener(round_id, value)
+        self.observe_phase(round_id, 'deliver')
+
+    def restore(self, state):
+        """Resume from the state recovered from the decision log or sent by a peer.
+        The process continues at the round after the last one delivered,
+        and the retained rounds keep their outcomes for late messages and waiters.
+
+        Keyword arguments:
+        state -- RecoveredState of the log or the peer.
+        Return: N/A
+        """
+        self.rounds.settle(state.rounds[0][0] if state.rounds else state.next_round_id)
+        for round_id, value in state.rounds:
+            if value is not None:
+                value = freeze(value)
+                # Late proposals for the retained rounds must not reopen their decided values.
+                self.proposal_set.add([value])
+                self.proposal_set.settle(value)
+                self.rounds.set_decided(round_id, value)
+            self.rounds.set_ended(round_id)
+        self.proposal_set.add(state.proposals)
+        self.current_round_id = state.next_round_id
 
     def check_end_of_round(self):
         """Determine if the process has reached the end of the currenet round.
@@ -303,64 +1513,72 @@ class Process:
         
         Return: N/A
         """
-        self.lock.acquire()
-
-        try:
-            # Check if the process has received all possible values from the current connections.
-            print(f"Checking end of round {self.current_round_id}...")
-            received_all_possible = False
+        # Check if the process has received all possible values from the current connections.
+        logger.debug("Checking end of round %s...", self.current_round_id)
+        received_all_possible = False
             
             
-            if self.current_round_id in self.received_from.keys():
+        # Get set of peers that the process has received proposals from.
+        received_from_peers = self.rounds.received_from(self.current_round_id)
 
-                
-                # Get list of addresses that the process has received proposals from.
-                received_from_addresses = self.received_from[self.current_round_id]
+        if received_from_peers is not None:
 
-                # Determine if the process has proposed a value for the round.
-                has_proposed = self.proposed_for_round[self.current_round_id] if self.current_round_id in self.proposed_for_round.keys() else False
+            # Determine if the process has proposed a value for the round.
+            has_proposed = self.rounds.has_proposed(self.current_round_id)
 
-                # Check if process has received all possible proposals from self and  peer processes. Add one for server connection.
-                received_all_possible = self.current_accepted_addresses.issubset(received_from_addresses) and has_proposed
+            # Check if process has received all possible proposals from self and peer processes.
+            received_all_possible = self.expected_peers() <= received_from_peers and has_proposed
 
-            if received_all_possible:
-                # End the round.
-                if not self.round_crash:
-                    # Only decide on a value if there have been no crashes in the current round.
-                    self.decide(round_id=self.current_round_id)
+        if received_all_possible:
+            self.observe_phase(self.current_round_id, 'collect')
+            # End the round.
+            if not self.round_crash:
+                # Only decide on a value if there have been no crashes in the current round.
+                self.decide(round_id=self.current_round_id)
                     
-                self.end_round()
-            else:
-                print("Round should not end.")
-        finally:
-            self.lock.release()
+            self.end_round()
+        else:
+            logger.debug("Round should not end.")
 
     def end_round(self):
         """End the current round and reset for the next round.
         
         Return: N/A
         """
-        if self.current_round_id in self.ended_rounds:
-            print("Already ended round.")
+        if self.rounds.is_ended(self.current_round_id):
+            logger.debug("Already ended round.")
             return
         
-        self.ended_rounds.append(self.current_round_id)
-        print(f"Ending round {self.current_round_id}...\n")
+        self.rounds.set_ended(self.current_round_id)
+        self.observe_round_end(self.current_round_id)
+        logger.debug("Ending round %s...", self.current_round_id)
+        self.deliver(self.current_round_id)
 
-        # Increment the round ID and reset the round's initial connections.
+        # Increment the round ID.
         self.current_round_id += 1 
-        self.initial_accepted_addresses = self.current_accepted_addresses
+        self.release_future_proposals()
 
         # Needs chance to decide again this round if there were crashes in previous round.
         if self.round_crash:
-            self.proposed_for_round[self.current_round_id] = True
-            # Broadcast proposal set to all peers for past round in case of crash.
-            self.send_to_all({'proposal': (self.current_round_id, self.proposal_set)}) 
+            self.rounds.set_proposed(self.current_round_id)
+            # Broadcast full proposal set to all peers for past round in case of crash.
+            self.broadcast_proposal(self.current_round_id, full=True)
         else:
-            self.proposed_for_round[self.current_round_id] = False
+            self.rounds.set_proposed(self.current_round_id, False)
 
         self.round_crash = False
-        print(f"Starting new round {self.current_round_id}\n****************")
+        self.rounds.evict(self.current_round_id)
+        logger.info("Starting new round %s", self.current_round_id)
+        self.notify_round_change()
+
+    def release_future_proposals(self):
+        """Add the values held back for the rounds this process has now reached to its proposal set.
+
+        Return: N/A
+        """
+        for round_id in sorted(self.future_proposals):
+            if round_id <= self.current_round_id:
+                self.consolidate_proposal_sets(self.future_proposals.pop(round_id))
 
     def consolidate_proposal_sets(self, proposal_set):
         """Add a proposal to this process's proposal set.
@@ -369,27 +1587,192 @@ class Process:
         proposal_set -- list of proposal(s) that need to be added to the process proposal set.
         Return: N/A
         """
-        self.proposal_set = sorted(list(set(self.proposal_set) | set(proposal_set)))
-        print(f"Updated Set: {self.proposal_set}")
+        new_values = self.proposal_set.add(proposal_set)
+        if new_values:
+            logger.debug("Updated Set: %s", self.proposal_set)
+            if self.log is not None:
+                self.log.append_proposals(new_values)
+
+    def broadcast_proposal(self, round_id, full=False):
+        """Broadcast this process's proposals for a round to all peers.
+        In delta mode each peer is only sent the values added since the last
+        proposal sent on its connection. TCP delivers in order, so those have
+        all been received unless the connection crashed, in which case the
+        peer is dropped and a new connection starts again from nothing.
+        
+        Keyword arguments:
+        round_id -- int ID of the round being proposed for.
+        full -- flag to send the whole proposal set, e.g. to resync after a crash.
+        Return: N/A
+        """
+        if self.overlay.relays:
+            self.gossip_proposal(round_id, full)
+            return
+
+        if not self.delta or full:
+            version = self.proposal_set.version
+            self.send_to_all({'proposal': (round_id, self.proposal_set.open_values())})
+            for connection in self.peers.connections():
+                self.sent_versions[connection] = version
+            return
+
+        # Peers at the same high-water mark using the same codec share one encoded delta.
+        version = self.proposal_set.version
+        encoded_deltas = dict()
+        for connection in self.peers.connections():
+            sent_version = self.sent_versions.get(connection)
+            self.sent_versions[connection] = version
+            key = (sent_version, self.codec(connection))
+            if key not in encoded_deltas:
+                new_proposals = self.unsent_since(sent_version, version)
+                encoded_deltas[key] = self.encode_data({'proposal_delta': (round_id, new_proposals)}, key[1])
+            self.metrics.counter('messages_out.proposal_delta').inc()
+            self.write(encoded_deltas[key], connection)
+
+    def gossip_proposal(self, round_id, full=False, connections=None):
+        """Send a round's proposal to every neighbour that is missing some of the processes it includes.
+        A neighbour is only sent the processes it has not sent to or been
+        sent by this process in the round, with the proposals added since the
+        last proposal sent on its connection, so each process crosses each
+        connection at most once per round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        full -- flag to send the whole proposal set, e.g. to resync after a crash.
+        connections -- optional list of the neighbour connections to send to, every neighbour by default.
+        Return: N/A
+        """
+        record = self.rounds.get(round_id)
+        if record is None:
+            return
+        origins = set(record.received_from)
+        if record.proposed:
+            origins.add(self.port)
+        for connection in self.peers.connections() if connections is None else connections:
+            relayed = self.relayed_origins(record, connection)
+            new_origins = origins - relayed
+            if not new_origins and not full:
+                continue
+            relayed.update(new_origins)
+            self.send_to_connection(
+                {'gossip': (round_id, self.unsent_proposals(round_id, connection, full), sorted(new_origins))},
+                connection)
+
+    def relayed_origins(self, record, connection):
+        """Get the processes a neighbour is known to have the proposals of in a round.
+
+        Keyword arguments:
+        record -- RoundRecord of the round.
+        connection -- connection of the neighbour.
+        Return: live set of ports.
+        """
+        if record.relayed is None:
+            record.relayed = dict()
+        return record.relayed.setdefault(connection, set())
+
+    def unsent_proposals(self, round_id, connection, full=False):
+        """Get the proposals a neighbour has not been sent yet.
+        TCP delivers in order, so everything sent on a connection before has
+        been received unless it crashed, and a new connection starts again
+        from nothing.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        connection -- connection of the neighbour.
+        full -- flag to get the whole proposal set.
+        Return: list of proposed values.
+        """
+        version = self.proposal_set.version
+        sent_version = None if full else self.sent_versions.get(connection)
+        self.sent_versions[connection] = version
+        return self.unsent_since(sent_version, version)
+
+    def unsent_since(self, sent_version, version):
+        """Get the proposals added between two versions of the proposal set.
+        A connection that has been sent nothing yet only needs the open values,
+        as every other value has been decided and is settled.
+
+        Keyword arguments:
+        sent_version -- version already sent, or None if nothing has been sent.
+        version -- current version.
+        Return: list of proposed values.
+        """
+        if sent_version is None:
+            return self.proposal_set.open_values()
+        return self.proposal_set.since(sent_version, version)
+
+    def open_rounds(self):
+        """Get the IDs of the rounds that are running.
+
+        Return: range of int round IDs, the current round.
+        """
+        return range(self.current_round_id, self.current_round_id + 1)
+
+    def relay_proposals(self):
+        """Relay the proposals of the rounds whose received from sets have grown to the neighbours.
+        A decided round is not relayed, as its decision ends it everywhere.
+
+        Return: N/A
+        """
+        for round_id in sorted(self.relay_rounds):
+            # A round whose values are held back is relayed once this process proposes in it.
+            if not self.rounds.is_decided(round_id) and round_id not in self.future_proposals:
+                self.gossip_proposal(round_id)
+        self.relay_rounds.clear()
+
+    def receive_origins(self, peer_id, round_id, origins):
+        """Record the processes whose proposals a relayed proposal includes.
+        Processes this one has not heard of in the round yet are relayed on
+        together with those that arrive within the relay delay.
+
+        Keyword arguments:
+        peer_id -- port of the neighbour that relayed the proposal.
+        round_id -- int ID of the round.
+        origins -- list of ports of the processes whose proposals it includes.
+        Return: N/A
+        """
+        record = self.rounds.record(round_id)
+        if record is None:
+            return
+        received = len(record.received_from)
+        record.received_from.update(origins)
+        record.received_from.discard(self.port)
+        if len(record.received_from) > received:
+            if not self.relay_rounds:
+                # Origins trickle in, so relaying each one at once would send a proposal per origin per neighbour.
+                self.schedule(self.relay_delay, self.relay_proposals)
+            self.relay_rounds.add(round_id)
+        # The neighbour has the proposals of every process it sent, so they are not sent back to it.
+        connection = self.peers.connection(peer_id)
+        if connection is not None:
+            self.relayed_origins(record, connection).update(origins)
 
-    def receive_proposal(self, address, round_id, proposal_set):
+    def receive_proposal(self, peer_id, round_id, proposal_set, origins=None):
         """ Receive a proposal from a connected node.
         Record that a value has been received from a node during a specified round.
         
         Keyword arguments:
-        address --  tuple host address/port for recieving proposal data.
+        peer_id -- port of the peer that sent the proposal.
         round_id -- int ID of the round in which the value was proposed.
         proposed_set -- list of set including updated proposed value.
+        origins -- list of ports of the processes whose proposals a relayed proposal includes.
         Return: N/A
         """
-        if round_id in self.received_from.keys():
-            # If round_id has already been received, add address to that round.
-            self.received_from[round_id].add(address)
+        # Add the peer to the round's received from set. Rounds that have already been evicted are ignored.
+        if origins is None:
+            self.rounds.add_received(round_id, peer_id)
         else:
-            # If round has not yet been received from, initialize round ID as key and add address.
-            self.received_from[round_id] = {address}
+            self.receive_origins(peer_id, round_id, origins)
+
+        # A peer has started a round this process has not proposed in, so send any batched values now.
+        if self.batcher is not None and not self.rounds.has_proposed(round_id):
+            self.batcher.round_opened()
 
         # Update self proposal set and check if it was the last possible recieved to conclude the round.
-        self.consolidate_proposal_sets(proposal_set)
+        if round_id > self.current_round_id:
+            # A later round's values only count once this process reaches it, so every process decides a round
+            # over the same values as the others.
+            self.future_proposals.setdefault(round_id, []).extend(proposal_set)
+        else:
+            self.consolidate_proposal_sets(proposal_set)
         self.check_end_of_round()
-        
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""Profiler
+
+Sampling profiler that can be started and stopped on a running process. A
+thread wakes up every interval, walks the stack of every other thread and
+counts each stack it sees, so it costs nothing while stopped and little while
+running, and shows where time goes on connection, writer and actor threads
+alike. The counts are written in the collapsed stack format, one line of
+semicolon separated frames and a count per stack, which flame graph tools read.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.005  # Seconds between samples.
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()  # Counter of collapsed stacks, outermost frame first.
+        self.sample_count = 0   # Number of times the threads were sampled.
+        self.started_at = None  # time.monotonic() time the profiler was started at.
+        self.stopped_at = None  # time.monotonic() time the profiler was stopped at.
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start sampling on the profiler's own thread.
+
+        Return: N/A
+        """
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the last sample to be counted.
+
+        Return: N/A
+        """
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.stopped_at = time.monotonic()
+
+    def run(self):
+        """Sample every interval until stopped.
+
+        Return: N/A
+        """
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Count the current stack of every thread except the profiler's own.
+
+        Return: N/A
+        """
+        own_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(frames))] += 1
+        self.sample_count += 1
+
+    def dump(self, path):
+        """Write the counted stacks to a file in the collapsed stack format, most frequent first.
+
+        Keyword arguments:
+        path -- file to write.
+        Return: N/A
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
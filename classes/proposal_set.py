@@ -0,0 +1,132 @@
+"""ProposalSet
+
+Set of proposed values that keeps a hash set for membership, an incrementally
+maintained ordered index for iteration in sorted order, and an append-only log
+of the order values were first seen. Merging k new values only has to look up
+and insert those k values, the decision value is read from the end of an
+ordered index of the values no round has decided yet, and senders can cheaply
+iterate every value added since a version they have already sent.
+"""
+
+import bisect
+
+# Merges larger than this re-sort once instead of inserting value by value.
+INSERT_THRESHOLD = 16
+
+
+def freeze(value):
+    """Convert lists decoded from a message back into hashable tuples.
+
+    Keyword arguments:
+    value -- proposed value, e.g. a batch of submitted values.
+    Return: hashable version of value.
+    """
+    if type(value) is list:
+        return tuple(freeze(i) for i in value)
+    return value
+
+
+class ProposalSet:
+    def __init__(self, values=()):
+        self.values = set()  # Set of all proposed values for O(1) membership.
+        self.ordered = []    # List of all proposed values in sorted order.
+        self.log = []        # List of all proposed values in the order they were first seen.
+        self.open = []       # List of the proposed values no round has decided yet, in sorted order.
+        self.add(values)
+
+    def add(self, values):
+        """Merge proposed values into the set.
+
+        Keyword arguments:
+        values -- iterable of proposed values.
+        Return: list of the values that were not already in the set.
+        """
+        new_values = []
+        for value in values:
+            value = freeze(value)
+            if value not in self.values:
+                self.values.add(value)
+                new_values.append(value)
+
+        for index in (self.ordered, self.open):
+            if len(new_values) > INSERT_THRESHOLD:
+                # The index is already sorted, so a single sort merges the new run in linear time.
+                index.extend(new_values)
+                index.sort()
+            else:
+                for value in new_values:
+                    bisect.insort(index, value)
+
+        self.log.extend(new_values)
+        return new_values
+
+    def max(self):
+        """Get the largest proposed value.
+
+        Return: largest value in the set.
+        """
+        if not self.ordered:
+            raise ValueError("max() of an empty ProposalSet")
+        return self.ordered[-1]
+
+    def max_open(self):
+        """Get the largest proposed value that no round has decided yet.
+
+        Return: largest open value, or None if every value has been decided.
+        """
+        return self.open[-1] if self.open else None
+
+    def settle(self, value):
+        """Record that a round has decided a value, so later rounds do not decide it again.
+        The value stays in the set, so a peer resending it does not reopen it.
+
+        Keyword arguments:
+        value -- decided value.
+        Return: N/A
+        """
+        index = bisect.bisect_left(self.open, value)
+        if index < len(self.open) and self.open[index] == value:
+            del self.open[index]
+
+    @property
+    def version(self):
+        """Number of values ever added, used as a high-water mark by senders."""
+        return len(self.log)
+
+    def since(self, version, until=None):
+        """Get the values added after a version.
+        Slicing the log only copies those values, so a delta costs O(delta) however long the history is.
+
+        Keyword arguments:
+        version -- version the reader has already seen.
+        until -- optional version to stop at.
+        Return: list of the values in the order they were added.
+        """
+        return self.log[version:until]
+
+    def open_values(self):
+        """Get the values no round has decided yet in sorted order, e.g. to send as a full proposal set.
+        Decided values are settled, so they never need to be sent again.
+
+        Return: list of open proposed values.
+        """
+        return list(self.open)
+
+    def to_list(self):
+        """Get all values in sorted order, e.g. to send as a full proposal set.
+
+        Return: list of proposed values.
+        """
+        return list(self.ordered)
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f"ProposalSet({self.ordered!r})"
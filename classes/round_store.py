@@ -0,0 +1,224 @@
+"""RoundStore
+
+Bounded store of per-round flooding state. Each round is a compact record in
+a dict keyed by round ID, so membership checks are O(1), and rounds older than
+a retention window are evicted once they have ended. Evicted rounds are
+summarised by a watermark: every round at or below it is settled, so it is
+reported as decided and ended and late messages for it are ignored.
+"""
+
+import time
+
+
+class RoundRecord:
+    """State of a single round."""
+
+    __slots__ = ('round_id', 'received_from', 'proposed', 'decided', 'ended', 'value', 'proposal_set', 'crash',
+                 'relayed', 'opened_at', 'proposed_at', 'phase_at')
+
+    def __init__(self, round_id):
+        self.round_id = round_id    # ID of the round.
+        self.received_from = set()  # Set of peers that proposals have been received from.
+        self.proposed = False       # Flag for if this process proposed in the round.
+        self.decided = False        # Flag for if the round has been decided.
+        self.ended = False          # Flag for if the round has been ended.
+        self.value = None           # Decided value of the round.
+        self.proposal_set = None    # ProposalSet of the round when rounds run as separate instances.
+        self.crash = False          # Flag for if a peer crashed while the round was open.
+        self.relayed = None         # Dict of neighbour connection to the processes it has the proposals of,
+                                    # when proposals are relayed.
+        self.opened_at = time.perf_counter()  # Time the round was first seen, for metrics.
+        self.proposed_at = None     # Time this process proposed in the round, for metrics.
+        self.phase_at = None        # Time the round reached its last phase, when the process is profiled.
+
+
+class RoundStore:
+    def __init__(self, retention=128):
+        self.rounds = dict()        # Dict of round ID to RoundRecord.
+        self.retention = retention  # Number of ended rounds kept before eviction, or None to keep all.
+        self.watermark = -1         # Every round at or below this ID has been evicted as settled.
+
+    def get(self, round_id):
+        """Get the record of a round without creating it.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: RoundRecord, or None if the round is unknown or evicted.
+        """
+        return self.rounds.get(round_id)
+
+    def record(self, round_id):
+        """Get the record of a round, creating it if needed.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: RoundRecord, or None if the round has already been evicted.
+        """
+        record = self.rounds.get(round_id)
+        if record is None:
+            if round_id <= self.watermark:
+                return None
+            record = self.rounds[round_id] = RoundRecord(round_id)
+        return record
+
+    def is_evicted(self, round_id):
+        """Check if a round is at or below the eviction watermark.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: True if the round has been evicted.
+        """
+        return round_id <= self.watermark
+
+    def add_received(self, round_id, peer_id):
+        """Record that a proposal was received from a peer in a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        peer_id -- peer the proposal was received from.
+        Return: N/A
+        """
+        record = self.record(round_id)
+        if record is not None:
+            record.received_from.add(peer_id)
+
+    def received_from(self, round_id):
+        """Get the peers that proposals were received from in a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: set of peers, or None if nothing was received.
+        """
+        record = self.rounds.get(round_id)
+        return record.received_from if record is not None and record.received_from else None
+
+    def has_proposed(self, round_id):
+        """Check if this process proposed in a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: True if proposed, or if the round has been evicted.
+        """
+        record = self.rounds.get(round_id)
+        return record.proposed if record is not None else round_id <= self.watermark
+
+    def set_proposed(self, round_id, proposed=True):
+        """Set the flag for if this process proposed in a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        proposed -- flag value.
+        Return: N/A
+        """
+        record = self.record(round_id)
+        if record is not None:
+            record.proposed = proposed
+            record.proposed_at = time.perf_counter() if proposed else None
+
+    def is_decided(self, round_id):
+        """Check if a round has been decided.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: True if decided, or if the round has been evicted.
+        """
+        record = self.rounds.get(round_id)
+        return record.decided if record is not None else round_id <= self.watermark
+
+    def set_decided(self, round_id, value):
+        """Record the decided value of a round.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        value -- decided value.
+        Return: N/A
+        """
+        record = self.record(round_id)
+        if record is not None:
+            record.decided = True
+            record.value = value
+
+    def decision(self, round_id):
+        """Get the decided value of a round that is still retained.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: decided value, or None if undecided or evicted.
+        """
+        record = self.rounds.get(round_id)
+        return record.value if record is not None else None
+
+    def is_ended(self, round_id):
+        """Check if a round has been ended.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: True if ended, or if the round has been evicted.
+        """
+        record = self.rounds.get(round_id)
+        return record.ended if record is not None else round_id <= self.watermark
+
+    def set_ended(self, round_id):
+        """Mark a round as ended.
+
+        Keyword arguments:
+        round_id -- int ID of the round.
+        Return: N/A
+        """
+        record = self.record(round_id)
+        if record is not None:
+            record.ended = True
+
+    def ended_rounds(self, round_id):
+        """Get the outcomes of the retained rounds that ended before a round.
+
+        Keyword arguments:
+        round_id -- int ID of the first round to leave out.
+        Return: list of (round ID, decided value or None), in round order.
+        """
+        return [(i, self.rounds[i].value) for i in sorted(self.rounds) if i < round_id and self.rounds[i].ended]
+
+    def round_ids(self, round_id):
+        """Get the IDs of the retained rounds from a round on.
+
+        Keyword arguments:
+        round_id -- int ID of the first round to include.
+        Return: list of int round IDs, in round order.
+        """
+        return sorted(i for i in self.rounds if i >= round_id)
+
+    def settle(self, round_id):
+        """Mark every round before a round as settled without keeping records for them,
+        e.g. rounds older than the history restored from a log.
+
+        Keyword arguments:
+        round_id -- int ID of the first round that is not settled.
+        Return: N/A
+        """
+        for settled_round_id in [i for i in self.rounds if i < round_id]:
+            del self.rounds[settled_round_id]
+        self.watermark = max(self.watermark, round_id - 1)
+
+    def evict(self, current_round_id):
+        """Evict ended rounds that have fallen out of the retention window.
+
+        Keyword arguments:
+        current_round_id -- int ID of the current round.
+        Return: N/A
+        """
+        if self.retention is None:
+            return
+        limit = current_round_id - self.retention
+        while self.watermark < limit:
+            record = self.rounds.get(self.watermark + 1)
+            if record is not None and not record.ended:
+                # Keep unfinished rounds until they end.
+                return
+            self.rounds.pop(self.watermark + 1, None)
+            self.watermark += 1
+
+    def __contains__(self, round_id):
+        return round_id in self.rounds or round_id <= self.watermark
+
+    def __len__(self):
+        return len(self.rounds)
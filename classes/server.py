@@ -1,142 +1,403 @@
+import asyncio
 import socket
+import selectors
 import threading
-import json 
+import logging
+
+from .codec import DEFAULT_CODECS, JSON, decode_payload, negotiate
+from .framing import HEADER, encode_frame, FrameDecoder, FrameError
+from .membership import Membership
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+class Client:
+    """State of a single connection accepted by the server."""
+
+    __slots__ = ('connection', 'address', 'decoder', 'outbound', 'writing', 'port', 'codec', 'group', 'endpoint')
+
+    def __init__(self, connection, address):
+        self.connection = connection  # Non-blocking socket of the client.
+        self.address = address        # Address of the sending socket.
+        self.decoder = FrameDecoder(buffer_size=4096)  # Receive buffer.
+        self.outbound = bytearray()   # Encoded data waiting to be sent.
+        self.writing = False          # Flag for if the selector waits for the socket to be writable.
+        self.port = None              # Listening port once the client has joined.
+        self.codec = JSON             # Codec messages to the client are sent with, negotiated when it joins.
+        self.group = None             # ID of the consensus group the client joined, or None for the default group.
+        self.endpoint = None          # Dict of the transports the client can be reached over, once it has joined.
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, codecs=DEFAULT_CODECS):
         self.host = host  # Host address.
         self.port = port  # Port number for connection.
+        self.codecs = list(codecs)  # Names of the codecs the server sends with, most preferred first.
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # TCP Socket.
-        self.connections = []  # List of sockets for In and Out connections.
-        self.out = []  # List of only Out connections.
+        self.selector = selectors.DefaultSelector()  # Multiplexes all client sockets on one thread.
+        self.connections = dict()  # Dict of client socket to its Client state.
+        self.groups = {None: Membership()}  # Dict of group ID to the registry of its members' ports to their Client state.
+        self.joined = dict()  # Dict of group ID to the ports that joined it since its members were last notified.
+        self.left = dict()    # Dict of group ID to the ports that left it since its members were last notified.
+        self.listening = threading.Event()  # Set once the server is accepting connections.
+        self.stopped = threading.Event()    # Set once the server has shut down.
+        self.stopping = False               # Flag for if stop() has been called.
+        self.wakeup, self.wakeup_signal = socket.socketpair()  # Wakes the selector from other threads.
+        self.metrics = Metrics()  # Counters of messages and bytes, and membership gauges.
+        self.metrics.gauge('members', lambda: sum(len(members) for members in list(self.groups.values())))
+        self.metrics.gauge('groups', lambda: len(self.groups))
+        self.metrics.gauge('connections', lambda: len(self.connections))
+        self.metrics.gauge('outbound_bytes', lambda: sum(len(c.outbound) for c in list(self.connections.values())))
+
+    def encode_data(self, data, codec=JSON):
+        """Encodes dictionary data into a length-prefixed frame
 
-    def encode_data(self, data):
-        """Encodes dictionary data 
-        
         Keyword arguments:
         data -- dictionary to be encoded
-        Return: encoded version of dictionary data
+        codec -- codec to encode with
+        Return: framed, encoded version of dictionary data
         """
-        return json.dumps(data).encode('utf-8')
-    
-    def decode_data(self, data):
-        """Decodes dictionary data 
-        
+        return encode_frame(codec.encode(data))
+
+    def decode_data(self, frame):
+        """Decodes dictionary data with the codec the frame is tagged with
+
         Keyword arguments:
-        data -- dictionary to be decoded
+        frame -- payload of a single frame to be decoded
         Return: decoded version of dictionary data
         """
-        return json.loads(data.decode('utf-8'))
-    
-    def connect(self, peer_host, peer_port):
-        """Connect to a peer socket.
-        
-        Keyword arguments:
-        peer_host -- host address of the peer connection
-        peer_port -- port number of the peer connection
+        return decode_payload(frame)
+
+    def bind(self):
+        """Start listening on the server port.
+
         Return: N/A
         """
-        # Create socket to connect to the peer.
-        connection = socket.create_connection((peer_host, peer_port))
-        self.connections.append(connection)
-
-        print(f"Connected to {peer_host}:{peer_port}")
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(1024)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self.wakeup)
+        logger.info("Listening for connections on %s:%s", self.host, self.port)
+        self.listening.set()
 
     def listen(self):
         """Listen to a socket connection for incoming data.
-        There is a thread running per connection which calls to handle data once received.
-        
+        A single selector loop accepts, reads and writes every connection.
+
         Return: N/A
         """
-        self.socket.bind((self.host, self.port))
-        self.socket.listen(10)
-        print(f"Listening for connections on {self.host}:{self.port}")
+        if not self.listening.is_set():
+            self.bind()
+
+        while not self.stopping:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self.accept()
+                    continue
+                if key.data is self.wakeup:
+                    self.wakeup.recv(1024)
+                    continue
+
+                client = key.data
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self.receive_data(client)
+                    if mask & selectors.EVENT_WRITE and client.connection in self.connections:
+                        self.flush(client)
+                except Exception:
+                    # Every client shares this thread, so one bad message must only cost its sender.
+                    logger.exception("Dropping %s after an error handling its messages.", client.address)
+                    self.close_connection(client)
 
+            # Coalesce every membership change from this pass into one delta per member.
+            self.send_deltas()
+
+        # Close every connection once stopped.
+        for client in list(self.connections.values()):
+            self.connections.pop(client.connection)
+            client.connection.close()
+        self.selector.close()
+        self.socket.close()
+        self.wakeup.close()
+        self.wakeup_signal.close()
+        self.metrics.stop_dump()
+        logger.info("Server stopped.")
+        self.stopped.set()
+
+    def accept(self):
+        """Accept every connection waiting on the listening socket.
+
+        Return: N/A
+        """
         while True:
-            connection, address = self.socket.accept()
-            self.connections.append(connection)
-            print(f"Accepted connection from {address}")
-            threading.Thread(target=self.receive_data, args=(connection, address)).start()
-
-    def send_data(self, data):
-        """Send data to all connections
-        
+            try:
+                connection, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            connection.setblocking(False)
+            client = Client(connection, address)
+            self.connections[connection] = client
+            self.selector.register(connection, selectors.EVENT_READ, client)
+            logger.debug("Accepted connection from %s", address)
+
+    def send_data(self, data, group=None):
+        """Send data to all processes that joined a group
+        The data is encoded once per codec the members use.
+
         Keyword arguments:
-        data -- Encoded data to be sent
+        data -- dict data to be sent
+        group -- ID of the group whose members are sent the data
         Return: N/A
         """
-        for connection in self.connections:
-            print(f'sendng data to {connection}')
-            try:
-                connection.sendall(self.encode_data(data))
-            except socket.error as e:
-                print(f"Failed to send data. Error: {e}")
-                self.connections.remove(connection)
+        encoded = dict()  # Dict of codec to the data encoded with it.
+        clients = self.groups[group].connections()
+        self.count_sent(data, len(clients))
+        for client in clients:
+            if client.codec not in encoded:
+                encoded[client.codec] = self.encode_data(data, client.codec)
+            self.send_to_client(encoded[client.codec], client)
+
+    def count_sent(self, data, count=1):
+        """Count messages sent by their type.
+
+        Keyword arguments:
+        data -- dict message being sent
+        count -- number of clients it is sent to
+        Return: N/A
+        """
+        for message_type in data:
+            self.metrics.counter('messages_out.' + message_type).inc(count)
+
+    def send_to_client(self, encoded_data, client):
+        """Queue encoded data for a client and send as much as possible now.
+
+        Keyword arguments:
+        encoded_data -- framed bytes to be sent
+        client -- Client to send the data to
+        Return: N/A
+        """
+        self.metrics.counter('bytes_out').inc(len(encoded_data))
+        waiting = bool(client.outbound)
+        client.outbound += encoded_data
+        if not waiting:
+            self.flush(client)
 
-    def receive_data(self, connection, address):
+    def flush(self, client):
+        """Write a client's queued data without blocking.
+        Anything the socket cannot take now is sent once it becomes writable.
+
+        Keyword arguments:
+        client -- Client to flush
+        Return: N/A
+        """
+        try:
+            sent = client.connection.send(client.outbound)
+        except BlockingIOError:
+            sent = 0
+        except socket.error as e:
+            logger.warning("Failed to send data to %s. Error: %s", client.address, e)
+            self.close_connection(client)
+            return
+        del client.outbound[:sent]
+
+        # Only wait for writability while data is left over.
+        writing = bool(client.outbound)
+        if writing != client.writing:
+            client.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self.selector.modify(client.connection, events, client)
+
+    def receive_data(self, client):
         """Receive and handle incoming data from connected nodes.
-        
+
         Expected message types:
-            New: A process wants to be added to the group of peers. 
-                 Need to let the new process know about all other connected peers.
+            New: A process wants to be added to the group of peers.
+                 Need to let the new process know about all other connected peers,
+                 and let the other peers know that it has joined, with the
+                 endpoints each of them can be reached at.
+                 A process that runs one of several consensus groups names
+                 its group, and only joins that group's peers.
+            Groups: A client asks for the members of every group.
 
         Keyword arguments:
-        connection -- socket that is receiving data.
-        address -- address of the sending socket.
+        client -- Client that is receiving data.
         Return: N/A
         """
-        while True:
+        try:
+            frames = client.decoder.recv(client.connection)
+        except BlockingIOError:
+            return
+        except (socket.error, FrameError):
+            frames = None
+
+        if frames is None:
+            # If there was an error (e.g., a crash), need to remove the process from the group.
+            self.close_connection(client)
+            return
+
+        for frame in frames:
+            self.metrics.counter('bytes_in').inc(len(frame) + HEADER.size)
             try:
-                # Receive data on connection
-                data = connection.recv(1024)
-                if not data:
-                    break
-                decoded_data = self.decode_data(data)
-                print(f"Received data from {address}: {decoded_data}")
-                
-                # Get which type of message was sent.
-                message_type = decoded_data.keys()
-
-                if 'new' in message_type:
-                    # Get the port number of the new connection.
-                    port_number = decoded_data['new']
-
-                    # Add that connection to the Out connections.
-                    connection = socket.create_connection(('127.0.0.1', port_number))   
-                    self.connections.append(connection)
-                    self.out.append(connection)
-
-                    # Get all currently connected Out ports and send to the new connection.
-                    ports = self.currently_connected_ports()
-                    print(ports)
-                    if len(ports) > 0:
-                        data = {'ports': ports}
-                        encoded_data = self.encode_data(data)
-                        connection.sendall(encoded_data)
-                        
-            except socket.error:
-                break
-
-        # If there was an error (e.g., a crash), need to remove the process from the group.
-        print(f"Connection from {address} closed.")
-        self.connections.remove(connection)
-        self.out.remove(connection)
-        connection.close()
-
-    def currently_connected_ports(self):
-        """Get port numbers of all current Out connections.
-        
+                decoded_data = self.decode_data(frame)
+            except FrameError as e:
+                logger.warning("Dropping %s, which sent an undecodable message. Error: %s", client.address, e)
+                self.close_connection(client)
+                return
+            logger.debug("Received data from %s: %s", client.address, decoded_data)
+
+            # Get which type of message was sent.
+            message_type = decoded_data.keys()
+            for key in message_type:
+                self.metrics.counter('messages_in.' + key).inc()
+
+            if 'new' in message_type:
+                self.join(client, decoded_data['new'], decoded_data.get('codecs'), decoded_data.get('group'),
+                          decoded_data.get('endpoint'))
+            elif 'groups' in message_type:
+                self.count_sent({'groups': None})
+                self.send_to_client(self.encode_data({'groups': self.group_ports()}, client.codec), client)
+
+    def join(self, client, port_number, codecs=None, group=None, endpoint=None):
+        """Add a process to the group of peers.
+        The new process gets the ports of all current members, and the current
+        members only get the newly joined port. A member already on the port
+        is taken to be a process that restarted there, so it is removed first.
+
+        Keyword arguments:
+        client -- Client of the joining process.
+        port_number -- listening port of the joining process.
+        codecs -- list of codec names the process offered, or None if it offered none.
+        group -- ID of the consensus group the process runs, or None for the default group.
+        endpoint -- dict of the transports besides TCP the process listens on, and the host they are on.
+        Return: N/A
+        """
+        if client.port is not None:
+            # A connection joins a single group once.
+            return
+        members = self.groups.get(group)
+        stale = members.connection(port_number) if members is not None else None
+        if stale is not None:
+            # A process restarted on the port before its old connection was seen to close.
+            logger.info("Replacing member %s of group %s with %s.", port_number, group, client.address)
+            self.close_connection(stale)
+            # Members must see the old process leave before the new one joins.
+            self.send_deltas()
+        ports = self.currently_connected_ports(group)
+        self.groups.setdefault(group, Membership()).add(port_number, client)
+        client.port = port_number
+        client.group = group
+        client.codec = negotiate(self.codecs, codecs)
+        # Peers reach the process over TCP at the address the server sees it at.
+        client.endpoint = dict(endpoint or {}, tcp=[client.address[0], port_number])
+
+        # Existing members are told about the join as a delta.
+        self.joined.setdefault(group, []).append(port_number)
+
+        # Get all currently connected ports and send to the new connection, even if there are none,
+        # so it knows it has joined.
+        data = {'ports': ports, 'endpoints': self.endpoints(ports, group)}
+        self.count_sent(data)
+        self.send_to_client(self.encode_data(data, client.codec), client)
+
+    def close_connection(self, client):
+        """Close a client connection and remove it from the group.
+
+        Keyword arguments:
+        client -- Client that has closed or crashed.
+        Return: N/A
+        """
+        if self.connections.pop(client.connection, None) is None:
+            return
+        logger.info("Connection from %s closed.", client.address)
+        self.selector.unregister(client.connection)
+        client.connection.close()
+
+        members = self.groups.get(client.group)
+        if client.port is not None and members is not None and members.connection(client.port) is client:
+            members.remove(client.port)
+            self.left.setdefault(client.group, []).append(client.port)
+
+    def send_deltas(self):
+        """Push the joins and leaves since the last call to the members of each group they happened in.
+
+        Return: N/A
+        """
+        for group, joined in self.joined.items():
+            self.send_data({'joined': joined, 'endpoints': self.endpoints(joined, group)}, group)
+        self.joined = dict()
+        for group, left in self.left.items():
+            if self.groups[group]:
+                self.send_data({'left': left}, group)
+            elif group is not None:
+                # Nobody is left to tell, so the group is forgotten.
+                del self.groups[group]
+        self.left = dict()
+
+    def currently_connected_ports(self, group=None):
+        """Get port numbers of all processes that joined a group.
+
+        Keyword arguments:
+        group -- ID of the group, or None for the default group
         Return: list of int port numbers
         """
-        port_numbers = []
-        for connection in self.out:
-            port_numbers.append(connection.getpeername()[1])
-        return port_numbers
+        members = self.groups.get(group)
+        return members.ports() if members is not None else []
+
+    def endpoints(self, ports, group=None):
+        """Get the endpoints members of a group can be reached at.
+
+        Keyword arguments:
+        ports -- list of int port numbers of the members.
+        group -- ID of the group
+        Return: list of [port, endpoint dict] pairs of the ports that are still members
+        """
+        members = self.groups[group]
+        return [[port, members.connection(port).endpoint] for port in ports if port in members]
+
+    def group_ports(self):
+        """Get the members of every group, which tells a node which peers run each of its groups.
+
+        Return: list of [group ID, list of int port numbers] pairs, as a message's dict keys must be strings
+        """
+        return [[group, members.ports()] for group, members in self.groups.items() if members]
 
     def start(self):
         """Start thread to listen for incoming connections.
-        
+        Binds first, so the server is accepting connections once this returns.
+
         Return: N/A
         """
+        self.bind()
         listen_thread = threading.Thread(target=self.listen)
         listen_thread.start()
+
+    def stop(self):
+        """Stop the server from any thread.
+
+        Return: N/A
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        try:
+            self.wakeup_signal.send(b'\0')
+        except OSError:
+            pass
+
+    def wait_for_shutdown(self, timeout=None):
+        """Block until the server has shut down.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for.
+        Return: True if the server has shut down.
+        """
+        return self.stopped.wait(timeout)
+
+    async def wait_for_shutdown_async(self):
+        """Wait on the caller's event loop until the server has shut down.
+        The server runs on its own threads, so the wait is handed to the loop's executor.
+
+        Return: N/A
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.stopped.wait)
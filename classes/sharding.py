@@ -0,0 +1,498 @@
+"""Sharding
+
+Runs many independent consensus groups, each keyed by a group ID, behind a
+single node endpoint. A Process runs one group and all of its handling shares
+one interpreter, so a node spreads its groups over a pool of worker OS
+processes, each with its own interpreter and GIL. Every group keeps its own
+rounds, proposal set and peers in the process that runs it.
+
+The node listens on one port for all of its groups. A peer's hello names the
+group it is for, so the node's router peeks at the hello without consuming
+it and hands the socket to the worker running that group, which serves it
+like a connection its process accepted itself. Connections are routed once
+rather than every message, so no message crosses the node's interpreter.
+Each group's process joins the rendezvous server with its group ID, and the
+server only introduces it to the members of the same group.
+"""
+
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+
+from multiprocessing import reduction
+
+from .codec import decode_payload
+from .framing import HEADER, FrameError
+from .process import Process
+
+ROUTE_TIMEOUT = 5.0         # Seconds an accepted connection may take to send the hello it is routed by.
+MAX_HELLO_SIZE = 64 * 1024  # Bytes a hello may take, as the router peeks at it whole.
+START_METHOD = 'spawn'      # Workers start from a fresh interpreter, as forking copies locks other threads hold.
+
+logger = logging.getLogger(__name__)
+
+
+def peek_group(connection):
+    """Read the group a connection's hello names, leaving the hello for the group's process to read.
+
+    Keyword arguments:
+    connection -- socket of an accepted peer connection.
+    Return: group ID the hello names, or None if it names none.
+    """
+    header = connection.recv(HEADER.size, socket.MSG_PEEK | socket.MSG_WAITALL)
+    if len(header) < HEADER.size:
+        raise FrameError("Connection closed before its hello.")
+    length, = HEADER.unpack(header)
+    if length > MAX_HELLO_SIZE:
+        raise FrameError(f"Hello of {length} bytes exceeds {MAX_HELLO_SIZE}.")
+    frame = connection.recv(HEADER.size + length, socket.MSG_PEEK | socket.MSG_WAITALL)
+    if len(frame) < HEADER.size + length:
+        raise FrameError("Connection closed before its hello.")
+    hello = decode_payload(frame[HEADER.size:])
+    if not isinstance(hello, dict) or 'hello' not in hello:
+        raise FrameError("First message is not a hello.")
+    return hello.get('group')
+
+
+def run_worker(channel, host, port, groups, process_class, process_kwargs):
+    """Entry point of a worker OS process.
+
+    Keyword arguments:
+    channel -- Connection to the node.
+    host -- host address of the node.
+    port -- port of the node, which every group's process uses as its peer ID.
+    groups -- list of IDs of the groups the worker runs.
+    process_class -- Process class each group runs on.
+    process_kwargs -- extra arguments for each group's process.
+    Return: N/A
+    """
+    ShardWorker(channel, host, port, groups, process_class, process_kwargs).serve()
+
+
+class ShardWorker:
+    """Groups run by a single worker OS process, and the commands its node sends them."""
+
+    def __init__(self, channel, host, port, groups, process_class, process_kwargs):
+        self.channel = channel  # Connection to the node, carrying commands, replies, decisions and sockets.
+        self.send_lock = threading.Lock()  # Orders replies and decisions sent from the groups' threads.
+        # Commands run off the channel's thread, so joining peers' sockets keep being adopted while they wait.
+        self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='shard-command')
+        self.processes = dict()  # Dict of group ID to the process running the group.
+        for group in groups:
+            kwargs = dict(process_kwargs)
+            if kwargs.get('log_dir') is not None:
+                # Every group logs its own decisions.
+                kwargs['log_dir'] = os.path.join(kwargs['log_dir'], str(group))
+            process = process_class(host, port, group=group, **kwargs)
+            process.decision_listeners.append(self.reporter(group))
+            self.processes[group] = process
+
+    def send(self, message):
+        """Send a message to the node.
+
+        Keyword arguments:
+        message -- picklable tuple.
+        Return: N/A
+        """
+        with self.send_lock:
+            self.channel.send(message)
+
+    def reporter(self, group):
+        """Create a decision listener that reports a group's decisions to the node.
+
+        Keyword arguments:
+        group -- ID of the group the listener is for.
+        Return: callable given a round ID and decided value.
+        """
+        def on_decision(round_id, value):
+            self.send(('decision', group, round_id, value))
+        return on_decision
+
+    def serve(self):
+        """Start every group's process and run the node's commands until it stops the worker.
+
+        Return: N/A
+        """
+        for process in self.processes.values():
+            process.start(listen=False)
+        while True:
+            try:
+                command, request_id, args = self.channel.recv()
+            except (EOFError, OSError):
+                # The node has gone away.
+                self.stop()
+                break
+            if command == 'adopt':
+                # The socket follows its command on the channel.
+                group, = args
+                connection = socket.socket(fileno=reduction.recv_handle(self.channel))
+                self.processes[group].adopt(connection)
+            elif command == 'stop':
+                self.stop()
+                self.send(('reply', request_id, True, None))
+                break
+            else:
+                self.executor.submit(self.run_command, command, request_id, args)
+        self.executor.shutdown(wait=False)
+
+    def run_command(self, command, request_id, args):
+        """Run a command and reply with its result.
+
+        Keyword arguments:
+        command -- name of the ShardWorker method to run.
+        request_id -- int ID the node matches the reply by.
+        args -- tuple of arguments for the method.
+        Return: N/A
+        """
+        try:
+            result = getattr(self, command)(*args)
+        except Exception as e:
+            self.send(('reply', request_id, False, e))
+        else:
+            self.send(('reply', request_id, True, result))
+
+    def ready(self):
+        """Report that every group's process has started, which is the case once commands are served.
+
+        Return: True
+        """
+        return True
+
+    def join(self, server_host, server_port):
+        """Connect every group's process to the rendezvous server.
+
+        Keyword arguments:
+        server_host -- host address of the server.
+        server_port -- port number of the server.
+        Return: N/A
+        """
+        for process in self.processes.values():
+            process.connect_to_rendezvous(server_host, server_port)
+
+    def wait_for_join(self, timeout):
+        """Wait for every group's process to finish joining.
+
+        Keyword arguments:
+        timeout -- seconds to wait for each group.
+        Return: list of IDs of the groups that did not finish joining.
+        """
+        return [group for group, process in self.processes.items() if process.wait_for_join(timeout) is None]
+
+    def propose(self, group, value):
+        """Propose a value in a group.
+
+        Keyword arguments:
+        group -- ID of the group.
+        value -- value to propose.
+        Return: int ID of the round proposed in, or None if the engine proposes without waiting.
+        """
+        return self.processes[group].propose(value)
+
+    def run_rounds(self, rounds):
+        """Have every group propose in each of its first rounds as soon as the round is free,
+        which is once the group has delivered the round before it.
+
+        Keyword arguments:
+        rounds -- number of rounds to propose in.
+        Return: N/A
+        """
+        for process in self.processes.values():
+            def on_decision(round_id, value, process=process):
+                # Proposing from a listener would start the next round while this one is being delivered.
+                process.schedule(0, self.propose_free_rounds, process, rounds)
+            process.decision_listeners.append(on_decision)
+            process.execute(self.propose_free_rounds, process, rounds)
+
+    def propose_free_rounds(self, process, rounds):
+        """Propose in every round a group's process has free, up to a number of rounds.
+
+        Keyword arguments:
+        process -- process of the group.
+        rounds -- number of rounds to propose in.
+        Return: N/A
+        """
+        round_id = process.next_free_round()
+        while round_id is not None and round_id < rounds:
+            process.propose(f"{round_id}:{process.port}")
+            round_id = process.next_free_round()
+
+    def metrics(self):
+        """Get a snapshot of every group's metrics.
+
+        Return: dict of group ID to metrics snapshot.
+        """
+        return {group: process.metrics.snapshot() for group, process in self.processes.items()}
+
+    def stop(self):
+        """Stop every group's process.
+
+        Return: N/A
+        """
+        for process in self.processes.values():
+            process.stop()
+
+
+class WorkerHandle:
+    """The node's end of a worker OS process."""
+
+    def __init__(self, context, name, host, port, groups, process_class, process_kwargs, on_decision):
+        self.groups = groups  # IDs of the groups the worker runs.
+        self.on_decision = on_decision  # Called with a group ID, round ID and decided value.
+        self.channel, worker_channel = context.Pipe()
+        self.process = context.Process(target=run_worker, name=name, daemon=True,
+                                       args=(worker_channel, host, port, groups, process_class, process_kwargs))
+        self.process.start()
+        worker_channel.close()
+        self.send_lock = threading.Lock()  # Keeps a command and the socket that follows it together.
+        self.requests = dict()  # Dict of request ID to the Future of its reply.
+        self.request_ids = itertools.count()
+        threading.Thread(target=self.read, name=f"{name}-reader", daemon=True).start()
+
+    def ask(self, command, *args):
+        """Run a command on the worker.
+
+        Keyword arguments:
+        command -- name of the ShardWorker method to run.
+        args -- arguments for the method.
+        Return: Future of the command's result.
+        """
+        future = concurrent.futures.Future()
+        request_id = next(self.request_ids)
+        self.requests[request_id] = future
+        try:
+            with self.send_lock:
+                self.channel.send((command, request_id, args))
+        except OSError as e:
+            self.requests.pop(request_id, None)
+            future.set_exception(e)
+        return future
+
+    def adopt(self, group, connection):
+        """Hand an accepted connection to the worker running its group.
+
+        Keyword arguments:
+        group -- ID of the group the connection is for.
+        connection -- socket of the accepted connection, which the caller still closes.
+        Return: N/A
+        """
+        with self.send_lock:
+            self.channel.send(('adopt', None, (group,)))
+            reduction.send_handle(self.channel, connection.fileno(), self.process.pid)
+
+    def read(self):
+        """Receive replies and decisions from the worker until it exits.
+
+        Return: N/A
+        """
+        while True:
+            try:
+                message = self.channel.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'decision':
+                group, round_id, value = message[1:]
+                self.on_decision(group, round_id, value)
+            else:
+                request_id, ok, result = message[1:]
+                future = self.requests.pop(request_id)
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+        for future in list(self.requests.values()):
+            if not future.done():
+                future.set_exception(ConnectionError(f"Worker {self.process.name} exited."))
+
+    def close(self, timeout=None):
+        """Wait for the worker to exit, killing it if it does not, and close the channel.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for.
+        Return: N/A
+        """
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning("Terminating worker %s, which did not stop.", self.process.name)
+            self.process.terminate()
+            self.process.join()
+        self.channel.close()
+
+
+class ShardedNode:
+    def __init__(self, host, port, groups, workers=None, process_class=Process, **process_kwargs):
+        self.host = host  # Host address.
+        self.port = port  # Port number every group's peers connect to, and its processes' peer ID.
+        self.groups = list(groups)  # IDs of the groups the node runs.
+        # Workers beyond one per core or per group would only contend for them.
+        self.worker_count = max(1, min(workers or os.cpu_count() or 1, len(self.groups)))
+        # Groups are dealt out in turn, so every worker runs about as many.
+        self.assignment = {group: i % self.worker_count for i, group in enumerate(self.groups)}
+        self.process_class = process_class    # Process class each group runs on, e.g. one of ENGINES.
+        self.process_kwargs = process_kwargs  # Extra arguments for each group's process.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.workers = []  # WorkerHandle of each worker.
+        self.decision_listeners = []  # Callables given a group ID, round ID and decided value, in round order.
+        self.listening = threading.Event()  # Set once the node is accepting connections.
+        self.stopped = threading.Event()    # Set once the node has been stopped.
+
+    def start(self):
+        """Start the workers and the thread routing incoming connections to them.
+        Binds first, so the node is accepting connections once this returns.
+
+        Return: N/A
+        """
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(1024)
+        context = multiprocessing.get_context(START_METHOD)
+        for index in range(self.worker_count):
+            groups = [group for group in self.groups if self.assignment[group] == index]
+            self.workers.append(WorkerHandle(context, f"shard-{self.port}-{index}", self.host, self.port, groups,
+                                             self.process_class, self.process_kwargs, self.notify_decision))
+        logger.info("Listening for connections on %s:%s for %d groups on %d workers",
+                    self.host, self.port, len(self.groups), self.worker_count)
+        self.listening.set()
+        threading.Thread(target=self.listen, name=f"router-{self.port}", daemon=True).start()
+
+    def listen(self):
+        """Accept connections until stopped, routing each on a thread of its own.
+
+        Return: N/A
+        """
+        while not self.stopped.is_set():
+            try:
+                connection, address = self.socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.route, args=(connection,), daemon=True).start()
+
+    def route(self, connection):
+        """Hand a connection to the worker running the group its hello names.
+
+        Keyword arguments:
+        connection -- socket of the accepted connection.
+        Return: N/A
+        """
+        try:
+            connection.settimeout(ROUTE_TIMEOUT)
+            group = peek_group(connection)
+            connection.settimeout(None)
+            if not isinstance(group, (int, str)) or group not in self.assignment:
+                logger.warning("Dropping connection for unknown group %r", group)
+            else:
+                self.workers[self.assignment[group]].adopt(group, connection)
+        except (OSError, FrameError) as e:
+            logger.debug("Dropping connection that could not be routed. Error: %r", e)
+        finally:
+            # The worker has its own copy of the socket.
+            connection.close()
+
+    def notify_decision(self, group, round_id, value):
+        """Pass a group's decision on to the node's listeners.
+
+        Keyword arguments:
+        group -- ID of the group.
+        round_id -- int ID of the round.
+        value -- decided value.
+        Return: N/A
+        """
+        for listener in self.decision_listeners:
+            listener(group, round_id, value)
+
+    def ask_all(self, command, *args):
+        """Run a command on every worker and wait for them all.
+
+        Keyword arguments:
+        command -- name of the ShardWorker method to run.
+        args -- arguments for the method.
+        Return: list of each worker's result.
+        """
+        futures = [worker.ask(command, *args) for worker in self.workers]
+        return [future.result() for future in futures]
+
+    def wait_for_workers(self, timeout=None):
+        """Block until every worker has started and its groups' processes are running.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for each worker.
+        Return: True if every worker is running.
+        """
+        futures = [worker.ask('ready') for worker in self.workers]
+        try:
+            return all(future.result(timeout) for future in futures)
+        except concurrent.futures.TimeoutError:
+            return False
+
+    def connect_to_rendezvous(self, server_host, server_port):
+        """Join every group through the rendezvous server.
+
+        Keyword arguments:
+        server_host -- host address of server connection.
+        server_port -- port number of server connection.
+        Return: N/A
+        """
+        self.ask_all('join', server_host, server_port)
+
+    def wait_for_join(self, timeout=None):
+        """Block until every group has finished joining.
+
+        Keyword arguments:
+        timeout -- optional seconds to wait for each group.
+        Return: True if every group finished joining.
+        """
+        return not any(self.ask_all('wait_for_join', timeout))
+
+    def propose(self, group, value):
+        """Propose a value in a group.
+
+        Keyword arguments:
+        group -- ID of the group.
+        value -- value to propose.
+        Return: int ID of the round proposed in, or None if the engine proposes without waiting.
+        """
+        return self.workers[self.assignment[group]].ask('propose', group, value).result()
+
+    def run_rounds(self, rounds):
+        """Have every group propose in its first rounds without waiting for the node,
+        each round as soon as the group has delivered the one before it.
+
+        Keyword arguments:
+        rounds -- number of rounds to propose in.
+        Return: N/A
+        """
+        self.ask_all('run_rounds', rounds)
+
+    def metrics(self):
+        """Get a snapshot of every group's metrics.
+
+        Return: dict of group ID to metrics snapshot.
+        """
+        snapshots = dict()
+        for result in self.ask_all('metrics'):
+            snapshots.update(result)
+        return snapshots
+
+    def stop(self, timeout=5):
+        """Stop every group and the workers running them.
+
+        Keyword arguments:
+        timeout -- seconds to wait for each worker to exit.
+        Return: N/A
+        """
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        logger.info("Stopping node %s...", self.port)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        for worker in self.workers:
+            worker.ask('stop')
+        for worker in self.workers:
+            worker.close(timeout)
@@ -0,0 +1,56 @@
+"""StateTransfer
+
+Chunked transfer of a process's state to a peer that joins a running
+cluster. The joiner asks one peer for a snapshot of the rounds it has
+delivered and its proposal set. The peer encodes the snapshot once and
+streams it as bounded-size chunks behind its other messages, so a large
+snapshot neither blocks its rounds nor has to fit in a single frame. The
+joiner reassembles the chunks and continues from the peer's current round,
+so joining takes time proportional to the snapshot, not to the number of
+rounds the cluster has run.
+"""
+
+import json
+import time
+
+from .decision_log import RecoveredState
+
+CHUNK_SIZE = 64 * 1024  # Characters of snapshot text sent per chunk.
+
+
+def encode_chunks(state, chunk_size=CHUNK_SIZE):
+    """Encode a state and split it into chunks.
+
+    Keyword arguments:
+    state -- RecoveredState to send.
+    chunk_size -- characters per chunk.
+    Return: list of str chunks, with at least one chunk.
+    """
+    text = json.dumps(state._asdict())
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+class SnapshotAssembler:
+    """Chunks of a snapshot being received from a single peer."""
+
+    def __init__(self, peer_id):
+        self.peer_id = peer_id  # Port of the peer sending the snapshot.
+        self.chunks = []
+        self.started_at = time.perf_counter()  # Time the snapshot was requested, for metrics.
+
+    def add(self, index, total, chunk):
+        """Add the next chunk of the snapshot.
+
+        Keyword arguments:
+        index -- int position of the chunk.
+        total -- int number of chunks in the snapshot.
+        chunk -- str chunk.
+        Return: RecoveredState once every chunk has arrived, else None.
+        """
+        if index != len(self.chunks):
+            # Chunks arrive in order on a single connection, so a gap means the snapshot is unusable.
+            raise ValueError(f"Expected snapshot chunk {len(self.chunks)} from {self.peer_id}, got {index}")
+        self.chunks.append(chunk)
+        if len(self.chunks) < total:
+            return None
+        return RecoveredState(**json.loads(''.join(self.chunks)))
@@ -0,0 +1,234 @@
+"""Transport
+
+Ways a process can be reached by its peers. Every transport gives stream
+sockets, so the framing, writers and readers above it are the same:
+
+TcpTransport -- TCP over IP, which reaches a process on any host. Nagle's
+                algorithm is turned off, as the writers already coalesce
+                messages.
+UnixTransport -- Unix domain stream sockets at a path derived from the
+                 listening port, which only reach processes on the same host
+                 but skip TCP's checksums, acknowledgements and loopback
+                 routing, so local round trips take less time.
+
+A process always listens on TCP, as the server and other hosts need it, and
+also on the other transports it offers. The rendezvous server advertises
+every member's endpoints, with the address it sees the member at for TCP,
+and a process dials a peer over the first of its transports that reaches it,
+falling back to the next one if a dial fails.
+"""
+
+import asyncio
+import functools
+import os
+import socket
+import tempfile
+
+SOCKET_DIR = tempfile.gettempdir()  # Directory the unix transport's sockets are created in.
+DEFAULT_TRANSPORTS = ('tcp',)        # Transports used by default, most preferred first.
+
+
+@functools.lru_cache(maxsize=None)
+def host_id():
+    """Get an ID of the host, which processes compare to tell if a peer is on the same host.
+
+    Return: str of the host name and, where the kernel has one, its boot ID.
+    """
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+    except OSError:
+        boot_id = ''
+    return f"{socket.gethostname()}/{boot_id}"
+
+
+def set_no_delay(connection):
+    """Send small messages straight away on TCP connections.
+
+    Keyword arguments:
+    connection -- socket of a connection over any transport.
+    Return: N/A
+    """
+    if connection.family in (socket.AF_INET, socket.AF_INET6):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def is_local(connection):
+    """Check if a connection is over a Unix domain socket, which only a process
+    on the same host that may open the socket's path can have made.
+
+    Keyword arguments:
+    connection -- socket of a connection over any transport.
+    Return: True if the connection is over a Unix domain socket.
+    """
+    return hasattr(socket, 'AF_UNIX') and connection.family == socket.AF_UNIX
+
+
+class TcpTransport:
+    name = 'tcp'
+
+    def listen(self, host, port, backlog):
+        """Create a socket listening on a port.
+
+        Keyword arguments:
+        host -- host address to listen on.
+        port -- port to listen on.
+        backlog -- connections waiting to be accepted at most.
+        Return: listening socket.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(backlog)
+        return listener
+
+    def address(self, endpoint, peer_host, peer_port):
+        """Get the address a peer is dialed at over this transport.
+
+        Keyword arguments:
+        endpoint -- dict the server advertised for the peer, or None.
+        peer_host -- host address to use if the server advertised none.
+        peer_port -- listening port of the peer.
+        Return: tuple of host and port.
+        """
+        if endpoint and endpoint.get('tcp'):
+            return tuple(endpoint['tcp'])
+        return (peer_host, peer_port)
+
+    def connect(self, address, timeout=None):
+        """Open a connection.
+
+        Keyword arguments:
+        address -- tuple of host and port.
+        timeout -- optional seconds the connection attempt may take.
+        Return: socket of the new connection.
+        """
+        return socket.create_connection(address, timeout)
+
+    async def open_connection(self, address):
+        """Open a connection on the running event loop.
+
+        Keyword arguments:
+        address -- tuple of host and port.
+        Return: tuple of StreamReader and StreamWriter.
+        """
+        return await asyncio.open_connection(*address)
+
+    async def start_server(self, callback, host, port, backlog):
+        """Listen on a port on the running event loop.
+
+        Keyword arguments:
+        callback -- coroutine function given the StreamReader and StreamWriter of each connection.
+        host -- host address to listen on.
+        port -- port to listen on.
+        backlog -- connections waiting to be accepted at most.
+        Return: asyncio Server.
+        """
+        return await asyncio.start_server(callback, host, port, backlog=backlog)
+
+
+class UnixTransport:
+    name = 'unix'
+
+    def __init__(self, directory=SOCKET_DIR):
+        self.directory = directory
+
+    def path(self, port):
+        """Get the path a process listening on a port has its unix socket at.
+
+        Keyword arguments:
+        port -- listening port of the process.
+        Return: str path.
+        """
+        return os.path.join(self.directory, f"flooding-{port}.sock")
+
+    def listen(self, host, port, backlog):
+        """Create a socket listening at the port's path.
+        Only call once the port's TCP socket is bound, as that makes any socket
+        already at the path one a crashed process left behind.
+
+        Keyword arguments:
+        host -- ignored, as the socket is only reachable from the same host.
+        port -- listening port of the process.
+        backlog -- connections waiting to be accepted at most.
+        Return: listening socket.
+        """
+        path = self.path(port)
+        self.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(backlog)
+        return listener
+
+    def remove(self, path):
+        """Remove the socket at a path, if there is one.
+
+        Keyword arguments:
+        path -- str path of the socket.
+        Return: N/A
+        """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def address(self, endpoint, peer_host, peer_port):
+        """Get the path a peer is dialed at over this transport.
+
+        Keyword arguments:
+        endpoint -- dict the server advertised for the peer, or None.
+        peer_host -- ignored.
+        peer_port -- listening port of the peer.
+        Return: str path, or None if the peer is not listening on this transport on the same host.
+        """
+        if endpoint and endpoint.get('unix') and endpoint.get('host_id') == host_id():
+            return endpoint['unix']
+        return None
+
+    def connect(self, address, timeout=None):
+        """Open a connection.
+
+        Keyword arguments:
+        address -- str path.
+        timeout -- optional seconds the connection attempt may take.
+        Return: socket of the new connection.
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(timeout)
+            connection.connect(address)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    async def open_connection(self, address):
+        """Open a connection on the running event loop.
+
+        Keyword arguments:
+        address -- str path.
+        Return: tuple of StreamReader and StreamWriter.
+        """
+        return await asyncio.open_unix_connection(address)
+
+    async def start_server(self, callback, host, port, backlog):
+        """Listen at the port's path on the running event loop.
+
+        Keyword arguments:
+        callback -- coroutine function given the StreamReader and StreamWriter of each connection.
+        host -- ignored.
+        port -- listening port of the process.
+        backlog -- connections waiting to be accepted at most.
+        Return: asyncio Server.
+        """
+        path = self.path(port)
+        self.remove(path)
+        return await asyncio.start_unix_server(callback, path, backlog=backlog)
+
+
+TRANSPORTS = {
+    'tcp': TcpTransport(),
+    'unix': UnixTransport(),
+}
+TCP = TRANSPORTS['tcp']
+UNIX = TRANSPORTS['unix']
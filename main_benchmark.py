@@ -0,0 +1,80 @@
+"""Main program to benchmark the flooding protocol.
+
+Runs a rendezvous server and clusters of processes on loopback ports for each
+scenario and cluster size, prints a summary and saves the results as JSON.
+With --groups, runs nodes that each host that many consensus groups on a pool
+of worker processes instead.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+
+from classes.benchmark import ENGINES, SCENARIOS, run_benchmark, run_sharded
+from classes.codec import CODECS
+from classes.overlay import OVERLAYS
+from classes.transport import DEFAULT_TRANSPORTS, TRANSPORTS
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the flooding consensus protocol on loopback.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 10, 30, 100], help="numbers of processes")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=["thread"])
+    parser.add_argument("--rounds", type=int, default=100, help="rounds to run per scenario")
+    parser.add_argument("--window", type=int, default=4, help="rounds in flight for the pipelined engine")
+    parser.add_argument("--delta", action="store_true", help="send proposal deltas instead of full sets")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for each round")
+    # Every process shares one interpreter here, so in large clusters silences measure thread starvation, not peers.
+    parser.add_argument("--failure-detector", choices=["timeout", "phi", "none"], default="none",
+                        help="failure detector the processes use")
+    parser.add_argument("--codec", choices=list(CODECS), default="binary", help="codec the processes send with")
+    parser.add_argument("--overlay", choices=list(OVERLAYS), default="mesh",
+                        help="overlay the processes connect and disseminate proposals over")
+    parser.add_argument("--transports", nargs="+", choices=list(TRANSPORTS), default=list(DEFAULT_TRANSPORTS),
+                        help="transports the processes dial each other over, most preferred first")
+    parser.add_argument("--groups", type=int, default=0,
+                        help="consensus groups each node hosts on a worker pool, 0 for one group per process")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes per node, one per core by default")
+    parser.add_argument("--profile", action="store_true",
+                        help="record handler, decode, send and round phase times in the results' metrics")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to save the results to")
+    parser.add_argument("--log-level", default="WARNING", help="logging level of the processes")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    process_kwargs = dict(delta=args.delta, codecs=[args.codec], overlay=args.overlay, transports=args.transports,
+                          failure_detector=None if args.failure_detector == "none" else args.failure_detector,
+                          profile=args.profile)
+    if args.groups:
+        results = [run_sharded(size, args.groups, args.workers, engine, rounds=args.rounds, window=args.window,
+                               timeout=args.timeout, **process_kwargs)
+                   for engine in args.engines for size in args.sizes]
+    else:
+        results = run_benchmark(args.sizes, args.scenarios, args.engines, rounds=args.rounds,
+                                window=args.window, timeout=args.timeout, **process_kwargs)
+
+    for result in results:
+        if 'error' in result:
+            print(f"{result['engine']:>9} {result['scenario']:>6} N={result['size']:<4} error: {result['error']}")
+        else:
+            if 'groups' in result:
+                print(f"{result['groups']} groups on {result['workers']} workers per node, "
+                      f"started in {result['spawn_seconds']:.3f} s:", end=" ")
+            print(f"{result['engine']:>9} {result['scenario']:>6} N={result['size']:<4} "
+                  f"{result['decisions_per_second']:8.1f} decisions/s  "
+                  f"p50 {result['latency_p50_ms']:7.2f} ms  p99 {result['latency_p99_ms']:7.2f} ms  "
+                  f"{result['bytes_per_round']:10.0f} B/round  join {result['join_seconds']:6.3f} s")
+
+    with open(args.output, "w") as f:
+        json.dump({
+            'time': datetime.datetime.now().isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'arguments': vars(args),
+            'results': results,
+        }, f, indent=2)
+    print(f"Results saved to {args.output}")
@@ -1,36 +1,52 @@
 """" Main program to run a single process.
 
-Starts the process, connects to peers, and infinitely loops to carry out 
-the flooding protocol with its peers.
+Starts the process, connects to peers, and loops to carry out the flooding 
+protocol with its peers until interrupted. Sending the program SIGUSR1 starts
+profiling the process, and sending it again dumps the profile to the
+temporary directory.
 """
 
+import logging
+import signal
+
 from classes import Process
 
 if __name__ == "__main__":
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Get port number for process.
     port_number = input("Enter process port number: \n")
 
-    # Start process thread.
-    process = Process("0.0.0.0", int(port_number))
+    # A process restarted with the same log directory resumes from the last round it delivered.
+    log_dir = input("Enter decision log directory (leave empty to keep no log): \n").strip()
+
+    # Start process thread, which returns once it is listening.
+    process = Process("0.0.0.0", int(port_number), log_dir=log_dir or None)
     process.start()
 
-    # Give some time for process to start listening.
-    import time
-    time.sleep(2)
+    # Toggle the sampling profiler without restarting, where the platform has the signal.
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, process.handle_profile_signal)
 
     # Conenct to psuedo rendezvous server.
     process.connect_to_rendezvous("127.0.0.1", 8000)
+
+    # A late joiner catches up with its peers' rounds before proposing.
+    process.wait_for_join()
     
-    # Loop for each proposal round input.
-    while(True):
-        current_round_id = process.current_round_id
-        # Only ask for proposal if round has not already been proposed for (e.g., in a case of a crash).
-        if current_round_id not in process.proposed_for_round.keys() or not process.proposed_for_round[current_round_id]:
-            proposed_value = input(f"** Waiting for round {current_round_id} proposal... **\n")
-            process.propose(proposed_value)
-        while (True):
-            # Move to the next proposal input once a new round has been incremented.
-            if process.current_round_id != current_round_id:
-                break
-    
\ No newline at end of file
+    # Loop for each proposal round input until interrupted.
+    try:
+        while not process.stopped.is_set():
+            current_round_id = process.current_round_id
+            # Only ask for proposal if round has not already been proposed for (e.g., in a case of a crash).
+            if not process.rounds.has_proposed(current_round_id):
+                proposed_value = input(f"** Waiting for round {current_round_id} proposal... **\n")
+                process.propose(proposed_value)
+
+            # Sleep until a new round has been incremented before asking for the next proposal.
+            process.wait_for_round_change(current_round_id)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        process.stop()
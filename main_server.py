@@ -1,19 +1,24 @@
 """Main program to run a rendezvous server.
 
-Runs infinitely to listen for processes wanting to join the peer network.
+Runs until interrupted to listen for processes wanting to join the peer network.
 """
 
+import logging
+
 from classes import Server
 
 if __name__ == "__main__":
 
-    # Start server.
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Start server, which returns once it is listening.
     server = Server("0.0.0.0", 8000)
     server.start()
 
-    # Give some time for server to start listening.
-    import time
-    time.sleep(2)
-    
-    while(True):
+    # Sleep until the server shuts down or is interrupted.
+    try:
+        server.wait_for_shutdown()
+    except KeyboardInterrupt:
         pass
+    finally:
+        server.stop()